@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import tqdm
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+from GitHubIssue.dataset.batching import BucketBatchSampler
+
+
+def activation_cache_key(model, dataset):
+    """
+    缓存的 key 由模型, 冻结层数和数据集的 tokenize 结果决定
+    """
+    key = {
+        'model': type(model).__name__,
+        'model_name': model.hparams.get('model_name'),
+        'frozen_layers': model.frozen_layers(),
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8'))
+    for name in sorted(dataset.columns.keys()):
+        digest.update(name.encode('utf-8'))
+        digest.update(np.asarray(dataset.columns[name], dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def build_activation_cache(model, dataset, path, collate_fn, batch_size=32, device='cpu'):
+    """
+    计算数据集在冻结层上的输出, 去除 padding 后以 float16 写入 memory-map 文件
+    """
+    if getattr(collate_fn, 'padding_side', 'right') != 'right':
+        raise Exception("activation cache only supports right padding")
+
+    lengths = np.asarray(dataset.lengths, dtype=np.int64)
+    offsets = np.zeros((len(lengths) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    hidden_states = np.lib.format.open_memmap(os.path.join(tmp_path, 'hidden_states.npy'), mode='w+', dtype=np.float16,
+                                              shape=(int(offsets[-1]), model.model.config.hidden_size))
+
+    training = model.training
+    model.eval()
+    model.to(device)
+    index = 0
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    for inputs, _ in tqdm.tqdm(loader, desc="cache frozen layer activations"):
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        states = model.frozen_forward(inputs).to(torch.float16).cpu().numpy()
+        for state in states:
+            start, end = offsets[index], offsets[index + 1]
+            hidden_states[start:end] = state[:end - start]
+            index += 1
+    model.train(training)
+
+    hidden_states.flush()
+    del hidden_states
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # 其他进程已经写入了相同的缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class FrozenActivationDataset(torch.utils.data.Dataset):
+    """
+    读取缓存的冻结层输出, 每个样本为 (length, hidden_size) 的 float16 矩阵
+    """
+    def __init__(self, path, labels):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.lengths = np.diff(self.offsets)
+        self.labels = labels
+        self.hidden_states = None
+
+    def __getitem__(self, i):
+        # 在 DataLoader 的 worker 中打开 memory-map 文件
+        if self.hidden_states is None:
+            self.hidden_states = np.load(os.path.join(self.path, 'hidden_states.npy'), mmap_mode='r')
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return torch.from_numpy(np.array(self.hidden_states[start:end])), self.labels[i]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['hidden_states'] = None
+        return state
+
+
+class FrozenActivationCollator(object):
+    """
+    将 batch 内的冻结层输出 pad 到 batch 中最长样本的长度, 并生成对应的 attention_mask
+    """
+    def __init__(self, num_classes: int = None):
+        self.num_classes = num_classes
+
+    def __call__(self, batch):
+        states = [x for x, _ in batch]
+        length = max(x.size(0) for x in states)
+        hidden_states = states[0].new_zeros((len(states), length, states[0].size(1)))
+        attention_mask = torch.zeros((len(states), length), dtype=torch.long)
+        for i, x in enumerate(states):
+            hidden_states[i, :x.size(0)] = x
+            attention_mask[i, :x.size(0)] = 1
+        labels = default_collate([y for _, y in batch])
+        if self.num_classes is not None and labels.dim() == 1:
+            labels = F.one_hot(labels.long(), self.num_classes)
+        return {'hidden_states': hidden_states, 'attention_mask': attention_mask}, labels
+
+
+def frozen_activation_loader(model, dataset, cache_dir, collate_fn, batch_size, shuffle=False, num_workers=0,
+                             device='cpu', num_classes=None):
+    """
+    读取或构建数据集的冻结层输出缓存, 返回从缓存训练顶部层的 DataLoader
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, activation_cache_key(model, dataset))
+    if not os.path.isfile(os.path.join(path, 'offsets.npy')):
+        build_activation_cache(model, dataset, path, collate_fn, device=device)
+    else:
+        print(f"load frozen layer activations from cache {path}")
+
+    labels = dataset.labels if dataset.compact else dataset.label_list
+    activation_dataset = FrozenActivationDataset(path, [torch.as_tensor(y, dtype=torch.long) for y in labels])
+    activation_collator = FrozenActivationCollator(num_classes=num_classes)
+    if shuffle:
+        sampler = BucketBatchSampler(activation_dataset.lengths, batch_size=batch_size, shuffle=True)
+        return DataLoader(activation_dataset, batch_sampler=sampler, num_workers=num_workers, collate_fn=activation_collator)
+    return DataLoader(activation_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=activation_collator)
@@ -9,6 +9,7 @@ from allennlp.data.dataset_readers import DatasetReader
 from allennlp.data.token_indexers import TokenIndexer, SingleIdTokenIndexer
 from allennlp.data.tokenizers import Token, Tokenizer, SpacyTokenizer
 from allennlp.data.vocabulary import Vocabulary
+from GitHubIssue.dataset.json_stream import iter_json_records
 
 
 class AllennlpIssueDatasetReader(DatasetReader):
@@ -30,9 +31,6 @@ class AllennlpIssueDatasetReader(DatasetReader):
         return Instance(fields)
 
     def read(self, file_path: str) -> Iterator[Instance]:
-        dataset = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            dataset = json.load(f)
-
-        for each_data in dataset:
+        # 流式读取, 不将整个文件载入内存
+        for each_data in iter_json_records(file_path):
             yield self.text_to_instance(each_data['title'] + ' ' + each_data['description'], each_data['labels'])
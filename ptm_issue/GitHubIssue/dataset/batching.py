@@ -0,0 +1,118 @@
+import math
+from typing import Sequence
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+class IssueCollator(object):
+    """
+    将 batch 内压缩存储的 ids 转换为 long, 并将 class id 展开为 one-hot 标签
+    """
+    def __init__(self, num_classes: int = None):
+        self.num_classes = num_classes
+
+    def __call__(self, batch):
+        inputs, labels = default_collate(batch)
+        for k, v in inputs.items():
+            if isinstance(v, torch.Tensor):
+                inputs[k] = v.long()
+        if self.num_classes is not None and labels.dim() == 1:
+            labels = F.one_hot(labels.long(), self.num_classes)
+        return inputs, labels
+
+
+class DynamicPaddingCollator(IssueCollator):
+    """
+    将 batch 内的样本只 pad 到 batch 中最长样本的长度, 而不是固定的 max_length
+    """
+    def __init__(self, padding_side: str = 'right', pad_token_id: int = 0, min_length: int = 8,
+                 num_classes: int = None):
+        super().__init__(num_classes)
+        self.padding_side = padding_side
+        self.pad_token_id = pad_token_id
+        # textcnn 等模型的卷积核需要最小长度
+        self.min_length = min_length
+
+    def batch_length(self, inputs):
+        if 'attention_mask' in inputs:
+            length = int(inputs['attention_mask'].sum(dim=1).max())
+        else:
+            not_pad = (inputs['input_ids'] != self.pad_token_id).long()
+            if self.padding_side == 'left':
+                not_pad = not_pad.flip(dims=[1])
+            # 最后一个非 pad token 的位置
+            positions = torch.arange(1, not_pad.size(1) + 1, device=not_pad.device)
+            length = int((not_pad * positions).max())
+        return max(length, self.min_length)
+
+    def __call__(self, batch):
+        inputs, labels = super().__call__(batch)
+        length = self.batch_length(inputs)
+        for k, v in inputs.items():
+            if isinstance(v, torch.Tensor) and v.dim() == 2 and v.size(1) > length:
+                if self.padding_side == 'left':
+                    inputs[k] = v[:, -length:].contiguous()
+                else:
+                    inputs[k] = v[:, :length].contiguous()
+        return inputs, labels
+
+
+class BucketBatchSampler(Sampler):
+    """
+    按长度分桶的 batch sampler: 每个 epoch 先随机打乱, 再在大小为 bucket_size 的桶内按长度排序切分 batch,
+    最后打乱 batch 的顺序, 使同一 batch 内的样本长度相近
+    """
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_size: int = None, shuffle: bool = True,
+                 drop_last: bool = False, seed: int = None):
+        self.lengths = [int(x) for x in lengths]
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size if bucket_size is not None else batch_size * 50
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        # 默认从 torch 的全局随机数生成器中取种子, 不同的 seed_everything 和多次训练得到不同的 batch 顺序
+        self.seed = seed if seed is not None else int(torch.randint(2 ** 31, ()).item())
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        # 没有调用 set_epoch 时, 每次迭代自动使用新的随机顺序
+        self.epoch += 1
+
+        num_samples = len(self.lengths)
+        if self.shuffle:
+            indices = torch.randperm(num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(num_samples))
+
+        batches = []
+        for start in range(0, num_samples, self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        num_samples = len(self.lengths)
+        if not self.drop_last:
+            return math.ceil(num_samples / self.batch_size)
+        # drop_last 时每个桶各自丢弃不满的 batch
+        count = 0
+        for start in range(0, num_samples, self.bucket_size):
+            count += min(self.bucket_size, num_samples - start) // self.batch_size
+        return count
@@ -1,7 +1,12 @@
+import hashlib
 import json
 import os
 import pickle
+import random
 import re
+import shutil
+from contextlib import contextmanager
+from multiprocessing import Pool
 from typing import Sequence, Union
 
 import numpy as np
@@ -9,8 +14,22 @@ import pytorch_lightning as pl
 import torch
 import tqdm
 import transformers
+from GitHubIssue.dataset.json_stream import iter_json_records
 from GitHubIssue.tokenizer.allennlp_tokenizer import AllennlpTokenizer
-from transformers import BertTokenizer, GPT2Tokenizer, T5Tokenizer
+from transformers import (BertTokenizer, BertTokenizerFast, GPT2Tokenizer,
+                          GPT2TokenizerFast, RobertaTokenizer,
+                          RobertaTokenizerFast, T5Tokenizer)
+
+# 文本拼接模板, 修改 issue_to_text 的拼接方式时需要同步修改, 使旧的缓存失效
+TEXT_TEMPLATE = "Title: {title} | Details: {description} | Comments: {comments}"
+
+# 与 slow tokenizer 编码结果一致的 fast tokenizer: 在 my_data 全部 issue 上逐条比较过 input_ids 和 attention_mask 完全相同.
+# xlnet, albert, t5 等 sentencepiece tokenizer 的 fast 版本与 slow 版本结果不完全一致, 使用多进程的 slow tokenizer
+FAST_TOKENIZER_CONFIG = {
+    BertTokenizer: BertTokenizerFast,
+    RobertaTokenizer: RobertaTokenizerFast,
+    GPT2Tokenizer: GPT2TokenizerFast,
+}
 
 
 def concat_str(tokenizer, text_list):
@@ -36,18 +55,271 @@ def concat_str(tokenizer, text_list):
                 final_str += " . " + text
     return final_str
 
+
+def concat_template(tokenizer):
+    """
+    concat_str 对不同 tokenizer 使用的拼接方式
+    """
+    if isinstance(tokenizer, T5Tokenizer):
+        return "t5"
+    elif isinstance(tokenizer, BertTokenizer):
+        return "bert"
+    elif isinstance(tokenizer, GPT2Tokenizer):
+        return "gpt2"
+    return "default"
+
+
+def issue_to_text(tokenizer, obj):
+    """
+    将 issue 的 title, description 和 comments 拼接为模型的输入文本
+    """
+    # text = obj['title'] + ' ' + obj['description']
+    title = "Title: "+ obj['title']
+    description = "Details: " + obj['description']
+    if obj.get("commment_concat_str") is not None:
+        # text += " " + obj["commment_concat_str"]
+        comments_list = obj['commment_concat_str'].split("concatcommentsign")
+        if len(comments_list) != 0:
+            comments_list[0] = "Comments: " + comments_list[0]
+        text = concat_str(tokenizer, [title, description] + comments_list)
+    else:
+        text = concat_str(tokenizer, [title, description])
+    return text
+
+
+def encode_issue(tokenizer, obj, max_length=512):
+    """
+    tokenize 单个 issue, 返回去除 batch 维度后的 numpy 数组
+    """
+    text = issue_to_text(tokenizer, obj)
+    # text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')['input_ids']
+    if isinstance(tokenizer, AllennlpTokenizer):
+        _text_ids = tokenizer(text, truncation=True, max_length=max_length, padding='max_length')
+        _text_ids['input_ids'] = torch.tensor(_text_ids['input_ids'], dtype=torch.long)
+    else:
+        _text_ids = tokenizer(text, truncation=True, max_length=max_length, padding='max_length', return_tensors='pt')
+    # 清除batch_size 维度，数据集会自动添加该维度
+    return {k: v.squeeze(0).numpy() for k, v in _text_ids.items() if isinstance(v, torch.Tensor)}
+
+
+def issue_label(obj, label_to_id):
+    labels_ids = np.zeros((len(label_to_id),))
+    labels_ids[label_to_id[obj['labels']]] = 1
+    # for c in labels:
+    #     label_id = self.label_to_id[c]
+    #     labels_ids[label_id] = 1
+    return labels_ids
+
+
+def to_fast_tokenizer(tokenizer):
+    """
+    获取与 slow tokenizer 编码结果一致的 fast tokenizer, 没有对应的 fast tokenizer 时返回 None
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        return tokenizer
+    fast_cls = FAST_TOKENIZER_CONFIG.get(type(tokenizer))
+    if fast_cls is None:
+        return None
+    kwargs = {}
+    if 'do_lower_case' in tokenizer.init_kwargs:
+        kwargs['do_lower_case'] = tokenizer.init_kwargs['do_lower_case']
+    fast_tokenizer = fast_cls.from_pretrained(tokenizer.name_or_path, **kwargs)
+    # gpt2 等模型在加载后修改了 pad_token 和 padding_side
+    fast_tokenizer.pad_token = tokenizer.pad_token
+    fast_tokenizer.padding_side = tokenizer.padding_side
+    return fast_tokenizer
+
+
+def _encode(tokenizer, texts, max_length):
+    encoding = tokenizer(texts, truncation=True, max_length=max_length, padding='max_length', return_tensors='np')
+    return {k: np.asarray(v) for k, v in encoding.items()}
+
+
+def _same_encoding(tokenizer, fast_tokenizer, texts, max_length):
+    """
+    检查 fast tokenizer 与逐条调用 slow tokenizer 的编码结果是否一致
+    """
+    expected = {}
+    for text in texts:
+        for k, v in _encode(tokenizer, text, max_length).items():
+            expected.setdefault(k, []).append(v[0])
+    actual = _encode(fast_tokenizer, texts, max_length)
+    if set(expected.keys()) != set(actual.keys()):
+        return False
+    return all(np.array_equal(np.stack(v), actual[k]) for k, v in expected.items())
+
+
+@contextmanager
+def _tokenizers_parallelism():
+    # 训练脚本关闭了 tokenizers 的多线程以避免 DataLoader fork 时死锁, 批量 tokenize 时临时打开
+    origin = os.environ.get("TOKENIZERS_PARALLELISM")
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+    try:
+        yield
+    finally:
+        if origin is None:
+            del os.environ["TOKENIZERS_PARALLELISM"]
+        else:
+            os.environ["TOKENIZERS_PARALLELISM"] = origin
+
+
+_worker_tokenizer = None
+
+
+def _init_tokenize_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_chunk(args):
+    texts, max_length = args
+    return _encode(_worker_tokenizer, texts, max_length)
+
+
+def batch_tokenize(tokenizer, texts, max_length=512, num_proc=1, chunk_size=256, check_size=64, fast_tokenizer=None):
+    """
+    批量 tokenize: 有 fast tokenizer 时使用 fast tokenizer 一次编码全部文本,
+    否则将文本切分为多个 chunk, 使用进程池并行调用 slow tokenizer.
+    FAST_TOKENIZER_CONFIG 只包含与 slow tokenizer 结果一致的 fast tokenizer, 编码前再检查前 check_size 条文本,
+    不一致时 (例如本地模型的 tokenizer 配置不同) 直接报错, 不使用结果不同的 ids 训练
+    """
+    if fast_tokenizer is None:
+        fast_tokenizer = to_fast_tokenizer(tokenizer)
+    if fast_tokenizer is not None:
+        if fast_tokenizer is not tokenizer and not _same_encoding(tokenizer, fast_tokenizer, texts[:check_size], max_length):
+            raise Exception(f"{type(fast_tokenizer).__name__} is inconsistent with {type(tokenizer).__name__} "
+                            f"of {tokenizer.name_or_path}, run without --batch_tokenize")
+        with _tokenizers_parallelism():
+            return _encode(fast_tokenizer, texts, max_length)
+
+    chunks = [(texts[i:i + chunk_size], max_length) for i in range(0, len(texts), chunk_size)]
+    if num_proc > 1 and len(chunks) > 1:
+        with Pool(min(num_proc, len(chunks)), initializer=_init_tokenize_worker, initargs=(tokenizer,)) as pool:
+            results = pool.map(_tokenize_chunk, chunks)
+    else:
+        results = [_encode(tokenizer, chunk, max_length) for chunk, max_length in chunks]
+    return {k: np.concatenate([r[k] for r in results]) for k in results[0].keys()}
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    计算 tokenizer 的词表指纹, 词表相同的模型 (如 roberta-base 和 codebert-base) 得到相同的指纹.
+    fast 和 slow tokenizer 的指纹不同
+    """
+    sha = hashlib.sha256()
+    if isinstance(tokenizer, AllennlpTokenizer):
+        sha.update(b"allennlp")
+        token_to_index = tokenizer.vocab.get_token_to_index_vocabulary('tokens')
+        sha.update(json.dumps(sorted(token_to_index.items()), ensure_ascii=False).encode('utf-8'))
+        sha.update(str(getattr(tokenizer.token_indexer, 'lowercase_tokens', None)).encode('utf-8'))
+    else:
+        # fast 和 slow tokenizer 的结果分别缓存, 批量和逐条 tokenize 的训练互不影响
+        sha.update(type(tokenizer).__name__.encode('utf-8'))
+        sha.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode('utf-8'))
+        sha.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode('utf-8'))
+        sha.update(str(getattr(tokenizer, 'do_lower_case', None)).encode('utf-8'))
+        sha.update(str(tokenizer.padding_side).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def data_fingerprint(data):
+    """
+    计算数据集中参与拼接的文本字段的指纹
+    """
+    sha = hashlib.sha256()
+    for obj in data:
+        fields = [obj['title'], obj['description'], obj.get("commment_concat_str")]
+        sha.update(json.dumps(fields, ensure_ascii=False).encode('utf-8'))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _cache_key(data_hash, tokenizer, max_length):
+    key = {
+        'data': data_hash,
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'max_length': max_length,
+        'template': TEXT_TEMPLATE + '@' + concat_template(tokenizer),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compact_dtype(name, value):
+    """
+    ids 在词表大小允许时使用 int16, 否则使用 int32, mask 等其他矩阵使用 uint8
+    """
+    if name == 'input_ids':
+        if value.size == 0 or int(value.max()) <= np.iinfo(np.int16).max:
+            return np.int16
+        return np.int32
+    return np.uint8
+
+
+def load_cached_columns(cache_dir, key):
+    """
+    以 memory-map 的方式读取缓存的 input_ids / attention_mask 等矩阵, 缓存不存在时返回 None
+    """
+    path = os.path.join(cache_dir, key)
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    columns = {}
+    for name in meta['columns']:
+        columns[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+    return columns
+
+
+def save_cached_columns(cache_dir, key, columns):
+    """
+    将 tokenize 结果以压缩的类型写入缓存
+    """
+    path = os.path.join(cache_dir, key)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, value in columns.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), value.astype(compact_dtype(name, value)))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'columns': list(columns.keys()), 'size': len(next(iter(columns.values())))}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # 其他进程已经写入了相同的缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 class IssueDataset(torch.utils.data.Dataset):
 
-    def __init__(self, dataset: Union[str, Sequence], all_labels: Sequence, tokenizer=None, lazy=False, is_gpt=True):
+    def __init__(self, dataset: Union[str, Sequence], all_labels: Sequence, tokenizer=None, lazy=False, is_gpt=True,
+                 max_length=512, cache_dir=None, batch_tokenize=False, num_proc=1, compact=False):
         self.data = []
+        # lazy 模式下不预先 tokenize, 在 __getitem__ 中 (即 DataLoader 的 worker 中) tokenize
+        self.lazy = lazy
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_tokenize = batch_tokenize
+        # compact 模式下按列压缩存储 ids, 标签只保存 class id, 在 collate 时展开为 one-hot
+        self.compact = compact
+        self.num_proc = num_proc
+        data_hash = None
         if isinstance(dataset, str):
             with open(dataset, 'r', encoding='utf-8') as f:
                 for line in f:
                     self.data.append(json.loads(line))
+            if cache_dir is not None:
+                data_hash = file_fingerprint(dataset)
         else:
             self.data = dataset
 
-        self.text_list = []
         self.label_list = []
 
         # id to label and label to id
@@ -59,61 +331,174 @@ class IssueDataset(torch.utils.data.Dataset):
         for key, value in self.label_to_id.items():
             self.id_to_label[value] = key
 
+        # 优先从缓存中读取 tokenize 结果
+        self.columns = None
+        if self.lazy:
+            pass
+        elif cache_dir is not None and len(self.data) != 0:
+            if data_hash is None:
+                data_hash = data_fingerprint(self.data)
+            # 批量 tokenize 使用 fast tokenizer 时按 fast tokenizer 计算缓存 key, 非批量的训练不会读取到 fast 的结果
+            fast_tokenizer = self.fast_tokenizer(tokenizer)
+            key = _cache_key(data_hash, fast_tokenizer or tokenizer, max_length)
+            self.columns = load_cached_columns(cache_dir, key)
+            if self.columns is None:
+                self.columns = self.tokenize(tokenizer, max_length, fast_tokenizer)
+                save_cached_columns(cache_dir, key, self.columns)
+                self.columns = load_cached_columns(cache_dir, key)
+            else:
+                print(f"load tokenized dataset from cache {os.path.join(cache_dir, key)}")
+        elif len(self.data) != 0:
+            self.columns = self.tokenize(tokenizer, max_length)
+            if self.compact:
+                self.columns = {k: np.ascontiguousarray(v, dtype=compact_dtype(k, v)) for k, v in self.columns.items()}
+
+        # 每个样本去除 padding 后的长度, 用于按长度分桶
+        self.lengths = self.compute_lengths(tokenizer)
+
         # convert data to matrices
+        if self.compact:
+            self.labels = np.array([self.label_to_id[obj['labels']] for obj in self.data], dtype=np.int64)
+        else:
+            for obj in self.data:
+                self.label_list.append(issue_label(obj, self.label_to_id))
+
+    def fast_tokenizer(self, tokenizer):
+        if self.batch_tokenize and not isinstance(tokenizer, AllennlpTokenizer):
+            return to_fast_tokenizer(tokenizer)
+        return None
+
+    def tokenize(self, tokenizer, max_length=512, fast_tokenizer=None):
+        if self.batch_tokenize and not isinstance(tokenizer, AllennlpTokenizer):
+            # 拼接文本使用 slow tokenizer 的类型判断, fast tokenizer 只用于编码
+            texts = [issue_to_text(tokenizer, obj) for obj in self.data]
+            return batch_tokenize(tokenizer, texts, max_length=max_length, num_proc=self.num_proc,
+                                  fast_tokenizer=fast_tokenizer)
+
+        columns = {}
         for obj in self.data:
-            # text = obj['title'] + ' ' + obj['description']
-            title = "Title: "+ obj['title']
-            description = "Details: " + obj['description']
-            if obj.get("commment_concat_str") is not None:
-                # text += " " + obj["commment_concat_str"]
-                comments_list = obj['commment_concat_str'].split("concatcommentsign")
-                if len(comments_list) != 0:
-                    comments_list[0] = "Comments: " + comments_list[0]
-                text = concat_str(tokenizer, [title, description] + comments_list)
-            else:
-                text = concat_str(tokenizer, [title, description])
-            # text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')['input_ids']
-            if isinstance(tokenizer, AllennlpTokenizer):
-                _text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')
-                _text_ids['input_ids'] = torch.tensor(_text_ids['input_ids'], dtype=torch.long)
-                text_ids = {}
-                for k, v in _text_ids.items():
-                    if isinstance(v, torch.Tensor):
-                        text_ids[k] = v.squeeze(0)
-                    else:
-                        text_ids[k] = v
-            else:
-                _text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length', return_tensors='pt')
-                # 清除batch_size 维度，数据集会自动添加该维度
-                text_ids = {}
-                for k, v in _text_ids.items():
-                    if isinstance(v, torch.Tensor):
-                        text_ids[k] = v.squeeze(0)
-                    else:
-                        text_ids[k] = v
-
-            labels = obj['labels']
-            labels_ids = np.zeros((len(all_labels),))
-
-            label_id = self.label_to_id[labels]
-            labels_ids[label_id] = 1
-        
-            # for c in labels:
-            #     label_id = self.label_to_id[c]
-            #     labels_ids[label_id] = 1
-
-            self.text_list.append(text_ids)
-            self.label_list.append(labels_ids)
+            for k, v in encode_issue(tokenizer, obj, max_length).items():
+                columns.setdefault(k, []).append(v)
+        return {k: np.stack(v) for k, v in columns.items()}
+
+    def compute_lengths(self, tokenizer):
+        if self.columns is None:
+            # lazy 模式下长度未知
+            return np.zeros((len(self.data),), dtype=np.int64)
+        if 'attention_mask' in self.columns:
+            return np.asarray(self.columns['attention_mask']).sum(axis=1).astype(np.int64)
+        if isinstance(tokenizer, AllennlpTokenizer):
+            pad_token_id = tokenizer.vocab.get_token_index(tokenizer.vocab._padding_token)
+        else:
+            pad_token_id = tokenizer.pad_token_id
+        return (np.asarray(self.columns['input_ids']) != pad_token_id).sum(axis=1).astype(np.int64)
 
     def __getitem__(self, i):
         # return (
         #     torch.tensor(self.text_list[i], dtype=torch.long),
         #     torch.tensor(self.label_list[i], dtype=torch.long)
         # )
+        if self.columns is None:
+            columns = encode_issue(self.tokenizer, self.data[i], self.max_length)
+        else:
+            columns = {k: v[i] for k, v in self.columns.items()}
+        if self.compact:
+            # 保持压缩的类型, 由 IssueCollator 转换为 long
+            text_ids = {k: torch.from_numpy(np.array(v)) for k, v in columns.items()}
+            return text_ids, torch.tensor(self.labels[i], dtype=torch.long)
+
+        text_ids = {k: torch.tensor(v, dtype=torch.long) for k, v in columns.items()}
         return (
-            self.text_list[i],
+            text_ids,
             torch.tensor(self.label_list[i], dtype=torch.long)
         )
 
     def __len__(self):
+        if self.compact and not self.lazy:
+            return len(self.labels)
         return len(self.data)
+
+    def __getstate__(self):
+        # 原始 issue 只在主进程中用于预测和报告, 不复制到 DataLoader 的 worker 中
+        state = self.__dict__.copy()
+        if self.compact and not self.lazy:
+            state['data'] = []
+        return state
+
+
+class IssueIterableDataset(torch.utils.data.IterableDataset):
+    """
+    流式读取 json/jsonl 文件的数据集, 在 DataLoader 的 worker 中 tokenize,
+    并按 worker (以及分布式训练的 rank) 切分样本, 使用 shuffle buffer 在有限内存内打乱样本顺序
+    """
+    def __init__(self, dataset: Union[str, Sequence], all_labels: Sequence, tokenizer=None, max_length=512,
+                 shuffle_buffer=0, seed=None):
+        self.dataset = dataset
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.shuffle_buffer = shuffle_buffer
+        # seed 为 None 时使用 DataLoader 每个 epoch 为 worker 生成的随机种子
+        self.seed = seed
+        self.epoch = 0
+
+        self.label_to_id = {}
+        for i, c in enumerate(all_labels):
+            self.label_to_id[c] = i
+
+        self.id_to_label = {}
+        for key, value in self.label_to_id.items():
+            self.id_to_label[value] = key
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def records(self):
+        if isinstance(self.dataset, str):
+            return iter_json_records(self.dataset)
+        return iter(self.dataset)
+
+    def shard(self):
+        """
+        返回当前进程需要读取的分片编号和分片数量
+        """
+        num_shards, shard_id = 1, 0
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            num_shards = torch.distributed.get_world_size()
+            shard_id = torch.distributed.get_rank()
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shard_id = shard_id * worker_info.num_workers + worker_info.id
+            num_shards = num_shards * worker_info.num_workers
+        return shard_id, num_shards
+
+    def shuffle(self, records):
+        if self.seed is not None:
+            seed = self.seed
+        else:
+            worker_info = torch.utils.data.get_worker_info()
+            seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+        # num_workers=0 时 initial_seed, persistent_workers 时 worker 的种子在每个 epoch 都相同, 需要加上 epoch
+        rng = random.Random(seed + self.epoch)
+        # 没有调用 set_epoch 时, 每次迭代自动使用新的随机顺序
+        self.epoch += 1
+        buffer = []
+        for obj in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(obj)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = obj
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        shard_id, num_shards = self.shard()
+        # 每个 worker 都会解析整个文件, 但只 tokenize 属于自己分片的样本
+        records = (obj for i, obj in enumerate(self.records()) if i % num_shards == shard_id)
+        if self.shuffle_buffer > 1:
+            records = self.shuffle(records)
+        for obj in records:
+            text_ids = {k: torch.tensor(v, dtype=torch.long)
+                        for k, v in encode_issue(self.tokenizer, obj, self.max_length).items()}
+            yield text_ids, torch.tensor(issue_label(obj, self.label_to_id), dtype=torch.long)
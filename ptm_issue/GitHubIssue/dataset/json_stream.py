@@ -0,0 +1,57 @@
+import json
+
+
+def iter_json_records(path: str, chunk_size: int = 1 << 20):
+    """
+    流式读取 json 数组文件或 jsonl 文件中的 issue, 不会将整个文件载入内存
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        head = f.read(1)
+        while head != '' and head.isspace():
+            head = f.read(1)
+        if head == '':
+            return
+
+        # jsonl: 每行一个 issue
+        if head != '[':
+            yield json.loads(head + f.readline())
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        # json 数组: 分块读取, 逐个解析数组中的元素
+        decoder = json.JSONDecoder()
+        buffer, pos = '', 0
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                pos += 1
+            if pos == len(buffer):
+                buffer, pos = f.read(chunk_size), 0
+                if buffer == '':
+                    raise ValueError(f"unexpected end of json file: {path}")
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # 元素跨越了两个块, 继续读取
+                more = f.read(chunk_size)
+                if more == '':
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield obj
+            pos = end
+
+
+class JsonRecords(object):
+    """
+    可重复迭代的 issue 文件, 每次迭代重新流式读取文件
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self):
+        return iter_json_records(self.path)
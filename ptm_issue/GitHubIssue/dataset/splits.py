@@ -0,0 +1,17 @@
+import numpy as np
+from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
+
+
+def stratified_kfold_indices(labels, n_splits, valid_size=0.2, random_state=42):
+    """
+    分层 K 折划分, 只返回下标: 每折的测试集为一折, 其余样本再按 valid_size 分层划分出验证集
+    返回 [(train_index, valid_index, test_index), ...]
+    """
+    labels = np.asarray(labels)
+    folds = []
+    kfold = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    for rest_index, test_index in kfold.split(np.zeros(len(labels)), labels):
+        split = StratifiedShuffleSplit(n_splits=1, test_size=valid_size, random_state=random_state)
+        train_index, valid_index = next(split.split(np.zeros(len(rest_index)), labels[rest_index]))
+        folds.append((rest_index[train_index], rest_index[valid_index], test_index))
+    return folds
@@ -1,6 +1,20 @@
 import torch
 from torchmetrics import Metric
 
+
+def topk_binarize(preds: torch.Tensor, top_k: int) -> torch.Tensor:
+    """
+    将每一行 top_k 个最大值的位置置为 1, 其余为 0, 返回 long 类型的 (batch_size, num_classes) 张量
+    """
+    # Top K indexes of the preds (or fewer, if there aren't K of them).
+    # Special case topk == 1, because it's common and .max() is much faster than .topk().
+    if top_k == 1:
+        indices = preds.max(-1)[1].unsqueeze(-1)
+    else:
+        indices = preds.topk(min(top_k, preds.shape[-1]), -1)[1]
+    return torch.zeros(preds.shape, dtype=torch.long, device=preds.device).scatter_(-1, indices, 1)
+
+
 class MultiLabelAccuracy(Metric):
     def __init__(self, dist_sync_on_step=False, top_k: int = 1):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
@@ -28,26 +42,12 @@ class MultiLabelAccuracy(Metric):
                 "target must have dimension == preds.size() but "
                 "found tensor of shape: {}".format(preds.size())
             )
-        if (target >= num_classes).any():
-            raise Exception(
-                "A gold label passed to RecAccuracy contains an id >= {}, "
-                "the number of classes.".format(num_classes)
-            )
 
         preds = preds.view(-1, num_classes)
         target = target.view(-1, num_classes).long()
 
-        # Top K indexes of the preds (or fewer, if there aren't K of them).
-        # Special case topk == 1, because it's common and .max() is much faster than .topk().
-        if self._top_k == 1:
-            top_k = preds.max(-1)[1].unsqueeze(-1)
-        else:
-            top_k = preds.topk(min(self._top_k, preds.shape[-1]), -1)[1]
-
         batch_size = preds.shape[0]
-        preds_bin = torch.zeros(batch_size, num_classes, dtype=torch.long, device=target.device)
-        for i in range(batch_size):
-            preds_bin[i, top_k[i]] = 1
+        preds_bin = topk_binarize(preds, self._top_k).to(target.device)
 
         correct_tensor = preds_bin & target
         union_tensor = preds_bin | target
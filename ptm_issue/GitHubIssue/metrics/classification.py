@@ -0,0 +1,86 @@
+import torch
+from torchmetrics import Metric
+
+from .accuracy import topk_binarize
+
+
+def _safe_divide(numerator, denominator):
+    return numerator.float() / denominator.float().clamp(min=1e-12)
+
+
+def _f1(tp, fp, fn):
+    # 分母为 0 的类别 f1 为 0, 与 torchmetrics.F1 和 sklearn 一致
+    return _safe_divide(2 * tp, 2 * tp + fp + fn)
+
+
+class IssueClassificationMetrics(Metric):
+    """
+    一个 stage 的全部指标: 只累计 top-1 / top-2 的 C×C 命中矩阵, 所有指标在计算时由命中矩阵得到
+
+    hits_k[i, j] 为真实类别是 i 且 j 在 top-k 预测中的样本数, 每个 issue 只有一个标签,
+    因此对角线是每个类别的 tp, 列和是每个类别被预测的次数, 行和除以 k 是每个类别的样本数.
+    输出的指标名称和数值与原来的 MultiLabelAccuracy 和 torchmetrics 的 Precision / Recall / F1 一致
+    """
+    def __init__(self, num_classes: int, stage: str, top_ks=(1, 2), selected_classes=None, dist_sync_on_step=False):
+        super().__init__(dist_sync_on_step=dist_sync_on_step)
+        self.num_classes = num_classes
+        self.stage = stage
+        self.top_ks = list(top_ks)
+        self.selected_classes = selected_classes
+        for k in self.top_ks:
+            self.add_state(f"hits_{k}", default=torch.zeros(num_classes, num_classes, dtype=torch.long), dist_reduce_fx="sum")
+
+    def batch_hits(self, preds: torch.Tensor, target: torch.Tensor):
+        preds = preds.detach().view(-1, self.num_classes)
+        target = target.view(-1, self.num_classes).float()
+        # CUDA 上不支持整数矩阵乘法, 使用 float 计算后转换, 计数在 2^24 以内是精确的
+        return {k: (target.t() @ topk_binarize(preds, k).float()).round().long() for k in self.top_ks}
+
+    def update(self, preds: torch.Tensor, target: torch.Tensor):
+        # 保留这个 batch 的命中矩阵, 用于计算 step 级别的指标
+        self.last_hits = self.batch_hits(preds, target)
+        for k, hits in self.last_hits.items():
+            setattr(self, f"hits_{k}", getattr(self, f"hits_{k}") + hits)
+
+    def step(self, preds: torch.Tensor, target: torch.Tensor):
+        """
+        累计一个 batch, 并返回这个 batch 上的指标, 与 torchmetrics 的 forward 相同, 但命中矩阵只计算一次
+        """
+        self.update(preds, target)
+        return self.derive(self.last_hits, '_step')
+
+    def compute(self):
+        hits = {k: getattr(self, f"hits_{k}") for k in self.top_ks}
+        metrics = self.derive(hits, '_epoch')
+        if self.selected_classes is not None:
+            metrics['selected_f1'] = self.selected_f1(hits[1])
+        return metrics
+
+    def derive(self, hits, suffix):
+        metrics = {}
+        for k, h in hits.items():
+            tp = h.diagonal()
+            predicted = h.sum(0)
+            support = torch.div(h.sum(1), min(k, self.num_classes), rounding_mode='floor')
+            fp = predicted - tp
+            fn = support - tp
+            f1 = _f1(tp, fp, fn)
+            total = support.sum()
+            name = f"{self.stage}_{{}}_{k}{suffix}"
+            metrics[name.format('acc')] = _safe_divide(tp.sum(), total)
+            metrics[name.format('precision')] = _safe_divide(tp.sum(), predicted.sum())
+            metrics[name.format('recall')] = _safe_divide(tp.sum(), total)
+            metrics[name.format('f1_marco')] = f1.mean()
+            metrics[name.format('f1_marco_weight')] = _safe_divide((f1 * support).sum(), total)
+            metrics[name.format('f1_mirco')] = _f1(tp.sum(), fp.sum(), fn.sum())
+        return metrics
+
+    def selected_f1(self, h):
+        """
+        只关注 selected_classes 的 top-1 macro f1, 与 sklearn 的 f1_score(labels=selected_classes, average='macro') 一致
+        """
+        tp = h.diagonal()
+        f1 = _f1(tp, h.sum(0) - tp, h.sum(1) - tp)
+        selected = [c for c in self.selected_classes if c < self.num_classes]
+        # 不存在的类别 f1 为 0
+        return f1[selected].sum() / len(self.selected_classes)
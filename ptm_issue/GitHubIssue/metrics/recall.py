@@ -1,6 +1,8 @@
 import torch
 from torchmetrics import Metric
 
+from .accuracy import topk_binarize
+
 class MultiLabelRecall(Metric):
     def __init__(self, dist_sync_on_step=False, top_k: int = 1):
         super().__init__(dist_sync_on_step=dist_sync_on_step)
@@ -24,40 +26,26 @@ class MultiLabelRecall(Metric):
         # Some sanity checks.
         num_classes = preds.size(-1)
         if target.dim() != preds.dim():
-            raise ConfigurationError(
+            raise Exception(
                 "target must have dimension == preds.size() but "
                 "found tensor of shape: {}".format(preds.size())
             )
-        if (target >= num_classes).any():
-            raise ConfigurationError(
-                "A gold label passed to RecPrecision contains an id >= {}, "
-                "the number of classes.".format(num_classes)
-            )
 
         preds = preds.view(-1, num_classes)
         target = target.view(-1, num_classes).long()
 
-        # Top K indexes of the preds (or fewer, if there aren't K of them).
-        # Special case topk == 1, because it's common and .max() is much faster than .topk().
-        if self._top_k == 1:
-            top_k = preds.max(-1)[1].unsqueeze(-1)
-        else:
-            top_k = preds.topk(min(self._top_k, preds.shape[-1]), -1)[1]
-
         batch_size = preds.shape[0]
-        preds_bin = torch.zeros(batch_size, num_classes, dtype=torch.long, device=target.device)
-        for i in range(batch_size):
-            preds_bin[i, top_k[i]] = 1
+        preds_bin = topk_binarize(preds, self._top_k).to(target.device)
 
         correct_tensor = preds_bin & target
 
         # This is of shape (batch_size, ..., top_k).
         correct = torch.sum(correct_tensor, -1)
         
-        for i in range(batch_size):
-            if torch.sum(target[i,:]).item() == 0:
-                continue
-            self.correct += correct[i].float() / min(self._top_k, torch.sum(target[i,:]))
+        # 没有标签的样本不计入 correct, 分母为 min(top_k, 标签数)
+        num_labels = torch.sum(target, -1).clamp(max=self._top_k)
+        recall = correct.float() / num_labels.clamp(min=1).float()
+        self.correct += torch.sum(torch.where(num_labels > 0, recall, torch.zeros_like(recall)))
         self.total += batch_size
 
     def compute(self):
@@ -0,0 +1,13 @@
+import torch
+
+from .classification import IssueClassificationMetrics
+
+
+def topk_metrics(logits, labels, num_classes, stage='test'):
+    """
+    由一个 stage 全部的 logits 和类别 id 计算 top-1 / top-2 指标, 与模型中记录的 <stage>_*_epoch 指标使用同一个实现
+    """
+    metric = IssueClassificationMetrics(num_classes, stage)
+    target = torch.nn.functional.one_hot(torch.as_tensor(labels, dtype=torch.long), num_classes)
+    metric.update(torch.as_tensor(logits, dtype=torch.float), target)
+    return {k: float(v) for k, v in metric.compute().items()}
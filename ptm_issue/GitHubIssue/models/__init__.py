@@ -0,0 +1,6 @@
+from .bilstm import BiLSTM
+from .rcnn import RCNN
+from .textcnn import TextCNN
+
+# 按关键字参数 (model(**inputs)) 调用的模型, 其余模型以字典作为输入 (model(inputs))
+KEYWORD_INPUT_MODELS = (TextCNN, BiLSTM, RCNN)
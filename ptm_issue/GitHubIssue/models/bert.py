@@ -16,15 +16,18 @@ from transformers import (AlbertModel, AlbertTokenizer,
 
 from ..loss.focal_loss import FocalLoss
 from ..metrics.accuracy import MultiLabelAccuracy
+from ..metrics.classification import IssueClassificationMetrics
 from ..metrics.precision import MultiLabelPrecision
 from ..metrics.recall import MultiLabelRecall
-from ..metrics.select_f1 import SelectedClassesF1Score
+from ..util.delta_ckpt import from_delta, to_delta
+from ..util.pretrained_cache import pretrained_model
 
 MODEL_CONFIG = {
     "bert-base-uncased": BertModel,
     "albert-base-v2": AlbertModel,
     "roberta-base": RobertaModel,
     "microsoft/codebert-base": RobertaModel,
+    "codebert-base": RobertaModel,
 }
 
 SEQUENCE_MODEL_CONFIG = {
@@ -40,8 +43,12 @@ SEQUENCE_MODEL_CONFIG = {
     "t5-large": T5ForSequenceClassification,
 }
 
+# configure_optimizers 中只微调顶部 trainable_layers 层的模型
+PARTIAL_FINETUNE_MODELS = ["bert-base-uncased", "codebert-base", "microsoft/codebert-base"]
+
 class Bert(pl.LightningModule):
-    def __init__(self, num_classes: int, base_lr: float=5e-5, model_name: str='bert-base-uncased', use_sequence: bool=False, disablefinetune: bool=False, local_model: bool=False):
+    def __init__(self, num_classes: int, base_lr: float=5e-5, model_name: str='bert-base-uncased', use_sequence: bool=False, disablefinetune: bool=False, local_model: bool=False,
+                 trainable_layers: int=4, cache_frozen: bool=False, class_weights: list=None):
         super().__init__()
         self.class_num = num_classes
         self.base_lr = base_lr
@@ -49,6 +56,10 @@ class Bert(pl.LightningModule):
         self.use_sequence = use_sequence
         self.disablefinetune = disablefinetune
         self.local_model = local_model
+        # 决定从上往下要训练的层数量
+        self.trainable_layers = trainable_layers
+        # 使用缓存的冻结层输出训练时, embedding 也需要冻结
+        self.cache_frozen = cache_frozen
 
         print(f"current model is :{model_name}")
         print(f"current num_classes is :{num_classes}")
@@ -61,22 +72,22 @@ class Bert(pl.LightningModule):
 
         if not self.use_sequence:
             if not self.local_model:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(model_name)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], model_name)
             else:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(self.model_path)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], self.model_path)
         else:
             if self.local_model:
                 self.config = self.model_path + "/config.json"
                 # model_file = self.model_path + "/pytorch_model.bin"
                 # model_state_dict = torch.load(model_file)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, state_dict=model_state_dict, num_labels=num_classes, ignore_mismatched_sizes=True)
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, num_labels=num_classes, ignore_mismatched_sizes=True)
             else:
                 # ignore_mismatched_sizes will randomly generate the initial parameters for classifier
                 # after transformers version == 4.9.0
                 print(f"model_name:{model_name}")
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # code for transformers version == 4.5.1
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes)
             
@@ -101,7 +112,8 @@ class Bert(pl.LightningModule):
 
         self.fc = nn.Linear(self.hid_dim, self.class_num, bias=True)
         self.dropout = nn.Dropout(p=0.5)
-        self.loss = nn.CrossEntropyLoss()
+        # class_weights 为各类别的损失权重, 例如 [1.2, 1.2, 1.2, 1.0, 0.8], None 时权重相同
+        self.loss = nn.CrossEntropyLoss(weight=None if class_weights is None else torch.tensor(class_weights, dtype=torch.float))
         # self.class_weights = torch.tensor([1.2, 1.2, 1.2, 1.0, 0.8]) 
         # self.loss = FocalLoss(gamma=2.0, alpha=self.class_weights)
         # self.loss = FocalLoss(gamma=5.0)
@@ -121,25 +133,54 @@ class Bert(pl.LightningModule):
         # print(f'class_weights: {self.class_weights}')
 
 
-        self.metrics = nn.ModuleDict()
-        stage_name = ['train', 'valid', 'test']
-        for stage in stage_name:
-            for k in range(1, 3):
-                self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                self.metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
-                self.metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
-                # self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                # self.metrics[f"{stage}_precision_{k}"] = MultiLabelPrecision(top_k=k)
-                # self.metrics[f"{stage}_recall_{k}"] = MultiLabelRecall(top_k=k)
-                self.metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
-        
-        self.val_selected_f1_score = SelectedClassesF1Score(selected_classes=[0, 1, 2])
+        # 每个 stage 一个指标集合, 所有指标都由 top-1 / top-2 命中矩阵计算
+        # 验证集额外计算只关注前 3 个类别的 macro f1 (val_custom_marco_f1)
+        self.metrics = nn.ModuleDict({
+            f"{stage}_metrics": IssueClassificationMetrics(num_classes, stage, selected_classes=[0, 1, 2] if stage == 'valid' else None)
+            for stage in ['train', 'valid', 'test']
+        })
         self.save_hyperparameters()
 
+    def activation_cache_supported(self):
+        return self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS
+
+    def frozen_layers(self):
+        """
+        被冻结的底部 encoder 层数
+        """
+        return max(len(self.model.bert.encoder.layer) - self.trainable_layers, 0)
+
+    @torch.no_grad()
+    def frozen_forward(self, input_ids):
+        """
+        计算 embedding 和冻结的底部 encoder 层的输出, 用于构建激活缓存
+        """
+        bert = self.model.bert
+        attention_mask = input_ids['attention_mask']
+        extended_mask = bert.get_extended_attention_mask(attention_mask, attention_mask.shape)
+        hidden_states = bert.embeddings(input_ids=input_ids['input_ids'], token_type_ids=input_ids.get('token_type_ids'))
+        for layer in bert.encoder.layer[:self.frozen_layers()]:
+            hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+        return hidden_states
+
+    def cached_forward(self, inputs):
+        """
+        从缓存的冻结层输出开始, 只计算顶部的 encoder 层和分类层
+        """
+        bert = self.model.bert
+        attention_mask = inputs['attention_mask']
+        extended_mask = bert.get_extended_attention_mask(attention_mask, attention_mask.shape)
+        hidden_states = inputs['hidden_states'].to(self.model.dtype)
+        for layer in bert.encoder.layer[self.frozen_layers():]:
+            hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+        pooled_output = self.model.dropout(bert.pooler(hidden_states))
+        return self.model.classifier(pooled_output)
+
     def forward(self, input_ids):
         # in lightning, forward defines the prediction/inference actions
+        if 'hidden_states' in input_ids:
+            return self.cached_forward(input_ids)
+
         output = self.model(**input_ids)
         
         if not self.use_sequence:
@@ -166,20 +207,13 @@ class Bert(pl.LightningModule):
         # Logging to TensorBoard by default
         self.log('train_loss', loss)
         #
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['train_metrics'].step(logits, y))
 
         return loss
 
     def training_epoch_end(self, outputs):
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['train_metrics'].compute())
+        self.metrics['train_metrics'].reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
@@ -187,28 +221,16 @@ class Bert(pl.LightningModule):
         loss = self.loss(logits, y.float())
         self.log('val_loss', loss)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
-        
-        if self.val_selected_f1_score is not None:
-            probabilities = torch.nn.functional.softmax(logits, dim=-1)
-            self.val_selected_f1_score.update(probabilities, y)
+        self.log_dict(self.metrics['valid_metrics'].step(logits, y))
+        # 供 MySubClassPredictCallback 复用, 不再对验证集重复推理
+        return {'logits': logits.detach()}
     
     def validation_epoch_end(self, outs):
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
-        
-        if self.val_selected_f1_score is not None:
-            selected_f1 = self.val_selected_f1_score.compute()
-            self.log('val_custom_marco_f1', selected_f1)
-            # 重置指标的状态，为下一个 epoch 准备
-            self.val_selected_f1_score.reset()
+        metrics = dict(self.metrics['valid_metrics'].compute())
+        self.log('val_custom_marco_f1', metrics.pop('selected_f1'))
+        self.log_dict(metrics)
+        # 重置指标的状态，为下一个 epoch 准备
+        self.metrics['valid_metrics'].reset()
 
     # def test_step(self, batch, batch_idx):
     #     x, y = batch
@@ -252,39 +274,47 @@ class Bert(pl.LightningModule):
         x, y = batch
         logits = self.forward(x)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['test_metrics'].step(logits, y))
         # return {'loss': loss, 'pred': pred}
 
     def test_epoch_end(self, outs):
         # log epoch metric
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['test_metrics'].compute())
+        self.metrics['test_metrics'].reset()
+
+    def on_save_checkpoint(self, checkpoint):
+        # 只保存可训练的参数, 冻结的参数在加载时由预训练模型补齐
+        to_delta(self, checkpoint)
+
+    def on_load_checkpoint(self, checkpoint):
+        from_delta(self, checkpoint)
+
+    def freeze_layers(self):
+        """
+        部分微调时冻结底部的层, configure_optimizers 和 batch size 探测共用
+        """
+        if not (self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS):
+            return
+        # Bert模型总共分层数量
+        total_layers = len(self.model.bert.encoder.layer) # 例：BERT-base有12层
+        # 决定从上往下要训练的层数量
+        trainable_layers = self.trainable_layers
+        # tune emb
+        finetune_emb = not self.cache_frozen
+
+        # 冻结除了最后trainable_layers层之外的所有层
+        for i, layer in enumerate(self.model.bert.encoder.layer):
+            if i < total_layers - trainable_layers:
+                for param in layer.parameters():
+                    param.requires_grad = False
+        
+        for param in self.model.bert.embeddings.parameters():
+            param.requires_grad = finetune_emb
 
     def configure_optimizers(self):
 
-        if self.use_sequence and self.model_name in ["bert-base-uncased", "codebert-base", "microsoft/codebert-base"]:
-            # Bert模型总共分层数量
-            total_layers = len(self.model.bert.encoder.layer) # 例：BERT-base有12层
-            # 决定从上往下要训练的层数量
-            trainable_layers = 4
-            # tune emb
-            finetune_emb = True 
-
-            # 冻结除了最后trainable_layers层之外的所有层
-            for i, layer in enumerate(self.model.bert.encoder.layer):
-                if i < total_layers - trainable_layers:
-                    for param in layer.parameters():
-                        param.requires_grad = False
-            
-            for param in self.model.bert.embeddings.parameters():
-                param.requires_grad = finetune_emb
+        if self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS:
+            self.freeze_layers()
 
 
             # emb_params = list(self.model.bert.embeddings.parameters())
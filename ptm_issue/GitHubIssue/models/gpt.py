@@ -7,8 +7,11 @@ from torch.utils.data import DataLoader, random_split
 from transformers import GPT2ForSequenceClassification
 
 from ..metrics.accuracy import MultiLabelAccuracy
+from ..metrics.classification import IssueClassificationMetrics
 from ..metrics.precision import MultiLabelPrecision
 from ..metrics.recall import MultiLabelRecall
+from ..util.delta_ckpt import from_delta, to_delta
+from ..util.pretrained_cache import pretrained_model
 
 SEQUENCE_MODEL_CONFIG = {
     "gpt2": GPT2ForSequenceClassification, # https://huggingface.co/gpt2
@@ -20,8 +23,13 @@ SEQUENCE_MODEL_CONFIG = {
 }
 
 
+# configure_optimizers 中只微调顶部 decoder_layers_to_train 层的模型
+PARTIAL_FINETUNE_MODELS = ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl", "CodeGPT-small-py", "microsoft/CodeGPT-small-py"]
+
+
 class Gpt(pl.LightningModule):
-    def __init__(self, num_classes: int, base_lr: float=5e-5, model_name: str='gpt2', use_sequence: bool=False, disablefinetune: bool=False, local_model: bool=False):
+    def __init__(self, num_classes: int, base_lr: float=5e-5, model_name: str='gpt2', use_sequence: bool=False, disablefinetune: bool=False, local_model: bool=False,
+                 decoder_layers_to_train: int=4, cache_frozen: bool=False, class_weights: list=None):
         super().__init__()
         self.class_num = num_classes
         self.base_lr = base_lr
@@ -29,6 +37,10 @@ class Gpt(pl.LightningModule):
         self.use_sequence = use_sequence
         self.disablefinetune = disablefinetune
         self.local_model = local_model
+        # Modify to control finetune layer
+        self.decoder_layers_to_train = decoder_layers_to_train
+        # 使用缓存的冻结层输出训练时, embedding 也需要冻结
+        self.cache_frozen = cache_frozen
 
         print(f"current model is :{model_name}")
         print(f"current num_classes is :{num_classes}")
@@ -41,21 +53,21 @@ class Gpt(pl.LightningModule):
 
         if not self.use_sequence:
             if not self.local_model:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(model_name)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], model_name)
             else:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(self.model_path)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], self.model_path)
         else:
             if self.local_model:
                 self.config = self.model_path + "/config.json"
                 # model_state_dict = torch.load(model_file)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, state_dict=model_state_dict, num_labels=num_classes, ignore_mismatched_sizes=True)
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, num_labels=num_classes, ignore_mismatched_sizes=True)
             else:
                 # ignore_mismatched_sizes will randomly generate the initial parameters for classifier
                 # after transformers version == 4.9.0
                 print(f"model_name:{model_name}")
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # code for transformers version == 4.5.1
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes)
             # Fix AssertionError: Cannot handle batch sizes > 1 if no padding token is defined.
@@ -73,7 +85,8 @@ class Gpt(pl.LightningModule):
 
         self.hid_dim = self.model.config.hidden_size
         
-        self.loss = nn.CrossEntropyLoss()
+        # class_weights 为各类别的损失权重, 例如 [1.2, 1.2, 1.2, 1.0, 0.8], None 时权重相同
+        self.loss = nn.CrossEntropyLoss(weight=None if class_weights is None else torch.tensor(class_weights, dtype=torch.float))
         
         # self.class_weights = torch.tensor([1.2, 1.2, 1.2, 0.8, 0.8]).to("cuda:0") # 
         # self.class_weights = torch.tensor([1.5, 1.5, 1.5, 0.75, 0.75]).to("cuda:0") # 
@@ -89,21 +102,61 @@ class Gpt(pl.LightningModule):
         # self.loss = nn.CrossEntropyLoss(weight=self.class_weights)
 
 
-        self.metrics = nn.ModuleDict()
-        stage_name = ['train', 'valid', 'test']
-        for stage in stage_name:
-            for k in range(1, 3):
-                self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                self.metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
-                self.metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
-                self.metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
+        # 每个 stage 一个指标集合, 所有指标都由 top-1 / top-2 命中矩阵计算
+        self.metrics = nn.ModuleDict({
+            f"{stage}_metrics": IssueClassificationMetrics(num_classes, stage) for stage in ['train', 'valid', 'test']
+        })
         
         self.save_hyperparameters()
 
+    def activation_cache_supported(self):
+        return self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS
+
+    def frozen_layers(self):
+        """
+        被冻结的底部 decoder 层数
+        """
+        return max(len(self.model.transformer.h) - self.decoder_layers_to_train, 0)
+
+    def extended_attention_mask(self, attention_mask):
+        # 与 GPT2Model 中的处理一致
+        attention_mask = attention_mask[:, None, None, :].to(dtype=self.model.dtype)
+        return (1.0 - attention_mask) * torch.finfo(self.model.dtype).min
+
+    @torch.no_grad()
+    def frozen_forward(self, input_ids):
+        """
+        计算 embedding 和冻结的底部 decoder 层的输出, 用于构建激活缓存
+        """
+        transformer = self.model.transformer
+        ids = input_ids['input_ids']
+        position_ids = torch.arange(ids.size(1), dtype=torch.long, device=ids.device).unsqueeze(0)
+        hidden_states = transformer.drop(transformer.wte(ids) + transformer.wpe(position_ids))
+        extended_mask = self.extended_attention_mask(input_ids['attention_mask'])
+        for block in transformer.h[:self.frozen_layers()]:
+            hidden_states = block(hidden_states, attention_mask=extended_mask)[0]
+        return hidden_states
+
+    def cached_forward(self, inputs):
+        """
+        从缓存的冻结层输出开始, 只计算顶部的 decoder 层和分类层
+        """
+        transformer = self.model.transformer
+        attention_mask = inputs['attention_mask']
+        extended_mask = self.extended_attention_mask(attention_mask)
+        hidden_states = inputs['hidden_states'].to(self.model.dtype)
+        for block in transformer.h[self.frozen_layers():]:
+            hidden_states = block(hidden_states, attention_mask=extended_mask)[0]
+        logits = self.model.score(transformer.ln_f(hidden_states))
+        # 与 GPT2ForSequenceClassification 一致, 使用最后一个非 pad token 的输出 (右侧 padding)
+        sequence_lengths = attention_mask.sum(dim=1) - 1
+        return logits[torch.arange(logits.size(0), device=logits.device), sequence_lengths]
+
     def forward(self, input_ids):
         # in lightning, forward defines the prediction/inference actions
+        if 'hidden_states' in input_ids:
+            return self.cached_forward(input_ids)
+
         # with torch.no_grad():
         # output = self.model(input_ids)
         output = self.model(**input_ids)
@@ -133,20 +186,13 @@ class Gpt(pl.LightningModule):
         loss = self.loss(logits, y.float())
         # Logging to TensorBoard by default
         self.log('train_loss', loss)
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['train_metrics'].step(logits, y))
 
         return loss
 
     def training_epoch_end(self, outputs):
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['train_metrics'].compute())
+        self.metrics['train_metrics'].reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
@@ -154,72 +200,75 @@ class Gpt(pl.LightningModule):
         loss = self.loss(logits, y.float())
         self.log('val_loss', loss)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['valid_metrics'].step(logits, y))
+        # 供 MySubClassPredictCallback 复用, 不再对验证集重复推理
+        return {'logits': logits.detach()}
 
     def validation_epoch_end(self, outs):
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['valid_metrics'].compute())
+        self.metrics['valid_metrics'].reset()
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self.forward(x)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['test_metrics'].step(logits, y))
         # return {'loss': loss, 'pred': pred}
 
     def test_epoch_end(self, outs):
         # log epoch metric
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
-
-    def configure_optimizers(self):
+        self.log_dict(self.metrics['test_metrics'].compute())
+        self.metrics['test_metrics'].reset()
+
+    def on_save_checkpoint(self, checkpoint):
+        # 只保存可训练的参数, 冻结的参数在加载时由预训练模型补齐
+        to_delta(self, checkpoint)
+
+    def on_load_checkpoint(self, checkpoint):
+        from_delta(self, checkpoint)
+
+    def freeze_layers(self):
+        """
+        部分微调时冻结底部的层, configure_optimizers 和 batch size 探测共用
+        """
+        if not (self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS):
+            return
+        # Do not modify
+        num_decoder_layers = len(self.model.transformer.h)
+
+        # Modify to control finetune layer
+        decoder_layers_to_train = self.decoder_layers_to_train
+        finetune_emb = not self.cache_frozen
+        finetune_ln = True
+        finetune_cls = True
+
+        # 确保要微调的层数不超过实际层数
+        decoder_layers_to_train = min(decoder_layers_to_train, num_decoder_layers)
+
+        # 微调共享权重， 默认为True
+        for param in self.model.transformer.wte.parameters():
+            param.requires_grad = finetune_emb
+        for param in self.model.transformer.wpe.parameters():
+            param.requires_grad = finetune_emb
         
-        if self.use_sequence and self.model_name in ["gpt2", "gpt2-medium", "gpt2-large", "gpt2-xl", "CodeGPT-small-py", "microsoft/CodeGPT-small-py"]:
-            # Do not modify
-            num_decoder_layers = 12
-
-            # Modify to control finetune layer
-            decoder_layers_to_train = 4
-            finetune_emb = True
-            finetune_ln = True
-            finetune_cls = True
+        # 微调解码器的最后decoder_layers_to_train层
+        for i, layer in enumerate(self.model.transformer.h):
+            for param in layer.parameters():
+                param.requires_grad = i >= (num_decoder_layers - decoder_layers_to_train)
 
-            # 确保要微调的层数不超过实际层数
-            decoder_layers_to_train = min(decoder_layers_to_train, num_decoder_layers)
+        # 微调 layer norm 层 默认为True
+        for param in self.model.transformer.ln_f.parameters():
+            param.requires_grad = finetune_ln
 
-            # 微调共享权重， 默认为True
-            for param in self.model.transformer.wte.parameters():
-                param.requires_grad = finetune_emb
-            for param in self.model.transformer.wpe.parameters():
-                param.requires_grad = finetune_emb
-            
-            # 微调解码器的最后decoder_layers_to_train层
-            for i, layer in enumerate(self.model.transformer.h):
-                for param in layer.parameters():
-                    param.requires_grad = i >= (num_decoder_layers - decoder_layers_to_train)
+        # 微调分类层, 默认为True
+        for param in self.model.score.parameters():
+            param.requires_grad = finetune_cls
 
-            # 微调 layer norm 层 默认为True
-            for param in self.model.transformer.ln_f.parameters():
-                param.requires_grad = finetune_ln
+    def configure_optimizers(self):
+        
+        if self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS:
+            self.freeze_layers()
 
-            # 微调分类层, 默认为True
-            for param in self.model.score.parameters():
-                param.requires_grad = finetune_cls
-            
 
             emb_params = list(self.model.transformer.wte.parameters()) + list(self.model.transformer.wpe.parameters())
             decoder_trainable_params = list(filter(lambda p: p.requires_grad, self.model.transformer.h.parameters()))
@@ -0,0 +1,77 @@
+import itertools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from sklearn.metrics import f1_score
+
+from ..metrics.topk import topk_metrics
+
+
+# 与 Bert 的分类头相同的 dropout
+DROPOUT = 0.5
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+class LinearProbe(object):
+    """
+    在缓存的 pooled 向量上训练的分类头, 与 Bert --disablefinetune 相同: sigmoid(fc(dropout(pooler_output)))
+    """
+    def __init__(self, weight, bias, lr, weight_decay):
+        self.weight = weight
+        self.bias = bias
+        self.lr = lr
+        self.weight_decay = weight_decay
+
+    def logits(self, features):
+        return _sigmoid(features @ self.weight + self.bias)
+
+    def predict(self, features):
+        return self.logits(features).argmax(axis=1)
+
+
+def train_linear_probes(train_x, train_y, valid_x, valid_y, num_classes, lrs=(1e-3, 1e-2), weight_decays=(0.0, 1e-2),
+                        epochs=500, device='cpu', seed=42):
+    """
+    在整个特征矩阵上 (full batch) 同时训练所有超参数组合的分类头, 按验证集 macro f1 从高到低返回.
+    分类头, 初始化和损失 (sigmoid 输出上的 CrossEntropyLoss) 与 Bert --disablefinetune 相同,
+    但训练方式 (full batch, 学习率和 epoch 数) 不同, 分数与 train_cross.py --disablefinetune 的结果不能直接比较
+    """
+    torch.manual_seed(seed)
+    settings = list(itertools.product(lrs, weight_decays))
+
+    x = torch.as_tensor(train_x, dtype=torch.float32, device=device)
+    y = torch.as_tensor(train_y, dtype=torch.long, device=device)
+
+    heads = [nn.Linear(x.size(1), num_classes).to(device) for _ in settings]
+    optimizer = torch.optim.AdamW([
+        {'params': head.parameters(), 'lr': lr, 'weight_decay': weight_decay}
+        for (lr, weight_decay), head in zip(settings, heads)
+    ])
+
+    for epoch in range(epochs):
+        optimizer.zero_grad()
+        # (settings, C, H), 每组超参数使用独立的 dropout mask
+        weight = torch.stack([head.weight for head in heads])
+        bias = torch.stack([head.bias for head in heads])
+        features = F.dropout(x.expand(len(settings), -1, -1), p=DROPOUT, training=True)
+        logits = torch.sigmoid(torch.einsum('snh,sch->snc', features, weight) + bias[:, None, :])
+        # 各组超参数的 loss 相互独立, 求和后一次反向传播
+        loss = F.cross_entropy(logits.reshape(-1, num_classes), y.repeat(len(settings)), reduction='sum') / len(y)
+        loss.backward()
+        optimizer.step()
+
+    probes = []
+    for (lr, weight_decay), head in zip(settings, heads):
+        probe = LinearProbe(head.weight.detach().cpu().numpy().T, head.bias.detach().cpu().numpy(), lr, weight_decay)
+        probe.valid_f1 = f1_score(valid_y, probe.predict(valid_x), labels=list(range(num_classes)), average='macro')
+        probes.append(probe)
+    return sorted(probes, key=lambda p: p.valid_f1, reverse=True)
+
+
+def probe_metrics(probe, features, labels, num_classes, stage='test'):
+    return topk_metrics(probe.logits(features), labels, num_classes, stage)
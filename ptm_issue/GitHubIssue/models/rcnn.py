@@ -8,6 +8,7 @@ import pytorch_lightning as pl
 import torchmetrics
 
 from ..metrics.accuracy import MultiLabelAccuracy
+from ..metrics.classification import IssueClassificationMetrics
 from ..metrics.precision import MultiLabelPrecision
 from ..metrics.recall import MultiLabelRecall
 
@@ -59,25 +60,10 @@ class RCNN(pl.LightningModule):
         self.loss = nn.CrossEntropyLoss()
 
 
-        self.metrics = nn.ModuleDict()
-        stage_name = ['train', 'valid', 'test']
-        # for stage in stage_name:
-        #     for k in range(1, 6):
-        #         self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-        #         self.metrics[f"{stage}_precision_{k}"] = MultiLabelPrecision(top_k=k)
-        #         self.metrics[f"{stage}_recall_{k}"] = MultiLabelRecall(top_k=k)
-        
-        for stage in stage_name:
-            for k in range(1, 3):
-                self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                self.metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
-                self.metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
-                # self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                # self.metrics[f"{stage}_precision_{k}"] = MultiLabelPrecision(top_k=k)
-                # self.metrics[f"{stage}_recall_{k}"] = MultiLabelRecall(top_k=k)
-                self.metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
+        # 每个 stage 一个指标集合, 所有指标都由 top-1 / top-2 命中矩阵计算
+        self.metrics = nn.ModuleDict({
+            f"{stage}_metrics": IssueClassificationMetrics(num_classes, stage) for stage in ['train', 'valid', 'test']
+        })
 
     def forward(self, input_ids):
         # x.shape = (seq_len, batch_size)
@@ -97,7 +83,8 @@ class RCNN(pl.LightningModule):
         
         linear_output = linear_output.permute(0,2,1) # Reshaping fot max_pool
         
-        max_out_features = F.max_pool1d(linear_output, linear_output.shape[2]).squeeze(2)
+        # 全局最大池化, 与 F.max_pool1d(linear_output, linear_output.shape[2]) 等价, 导出 ONNX 时序列长度保持动态
+        max_out_features = linear_output.max(dim=2)[0]
         # max_out_features.shape = (batch_size, hidden_size_linear)
         
         max_out_features = self.dropout(max_out_features)
@@ -115,17 +102,12 @@ class RCNN(pl.LightningModule):
         self.log('train_loss', loss)
         print("loss: ", loss)
         
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['train_metrics'].step(logits, y))
         return loss
 
     def training_epoch_end(self, outputs):
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['train_metrics'].compute())
+        self.metrics['train_metrics'].reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
@@ -133,33 +115,25 @@ class RCNN(pl.LightningModule):
         loss = self.loss(logits, y.float())
         self.log('val_loss', loss)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['valid_metrics'].step(logits, y))
+        # 供 MySubClassPredictCallback 复用, 不再对验证集重复推理
+        return {'logits': logits.detach()}
 
     def validation_epoch_end(self, outs):
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['valid_metrics'].compute())
+        self.metrics['valid_metrics'].reset()
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self.forward(**x)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['test_metrics'].step(logits, y))
         # return {'loss': loss, 'pred': pred}
 
     def test_epoch_end(self, outs):
         # log epoch metric
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['test_metrics'].compute())
+        self.metrics['test_metrics'].reset()
 
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=0.01)
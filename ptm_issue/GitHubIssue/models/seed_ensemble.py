@@ -0,0 +1,301 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.nn.utils.rnn as rnn
+import tqdm
+from torch import nn
+
+from ..util.evaluation import EvaluationEngine
+from .bilstm import BiLSTM
+from .rcnn import RCNN
+from .textcnn import TextCNN
+
+# 可以按副本堆叠计算的模型
+STACKED_MODELS = (TextCNN, BiLSTM, RCNN)
+# 合并后的 LSTM 权重为块对角矩阵, 计算量是 N 个副本的 N 倍, 只在 GPU 上比逐个模型计算快
+CUDA_ONLY_MODELS = (BiLSTM, RCNN)
+
+MONITOR = 'valid_f1_marco_1_epoch'
+
+
+def stack_parameters(members):
+    """
+    各副本同名参数堆叠为 (N, ...) 的叶子张量, 参数名与单个模型的 state_dict 相同. LSTM 的参数由 fuse_lstms 合并
+    """
+    return {name: torch.stack([dict(m.named_parameters())[name].detach() for m in members]).requires_grad_()
+            for name, _ in members[0].named_parameters() if not name.startswith('lstm.')}
+
+
+def lstm_block(lstm, n, name, j):
+    """
+    合并后的 LSTM 参数 name 中第 j 个副本所在块的下标, bias 只有行
+    """
+    h = lstm.hidden_size // n
+    device = lstm.weight_ih_l0.device
+    arange = torch.arange(h, device=device)
+    # 每个门 (i, f, g, o) 的 N*H 行中, 第 j 个副本占 [j*H, (j+1)*H)
+    rows = torch.cat([g * n * h + j * h + arange for g in range(4)])
+    if name.startswith('bias'):
+        return rows
+    if name.startswith('weight_hh'):
+        cols = j * h + arange
+    elif name.startswith('weight_ih_l0'):
+        d = lstm.input_size // n
+        cols = j * d + torch.arange(d, device=device)
+    else:
+        # 上一层的输出为 [所有副本的正向, 所有副本的反向]
+        directions = 2 if lstm.bidirectional else 1
+        cols = torch.cat([k * n * h + j * h + arange for k in range(directions)])
+    return rows[:, None], cols[None, :]
+
+
+def fuse_lstms(lstms):
+    """
+    N 个结构相同的 nn.LSTM 合并为一个 input_size 和 hidden_size 都是 N 倍的 nn.LSTM, 一次 (cuDNN) 调用计算所有副本,
+    pack_padded_sequence 也可以直接使用. 权重按副本分块, 块以外的元素为 0, 各副本的门和隐状态互不影响.
+    返回合并后的 LSTM 和每个参数的块掩码, 优化器更新前梯度乘以掩码, 块以外的元素始终为 0
+    """
+    n, first = len(lstms), lstms[0]
+    fused = nn.LSTM(first.input_size * n, first.hidden_size * n, first.num_layers, bias=first.bias,
+                    batch_first=first.batch_first, dropout=first.dropout,
+                    bidirectional=first.bidirectional).to(first.weight_ih_l0.device)
+    masks = {}
+    with torch.no_grad():
+        for name, param in fused.named_parameters():
+            param.zero_()
+            mask = torch.zeros_like(param)
+            for j, lstm in enumerate(lstms):
+                index = lstm_block(fused, n, name, j)
+                param[index] = getattr(lstm, name)
+                mask[index] = 1
+            masks[name] = mask
+    return fused, masks
+
+
+def split_members(out, n, directions=2):
+    """
+    合并后的 LSTM 输出 (..., D*N*H) 拆成 (N, ..., D*H), 每个副本的正向和反向输出与单个 LSTM 的顺序相同
+    """
+    shape = out.shape[:-1]
+    h = out.shape[-1] // (directions * n)
+    out = out.view(*shape, directions, n, h).movedim(-2, 0)
+    return out.reshape(n, *shape, directions * h)
+
+
+def member_embeddings(params, input_ids):
+    """
+    按副本查表, 返回 (N, B, W, D) 的 embedding 和在特征维拼接后 (B, W, N*D) 的合并 LSTM 输入
+    """
+    embeddings = params['embeddings.weight']  # (N, V, D)
+    n, _, d = embeddings.shape
+    b, w = input_ids.shape
+    embedded = embeddings[:, input_ids]
+    return embedded, embedded.permute(1, 2, 0, 3).reshape(b, w, n * d)
+
+
+def stacked_textcnn_forward(params, input_ids, dropout=0.5, training=True):
+    """
+    N 个 TextCNN 副本一次 forward, 返回 (N, batch, C) 的 logits.
+    embedding 按副本查表后在通道维拼接, (K, D) 卷积等价于 D 个输入通道的一维卷积, 各副本的卷积合并为 groups=N 的分组卷积,
+    全连接层为批量矩阵乘. 只依赖 torch 1.11 已有的算子
+    """
+    embeddings = params['embeddings.weight']  # (N, V, D)
+    n, _, d = embeddings.shape
+    b, w = input_ids.shape
+    x = embeddings[:, input_ids].permute(1, 0, 3, 2).reshape(b, n * d, w)  # (B, N*D, W)
+    pooled = []
+    i = 0
+    while f'convs1.{i}.weight' in params:
+        weight = params[f'convs1.{i}.weight']  # (N, Co, 1, K, D)
+        co, k = weight.shape[1], weight.shape[3]
+        weight = weight.squeeze(2).permute(0, 1, 3, 2).reshape(n * co, d, k)  # (N*Co, D, K)
+        out = F.conv1d(x, weight, params[f'convs1.{i}.bias'].reshape(n * co), groups=n)  # (B, N*Co, W-K+1)
+        # 全局最大池化, 与 TextCNN.forward 相同
+        pooled.append(F.relu(out).max(dim=2)[0].view(b, n, co))
+        i += 1
+    x = torch.cat(pooled, 2).transpose(0, 1)  # (N, B, len(Ks)*Co)
+    x = F.dropout(x, dropout, training)
+    return torch.baddbmm(params['fc1.bias'].unsqueeze(1), x, params['fc1.weight'].transpose(1, 2))
+
+
+def stacked_bilstm_forward(params, lstm, input_ids):
+    """
+    N 个 BiLSTM 副本一次 forward, 返回 (N, batch, C) 的 logits. LSTM 由 fuse_lstms 合并, 全连接层为批量矩阵乘
+    """
+    n = params['fc.weight'].shape[0]
+    _, x = member_embeddings(params, input_ids)
+    input_lengths = (input_ids != 1).sum(dim=1)
+    packed_x = rnn.pack_padded_sequence(x, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+    out, _ = lstm(packed_x)
+    unpacked_out, _ = rnn.pad_packed_sequence(out, batch_first=True, padding_value=1)
+    # 与 BiLSTM.forward 相同, 取每个序列最后一个 token 位置的输出
+    last_out = unpacked_out[torch.arange(unpacked_out.size(0), device=input_ids.device), input_lengths - 1]
+    last_out = split_members(last_out, n)  # (N, B, 2*H)
+    return torch.baddbmm(params['fc.bias'].unsqueeze(1), last_out, params['fc.weight'].transpose(1, 2))
+
+
+def stacked_rcnn_forward(params, lstm, input_ids, dropout=0.5, training=True):
+    """
+    N 个 RCNN 副本一次 forward, 返回 (N, batch, C) 的 logits. LSTM 由 fuse_lstms 合并, 线性层为批量矩阵乘
+    """
+    n = params['fc.weight'].shape[0]
+    b, w = input_ids.shape
+    embedded, x = member_embeddings(params, input_ids)
+    lstm_out, _ = lstm(x)
+    input_features = torch.cat([split_members(lstm_out, n), embedded], 3)  # (N, B, W, 2*H+D)
+    linear_output = torch.tanh(torch.baddbmm(params['W.bias'].unsqueeze(1), input_features.reshape(n, b * w, -1),
+                                             params['W.weight'].transpose(1, 2)))
+    # 全局最大池化, 与 RCNN.forward 相同
+    max_out_features = linear_output.view(n, b, w, -1).max(dim=2)[0]
+    max_out_features = F.dropout(max_out_features, dropout, training)
+    return torch.baddbmm(params['fc.bias'].unsqueeze(1), max_out_features, params['fc.weight'].transpose(1, 2))
+
+
+class SeedEnsemble(object):
+    """
+    同一个模型的 N 个副本, 每个副本使用不同的随机种子初始化, 在同一个数据流上同步训练.
+
+    各副本的 loss 求和后一次反向传播, 梯度相互独立, 与单独训练 N 次等价 (只是 batch 顺序相同).
+    参数按副本堆叠, TextCNN 由分组卷积和批量矩阵乘一次计算所有副本的 forward 和 backward,
+    BiLSTM 和 RCNN 在 GPU 上把 LSTM 合并为一个按副本分块的 LSTM, 其他情况逐个模型计算.
+    每个副本像 ModelCheckpoint 一样保留验证集 macro f1 最高的 epoch 的参数
+    """
+    def __init__(self, build_model, seeds, device='cpu', vectorize=True):
+        self.seeds = list(seeds)
+        self.device = device
+        members = []
+        for seed in self.seeds:
+            torch.manual_seed(seed)
+            members.append(build_model().to(device))
+        self.loss = members[0].loss
+        # 优化器的类型和超参数与单个模型的 configure_optimizers 相同
+        template = members[0].configure_optimizers()
+        self.vectorized = vectorize and isinstance(members[0], STACKED_MODELS) and \
+            (torch.device(device).type == 'cuda' or not isinstance(members[0], CUDA_ONLY_MODELS))
+        if self.vectorized:
+            # (N, ...) 的堆叠参数, SGD / Adam 按元素更新, 堆叠后与逐个模型更新相同
+            self.params = stack_parameters(members)
+            self.model_type = type(members[0])
+            self.lstm, self.lstm_masks = fuse_lstms([m.lstm for m in members]) if hasattr(members[0], 'lstm') else (None, {})
+            self.dropout = members[0].dropout.p if isinstance(members[0], (TextCNN, RCNN)) else 0.0
+            self.training = True
+            parameters = list(self.params.values()) + ([] if self.lstm is None else list(self.lstm.parameters()))
+            self.optimizers = [type(template)(parameters, **template.defaults)]
+        else:
+            self.members = members
+            self.optimizers = [m.configure_optimizers() for m in members]
+        self.best_scores = [-1.0] * len(self.seeds)
+        self.best_states = [None] * len(self.seeds)
+        self.best_epochs = [None] * len(self.seeds)
+
+    def train(self, mode=True):
+        if self.vectorized:
+            self.training = mode
+            if self.lstm is not None:
+                self.lstm.train(mode)
+            return
+        for m in self.members:
+            m.train(mode)
+
+    def forward(self, input_ids):
+        """
+        返回 (N, batch, C) 的 logits
+        """
+        if not self.vectorized:
+            return torch.stack([m(input_ids=input_ids) for m in self.members])
+        if self.model_type is BiLSTM:
+            return stacked_bilstm_forward(self.params, self.lstm, input_ids)
+        if self.model_type is RCNN:
+            return stacked_rcnn_forward(self.params, self.lstm, input_ids, self.dropout, self.training)
+        return stacked_textcnn_forward(self.params, input_ids, self.dropout, self.training)
+
+    def training_step(self, inputs, target):
+        logits = self.forward(**inputs)
+        loss = sum(self.loss(logits[i], target.float()) for i in range(len(self.seeds)))
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+        loss.backward()
+        if self.vectorized:
+            # 合并 LSTM 块以外的梯度置零, 这些元素在优化器更新后仍为 0
+            for name, param in self.lstm_parameters():
+                param.grad.mul_(self.lstm_masks[name])
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss.item() / len(self.seeds)
+
+    def evaluate(self, loader, stage, all_labels):
+        """
+        对 loader 推理一次, 返回每个副本的 EvaluationEngine
+        """
+        engines = [EvaluationEngine(stage, all_labels) for _ in self.seeds]
+        self.train(False)
+        with torch.inference_mode():
+            for inputs, target in tqdm.tqdm(loader, desc=f"evaluate {stage}"):
+                logits = self.forward(**{k: v.to(self.device) for k, v in inputs.items()})
+                for engine, member_logits in zip(engines, logits):
+                    engine.add(member_logits, target)
+        self.train(True)
+        return engines
+
+    def member_state(self, i):
+        if self.vectorized:
+            state = {k: v[i] for k, v in self.params.items()}
+            for name, param in self.lstm_parameters():
+                state['lstm.' + name] = param[lstm_block(self.lstm, len(self.seeds), name, i)]
+        else:
+            state = self.members[i].state_dict()
+        return {k: v.detach().cpu().clone() for k, v in state.items()}
+
+    def load_member_state(self, i, state):
+        if self.vectorized:
+            with torch.no_grad():
+                for k, v in self.params.items():
+                    v[i].copy_(state[k])
+                for name, param in self.lstm_parameters():
+                    param[lstm_block(self.lstm, len(self.seeds), name, i)] = state['lstm.' + name].to(param.device)
+        else:
+            self.members[i].load_state_dict(state, strict=False)
+
+    def lstm_parameters(self):
+        """
+        合并 LSTM 的 (参数名, 参数), 没有 LSTM 时为空
+        """
+        return [] if self.lstm is None else list(self.lstm.named_parameters())
+
+    def update_best(self, engines, epoch):
+        for i, engine in enumerate(engines):
+            score = engine.metrics()[MONITOR]
+            # 与 ModelCheckpoint(mode='max') 相同, 只有严格更高时才更新
+            if score > self.best_scores[i]:
+                self.best_scores[i] = score
+                self.best_states[i] = self.member_state(i)
+                self.best_epochs[i] = epoch
+
+    def load_best(self):
+        for i, state in enumerate(self.best_states):
+            if state is not None:
+                self.load_member_state(i, state)
+
+    def fit(self, train_loader, valid_loader, all_labels, max_epochs=30):
+        self.train(True)
+        for epoch in range(max_epochs):
+            losses = []
+            for inputs, target in tqdm.tqdm(train_loader, desc=f"epoch {epoch}"):
+                losses.append(self.training_step({k: v.to(self.device) for k, v in inputs.items()},
+                                                 target.to(self.device)))
+            engines = self.evaluate(valid_loader, 'valid', all_labels)
+            self.update_best(engines, epoch)
+            scores = [engine.metrics()[MONITOR] for engine in engines]
+            print(f"epoch {epoch}: train_loss {np.mean(losses):.4f}, {MONITOR} "
+                  f"{np.mean(scores):.4f} ± {np.std(scores):.4f} over {len(self.seeds)} seeds")
+        self.load_best()
+        return self
+
+
+def aggregate_metrics(metrics):
+    """
+    各种子的指标的均值和标准差
+    """
+    keys = list(metrics[0].keys())
+    return {'mean': {k: float(np.mean([m[k] for m in metrics])) for k in keys},
+            'std': {k: float(np.std([m[k] for m in metrics])) for k in keys}}
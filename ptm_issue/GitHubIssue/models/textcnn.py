@@ -8,6 +8,7 @@ import torchmetrics
 import torch
 
 from ..metrics.accuracy import MultiLabelAccuracy
+from ..metrics.classification import IssueClassificationMetrics
 from ..metrics.precision import MultiLabelPrecision
 from ..metrics.recall import MultiLabelRecall
 
@@ -35,30 +36,14 @@ class TextCNN(pl.LightningModule):
         # self.loss = nn.BCELoss()
         self.loss = nn.CrossEntropyLoss()
 
-        self.metrics = nn.ModuleDict()
-        stage_name = ['train', 'valid', 'test']
-        # for stage in stage_name:
-        #     for k in range(1, 6):
-        #         self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-        #         self.metrics[f"{stage}_precision_{k}"] = MultiLabelPrecision(top_k=k)
-        #         self.metrics[f"{stage}_recall_{k}"] = MultiLabelRecall(top_k=k)
-                # self.metrics[f"{stage}_f1_{k}"] = torchmetrics.F1(average=avg, num_classes=num_classes, top_k=k)
-
-        for stage in stage_name:
-            for k in range(1, 3):
-                self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                self.metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
-                self.metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
-                # self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                # self.metrics[f"{stage}_precision_{k}"] = MultiLabelPrecision(top_k=k)
-                # self.metrics[f"{stage}_recall_{k}"] = MultiLabelRecall(top_k=k)
-                self.metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
+        # 每个 stage 一个指标集合, 所有指标都由 top-1 / top-2 命中矩阵计算
+        self.metrics = nn.ModuleDict({
+            f"{stage}_metrics": IssueClassificationMetrics(num_classes, stage) for stage in ['train', 'valid', 'test']
+        })
 
     def conv_and_pool(self, x, conv):
         x = F.relu(conv(x)).squeeze(3)  # (N, Co, W)
-        x = F.max_pool1d(x, x.size(2)).squeeze(2)
+        x = x.max(dim=2)[0]
         return x
 
     def forward(self, input_ids):
@@ -69,7 +54,8 @@ class TextCNN(pl.LightningModule):
 
         x = [F.relu(conv(x)).squeeze(3) for conv in self.convs1]  # [(N, Co, W), ...]*len(Ks)
 
-        x = [F.max_pool1d(i, i.size(2)).squeeze(2) for i in x]  # [(N, Co), ...]*len(Ks)
+        # 全局最大池化, 与 F.max_pool1d(i, i.size(2)) 等价, 导出 ONNX 时序列长度保持动态
+        x = [i.max(dim=2)[0] for i in x]  # [(N, Co), ...]*len(Ks)
 
         x = torch.cat(x, 1)
 
@@ -94,17 +80,12 @@ class TextCNN(pl.LightningModule):
         # Logging to TensorBoard by default
         self.log('train_loss', loss)
         
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['train_metrics'].step(logits, y))
         return loss
 
     def training_epoch_end(self, outputs):
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['train_metrics'].compute())
+        self.metrics['train_metrics'].reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
@@ -112,33 +93,25 @@ class TextCNN(pl.LightningModule):
         loss = self.loss(logits, y.float())
         self.log('val_loss', loss)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['valid_metrics'].step(logits, y))
+        # 供 MySubClassPredictCallback 复用, 不再对验证集重复推理
+        return {'logits': logits.detach()}
 
     def validation_epoch_end(self, outs):
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['valid_metrics'].compute())
+        self.metrics['valid_metrics'].reset()
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self.forward(**x)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                # self.log(f"{name}_step", metric(logits, y))
-                self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['test_metrics'].step(logits, y))
         # return {'loss': loss, 'pred': pred}
 
     def test_epoch_end(self, outs):
         # log epoch metric
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['test_metrics'].compute())
+        self.metrics['test_metrics'].reset()
 
     def configure_optimizers(self):
         # optimizer = torch.optim.SGD(self.parameters(), lr=0.1)
@@ -7,8 +7,11 @@ from torch.utils.data import DataLoader, random_split
 from transformers import T5ForSequenceClassification, T5Tokenizer
 
 from ..metrics.accuracy import MultiLabelAccuracy
+from ..metrics.classification import IssueClassificationMetrics
 from ..metrics.precision import MultiLabelPrecision
 from ..metrics.recall import MultiLabelRecall
+from ..util.delta_ckpt import from_delta, to_delta
+from ..util.pretrained_cache import pretrained_model
 
 MODEL_CONFIG = {
 }
@@ -20,6 +23,8 @@ SEQUENCE_MODEL_CONFIG = {
     "codet5-base": T5ForSequenceClassification,
 }
 
+PARTIAL_FINETUNE_MODELS = ["t5-base", "t5-large", "codet5-base", "Salesforce/codet5-base"]
+
 class Transformer(pl.LightningModule):
     def __init__(self, num_classes: int, base_lr: float=5e-5,  model_name: str='t5-base', use_sequence: bool=False, disablefinetune: bool=False, local_model: bool=False):
         super().__init__()
@@ -41,21 +46,21 @@ class Transformer(pl.LightningModule):
 
         if not self.use_sequence:
             if not self.local_model:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(model_name)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], model_name)
             else:
-                self.model = MODEL_CONFIG[model_name].from_pretrained(self.model_path)
+                self.model = pretrained_model(MODEL_CONFIG[model_name], self.model_path)
         else:
             if self.local_model:
                 self.config = self.model_path + "/config.json"
                 # model_state_dict = torch.load(model_file)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, state_dict=model_state_dict, num_labels=num_classes, ignore_mismatched_sizes=True)
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], self.model_path, config=self.config, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(self.model_path, num_labels=num_classes, ignore_mismatched_sizes=True)
             else:
                 # ignore_mismatched_sizes will randomly generate the initial parameters for classifier
                 # after transformers version == 4.9.0
                 print(f"model_name:{model_name}")
-                self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
+                self.model = pretrained_model(SEQUENCE_MODEL_CONFIG[model_name], model_name, num_labels=num_classes, ignore_mismatched_sizes=True)
                 # code for transformers version == 4.5.1
                 # self.model = SEQUENCE_MODEL_CONFIG[model_name].from_pretrained(model_name, num_labels=num_classes)
             
@@ -97,16 +102,10 @@ class Transformer(pl.LightningModule):
         # print(f'class_weights: {self.class_weights}')
 
 
-        self.metrics = nn.ModuleDict()
-        stage_name = ['train', 'valid', 'test']
-        for stage in stage_name:
-            for k in range(1, 3):
-                self.metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
-                self.metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
-                self.metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
-                self.metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
-                self.metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
+        # 每个 stage 一个指标集合, 所有指标都由 top-1 / top-2 命中矩阵计算
+        self.metrics = nn.ModuleDict({
+            f"{stage}_metrics": IssueClassificationMetrics(num_classes, stage) for stage in ['train', 'valid', 'test']
+        })
         
         self.save_hyperparameters()
 
@@ -141,20 +140,13 @@ class Transformer(pl.LightningModule):
         # Logging to TensorBoard by default
         self.log('train_loss', loss)
         #
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['train_metrics'].step(logits, y))
 
         return loss
 
     def training_epoch_end(self, outputs):
-        for name, metric in self.metrics.items():
-            if name.startswith('train_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['train_metrics'].compute())
+        self.metrics['train_metrics'].reset()
 
     def validation_step(self, batch, batch_idx):
         x, y = batch
@@ -162,75 +154,74 @@ class Transformer(pl.LightningModule):
         loss = self.loss(logits, y.float())
         self.log('val_loss', loss)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['valid_metrics'].step(logits, y))
+        # 供 MySubClassPredictCallback 复用, 不再对验证集重复推理
+        return {'logits': logits.detach()}
 
     def validation_epoch_end(self, outs):
-        for name, metric in self.metrics.items():
-            if name.startswith('valid_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['valid_metrics'].compute())
+        self.metrics['valid_metrics'].reset()
 
     def test_step(self, batch, batch_idx):
         x, y = batch
         logits = self.forward(x)
 
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                if not self.use_sequence:
-                    self.log(f"{name}_step", metric(logits, y))
-                else:
-                    self.log(f"{name}_step", metric(torch.nn.functional.softmax(logits, dim=-1), y))
+        self.log_dict(self.metrics['test_metrics'].step(logits, y))
         # return {'loss': loss, 'pred': pred}
 
     def test_epoch_end(self, outs):
         # log epoch metric
-        for name, metric in self.metrics.items():
-            if name.startswith('test_'):
-                self.log(f"{name}_epoch", metric.compute())
-                metric.reset()
+        self.log_dict(self.metrics['test_metrics'].compute())
+        self.metrics['test_metrics'].reset()
 
-    def configure_optimizers(self):        
-        if self.use_sequence and self.model_name in ["t5-base", "t5-large", "codet5-base", "Salesforce/codet5-base"]:
-            # Do not modify
-            num_encoder_layers = 12
-            num_decoder_layers = 12
-
-            # Modify to control finetune layer
-            encoder_layers_to_train = 4
-            decoder_layers_to_train = 0
-            finetune_shared = True
-            finetune_cls = True
-
-            # 获取编码器和解码器的所有层
-            encoder_layers = self.model.transformer.encoder
-            decoder_layers = self.model.transformer.decoder
-            
-            # 确保要微调的层数不超过实际层数
-            encoder_layers_to_train = min(encoder_layers_to_train, num_encoder_layers)
-            decoder_layers_to_train = min(decoder_layers_to_train, num_decoder_layers)
+    def on_save_checkpoint(self, checkpoint):
+        # 只保存可训练的参数, 冻结的参数在加载时由预训练模型补齐
+        to_delta(self, checkpoint)
 
-            # 微调共享权重， 默认为 True
-            for param in self.model.transformer.shared.parameters():
-                param.requires_grad = finetune_shared
-            
-            # 微调编码器的最后encoder_layers_to_train层
-            for i, layer in enumerate(self.model.transformer.encoder.block):
-                for param in layer.parameters():
-                    param.requires_grad = i >= (num_encoder_layers - encoder_layers_to_train)
-                    
-            # 微调解码器的最后decoder_layers_to_train层
-            for i, layer in enumerate(self.model.transformer.decoder.block):
-                for param in layer.parameters():
-                    param.requires_grad = i >= (num_decoder_layers - decoder_layers_to_train)
-
-            # 微调分类层, 默认为 True
-            for param in self.model.classification_head.dense.parameters():
-                param.requires_grad = finetune_cls
+    def on_load_checkpoint(self, checkpoint):
+        from_delta(self, checkpoint)
+
+    def freeze_layers(self):
+        """
+        部分微调时冻结底部的层, configure_optimizers 和 batch size 探测共用
+        """
+        if not (self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS):
+            return
+        # Do not modify
+        num_encoder_layers = 12
+        num_decoder_layers = 12
+
+        # Modify to control finetune layer
+        encoder_layers_to_train = 4
+        decoder_layers_to_train = 0
+        finetune_shared = True
+        finetune_cls = True
+
+        # 确保要微调的层数不超过实际层数
+        encoder_layers_to_train = min(encoder_layers_to_train, num_encoder_layers)
+        decoder_layers_to_train = min(decoder_layers_to_train, num_decoder_layers)
+
+        # 微调共享权重， 默认为 True
+        for param in self.model.transformer.shared.parameters():
+            param.requires_grad = finetune_shared
+        
+        # 微调编码器的最后encoder_layers_to_train层
+        for i, layer in enumerate(self.model.transformer.encoder.block):
+            for param in layer.parameters():
+                param.requires_grad = i >= (num_encoder_layers - encoder_layers_to_train)
+                
+        # 微调解码器的最后decoder_layers_to_train层
+        for i, layer in enumerate(self.model.transformer.decoder.block):
+            for param in layer.parameters():
+                param.requires_grad = i >= (num_decoder_layers - decoder_layers_to_train)
+
+        # 微调分类层, 默认为 True
+        for param in self.model.classification_head.dense.parameters():
+            param.requires_grad = finetune_cls
+
+    def configure_optimizers(self):        
+        if self.use_sequence and self.model_name in PARTIAL_FINETUNE_MODELS:
+            self.freeze_layers()
 
             emb_params = list(self.model.transformer.shared.parameters())
             # encoder_trainable_params = []
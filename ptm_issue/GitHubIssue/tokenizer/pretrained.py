@@ -0,0 +1,42 @@
+from transformers import (AlbertTokenizer, AutoTokenizer, BertTokenizer,
+                          GPT2Tokenizer, RobertaTokenizer, T5Tokenizer,
+                          XLNetTokenizer)
+
+from ..util.pretrained_cache import pretrained_tokenizer
+
+# 与训练脚本中的 TOKENIZER_CONFIG 保持一致
+TOKENIZER_CONFIG = {
+    "bert-base-uncased": BertTokenizer,
+    "xlnet-base-cased": XLNetTokenizer,
+    "albert-base-v2":  AlbertTokenizer,
+    "roberta-base": RobertaTokenizer,
+    "microsoft/codebert-base": RobertaTokenizer,
+    "codebert-base": RobertaTokenizer,
+    "jeniya/BERTOverflow": AutoTokenizer,
+    "BERTOverflow": AutoTokenizer,
+    "huggingface/CodeBERTa-language-id": RobertaTokenizer,
+    "seBERT": BertTokenizer,
+    "t5-base": T5Tokenizer,
+    "t5-large": T5Tokenizer,
+    "Salesforce/codet5-base": RobertaTokenizer,
+    "codet5-base": RobertaTokenizer,
+    "gpt2": GPT2Tokenizer,
+    "microsoft/CodeGPT-small-py": GPT2Tokenizer,
+    "CodeGPT-small-py": GPT2Tokenizer
+}
+
+GPT_TOKENIZERS = ["gpt2", "microsoft/CodeGPT-small-py", "CodeGPT-small-py"]
+
+
+def load_tokenizer(model_name, local_model=False):
+    """
+    按训练脚本中的方式加载预训练模型的 tokenizer, 本地模型使用路径的最后一级作为模型名称
+    """
+    if local_model:
+        tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name.split('/')[-1]], model_name, do_lower_case=True)
+    else:
+        tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], model_name)
+    if model_name.split('/')[-1] in GPT_TOKENIZERS or model_name in GPT_TOKENIZERS:
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = 'right'
+    return tokenizer
@@ -0,0 +1,153 @@
+import os
+import queue
+import threading
+
+import torch
+from pytorch_lightning.callbacks import ModelCheckpoint
+
+
+def cpu_snapshot(obj):
+    """
+    复制 checkpoint 中的所有 tensor 到 CPU, 之后的训练不会修改快照
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(checkpoint, filepath):
+    """
+    先写临时文件再重命名, 进程中断时不会留下写了一半的 checkpoint
+    """
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    tmp_path = f"{filepath}.tmp-{os.getpid()}"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, filepath)
+
+
+class CheckpointWriter(object):
+    """
+    后台线程按提交顺序写入和删除 checkpoint, 同一个文件还没有写入的旧快照直接跳过
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # filepath -> 最新提交的快照的序号
+        self.latest = {}
+        self.seq = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, filepath, checkpoint):
+        with self.lock:
+            self.seq += 1
+            self.latest[filepath] = self.seq
+            self.queue.put(('save', filepath, checkpoint, self.seq))
+
+    def delete(self, filepath):
+        with self.lock:
+            self.seq += 1
+            self.latest[filepath] = self.seq
+            self.queue.put(('delete', filepath, None, self.seq))
+
+    def _run(self):
+        while True:
+            op, filepath, checkpoint, seq = self.queue.get()
+            try:
+                if op == 'stop':
+                    return
+                with self.lock:
+                    stale = self.latest.get(filepath) != seq
+                if stale:
+                    continue
+                if op == 'save':
+                    atomic_save(checkpoint, filepath)
+                elif os.path.exists(filepath):
+                    os.remove(filepath)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        等待已经提交的写入和删除完成, 后台写入失败时在这里抛出
+        """
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.flush()
+        self.queue.put(('stop', None, None, None))
+        self.thread.join()
+
+
+class AsyncModelCheckpoint(ModelCheckpoint):
+    """
+    与 ModelCheckpoint 相同的保存策略, 但保存时只在训练线程中把 checkpoint 复制到内存, 由后台线程序列化到磁盘.
+    最近一次保存的快照保留在内存中, 训练结束后加载最优模型时不需要从磁盘读取
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = None
+        self.snapshots = {}
+
+    def _save_model(self, trainer, filepath):
+        if not trainer.is_global_zero:
+            return
+        if self.writer is None:
+            self.writer = CheckpointWriter()
+        checkpoint = cpu_snapshot(trainer.checkpoint_connector.dump_checkpoint(self.save_weights_only))
+        self.snapshots[filepath] = checkpoint
+        self.writer.submit(filepath, checkpoint)
+
+    def file_exists(self, filepath, trainer):
+        # 还在后台写入的 checkpoint 视为已经存在
+        return filepath in self.snapshots or super().file_exists(filepath, trainer)
+
+    def _del_model(self, *args):
+        # Lightning 不同版本的参数为 (filepath) 或 (trainer, filepath)
+        filepath = args[-1]
+        self.snapshots.pop(filepath, None)
+        if self.writer is None:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return
+        self.writer.delete(filepath)
+
+    def snapshot(self, filepath):
+        """
+        filepath 对应的内存快照, 不存在时返回 None. 返回浅拷贝, 调用方替换其中的 state_dict 不影响后台写入
+        """
+        checkpoint = self.snapshots.get(filepath)
+        return dict(checkpoint) if checkpoint is not None else None
+
+    def load(self, filepath, map_location=None):
+        """
+        优先使用内存快照, 否则从磁盘读取
+        """
+        checkpoint = self.snapshot(filepath)
+        if checkpoint is not None:
+            return checkpoint
+        self.flush()
+        return torch.load(filepath, map_location=map_location)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """
+        等待所有 checkpoint 写入磁盘, 进程退出前必须调用
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.snapshots = {}
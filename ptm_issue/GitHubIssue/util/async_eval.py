@@ -0,0 +1,161 @@
+import io
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from pytorch_lightning import Callback
+from pytorch_lightning.loggers import TensorBoardLogger
+from torch.utils.data import DataLoader
+
+from GitHubIssue.metrics.log_metrics import log_metrics
+from GitHubIssue.util.evaluation import EvaluationEngine
+from GitHubIssue.util.my_callback import _sanity_checking
+
+CUSTOM_CLASSES = ["Error", "Performance", "deployment"]
+
+
+class _WriterLogger(object):
+    """
+    log_metrics 需要 logger.experiment, worker 中直接使用 SummaryWriter
+    """
+    def __init__(self, writer):
+        self.experiment = writer
+
+
+def _evaluation_worker(model_bytes, stage, all_labels, dataset, collate_fn, batch_size, device, num_threads, log_dir, tasks):
+    """
+    在独立进程中对 stage 的数据集打分, 每次从队列中取出最新的可训练参数快照
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    from torch.utils.tensorboard import SummaryWriter
+
+    model = torch.load(io.BytesIO(model_bytes), map_location='cpu').to(device)
+    del model_bytes
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    engine = EvaluationEngine(stage, all_labels)
+    writer = SummaryWriter(log_dir) if log_dir is not None else None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, global_step, weights = task
+        model.load_state_dict(weights, strict=False)
+        engine.run(model, loader, desc=f"async evaluate {stage} epoch {epoch}")
+        report = engine.report()
+        print(f"======== stage: {stage} sub class metric (epoch {epoch}) ============")
+        print(report)
+        if writer is None:
+            continue
+        log_metrics(_WriterLogger(writer), report, stage + " ", global_step=global_step)
+        for name, value in engine.metrics().items():
+            writer.add_scalar(f"async_{name}", value, global_step=global_step)
+        f1 = [float(report[c]['f1-score']) for c in CUSTOM_CLASSES if c in report]
+        if sum(f1) != 0:
+            writer.add_scalar(f'{stage}_custom_marco_f1', sum(f1) / len(f1), global_step=global_step)
+        writer.flush()
+    if writer is not None:
+        writer.close()
+
+
+class AsyncEvaluationCallback(Callback):
+    """
+    MySubClassPredictCallback 的异步版本: 训练进程只把可训练参数的快照放入队列, 推理和 TensorBoard 记录由独立的 worker 进程完成.
+    队列只保留最新的快照, worker 跟不上时跳过过期的 epoch, 训练速度不再受测试集大小影响
+
+    every_n_epochs: 每 N 个 epoch 评估一次
+    monitor: 不为 None 时只在该指标变好时评估, 例如 valid_f1_marco_1_epoch
+    """
+    def __init__(self, stage, model, all_labels, dataset, collate_fn, batch_size=8, device='cpu', num_threads=0,
+                 every_n_epochs=1, monitor=None, mode='max'):
+        super().__init__()
+        self.stage = stage
+        self.all_labels = list(all_labels)
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.batch_size = batch_size
+        self.device = device
+        self.num_threads = num_threads
+        self.every_n_epochs = every_n_epochs
+        self.monitor = monitor
+        self.mode = mode
+        self.best = None
+        self.last_epoch = -1
+        # 模型在 trainer.fit 之前序列化, 此时还没有关联 trainer, 参数也还在 CPU 上
+        buffer = io.BytesIO()
+        torch.save(model, buffer)
+        self.model_bytes = buffer.getvalue()
+        self.process = None
+        self.tasks = None
+
+    def on_fit_start(self, trainer, pl_module):
+        log_dir = None
+        if isinstance(trainer.logger, TensorBoardLogger):
+            log_dir = trainer.logger.experiment.get_logdir()
+        ctx = mp.get_context('spawn')
+        self.tasks = ctx.Queue(maxsize=1)
+        self.process = ctx.Process(
+            target=_evaluation_worker,
+            args=(self.model_bytes, self.stage, self.all_labels, self.dataset, self.collate_fn, self.batch_size,
+                  self.device, self.num_threads, log_dir, self.tasks),
+            daemon=True,
+        )
+        self.process.start()
+        self.model_bytes = None
+
+    def should_evaluate(self, trainer):
+        epoch = trainer.current_epoch
+        if epoch == self.last_epoch or (epoch + 1) % self.every_n_epochs != 0:
+            return False
+        if self.monitor is None:
+            return True
+        current = trainer.callback_metrics.get(self.monitor)
+        if current is None:
+            return False
+        current = float(current)
+        if self.best is not None and (current <= self.best if self.mode == 'max' else current >= self.best):
+            return False
+        self.best = current
+        return True
+
+    def on_validation_end(self, trainer, pl_module):
+        if self.process is None or _sanity_checking(trainer) or not self.should_evaluate(trainer):
+            return
+        self.last_epoch = trainer.current_epoch
+        # 冻结的参数不会变化, 只需要发送可训练参数
+        weights = {name: param.detach().to('cpu', copy=True)
+                   for name, param in pl_module.named_parameters() if param.requires_grad}
+        self.submit((trainer.current_epoch, trainer.global_step, weights))
+
+    def submit(self, task):
+        try:
+            self.tasks.put_nowait(task)
+        except queue.Full:
+            # 丢弃还没有被 worker 取走的旧快照
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                pass
+            self.tasks.put(task)
+
+    def on_fit_end(self, trainer, pl_module):
+        self.close()
+
+    def close(self, timeout=None):
+        """
+        等待 worker 完成最后一次评估后退出. worker 已经退出 (例如 OOM) 时队列中的快照不会再被取走, 不能阻塞等待
+        """
+        if self.process is None:
+            return
+        while self.process.is_alive():
+            try:
+                self.tasks.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        # 没有被取走的快照不再写入管道, 避免退出时等待队列的后台线程
+        self.tasks.cancel_join_thread()
+        self.process = None
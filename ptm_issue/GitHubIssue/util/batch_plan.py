@@ -0,0 +1,233 @@
+import json
+import math
+import os
+import socket
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import PreTrainedModel
+
+from GitHubIssue.util.device import torch_device
+
+PLAN_FILE = './cache/batch_plan.json'
+# 探测时序列长度按 64 向上取整, 长度相近的数据集共用一个计划
+LENGTH_STEP = 64
+MAX_LENGTH = 512
+
+
+def _hf_model(model):
+    hf = getattr(model, 'model', None)
+    return hf if isinstance(hf, PreTrainedModel) else None
+
+
+def supports_gradient_checkpointing(model):
+    hf = _hf_model(model)
+    return hf is not None and getattr(hf, 'supports_gradient_checkpointing', False)
+
+
+def set_gradient_checkpointing(model, enable=True):
+    hf = _hf_model(model)
+    if enable:
+        hf.gradient_checkpointing_enable()
+        # 底部的层被冻结时, checkpoint 的输入也需要梯度, 否则顶部的层收不到梯度
+        hf.enable_input_require_grads()
+    else:
+        hf.gradient_checkpointing_disable()
+        hf.disable_input_require_grads()
+
+
+def _meminfo(name):
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            if line.startswith(name + ':'):
+                return int(line.split()[1]) * 1024
+    raise Exception(f"{name} not found in /proc/meminfo")
+
+
+def _status(name):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(name + ':'):
+                return int(line.split()[1]) * 1024
+    raise Exception(f"{name} not found in /proc/self/status")
+
+
+def host_key(device):
+    """
+    计划按 (模型, 机器) 缓存, 机器由主机名, 设备型号和总内存确定
+    """
+    if device >= 0:
+        props = torch.cuda.get_device_properties(device)
+        return f"{socket.gethostname()}/{props.name}/{props.total_memory // 2 ** 20}MB"
+    return f"{socket.gethostname()}/cpu/{_meminfo('MemTotal') // 2 ** 20}MB"
+
+
+def probe_length(lengths):
+    """
+    长度分桶后最长的 batch 决定显存峰值, 按数据集中最长的样本探测
+    """
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0 or lengths.max() == 0:
+        # lazy / 流式数据集的长度未知
+        return MAX_LENGTH
+    return min(MAX_LENGTH, int(math.ceil(lengths.max() / LENGTH_STEP) * LENGTH_STEP))
+
+
+class MemoryProbe(object):
+    """
+    在真实的样本上执行一次完整的训练 step (forward, backward, optimizer), 测量内存峰值是否在预算内
+    GPU 使用 max_memory_allocated, CPU 使用进程的 VmHWM
+    """
+    def __init__(self, model, dataset, collate_fn, device, length, memory_fraction=0.9):
+        self.model = model
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.device = torch.device(torch_device(device))
+        self.length = length
+        # 最长的样本排在前面
+        self.order = np.argsort(-np.asarray(dataset.lengths), kind='stable')
+        if self.device.type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(self.device)
+            self.base = torch.cuda.memory_allocated(self.device)
+            self.budget = int(free * memory_fraction)
+        else:
+            # 释放的内存不一定归还给系统, 以探测开始时的 RSS 为基准
+            self.base = _status('VmRSS')
+            self.budget = int(_meminfo('MemAvailable') * memory_fraction)
+
+    def batch(self, batch_size):
+        index = [int(self.order[i % len(self.order)]) for i in range(batch_size)]
+        inputs, labels = self.collate_fn([self.dataset[i] for i in index])
+        # pad 到探测长度, attention 的计算量和 mask 无关
+        inputs = {k: F.pad(v, (0, self.length - v.size(1))) if v.dim() == 2 and v.size(1) < self.length else v
+                  for k, v in inputs.items()}
+        return {k: v.to(self.device) for k, v in inputs.items()}, labels.to(self.device)
+
+    def _reset_peak(self):
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        # 写入 5 把 VmHWM 重置为当前的 RSS
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+    def _peak(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) - self.base
+        return _status('VmHWM') - self.base
+
+    def fits(self, batch_size):
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        # 学习率为 0, 只分配优化器状态, 不修改参数
+        optimizer = torch.optim.AdamW(params, lr=0.0)
+        inputs, labels = self.batch(batch_size)
+        self._reset_peak()
+        try:
+            logits = self.model(inputs)
+            loss = self.model.loss(logits.float(), labels.float())
+            loss.backward()
+            optimizer.step()
+            peak = self._peak()
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            peak = None
+        finally:
+            optimizer.zero_grad(set_to_none=True)
+            del optimizer
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+        fits = peak is not None and peak <= self.budget
+        print(f"probe batch size {batch_size} x {self.length}: "
+              f"{'oom' if peak is None else f'{peak / 2 ** 20:.0f}MB'} / {self.budget / 2 ** 20:.0f}MB")
+        return fits
+
+    def largest(self, max_batch_size):
+        """
+        按 2 的幂次增大 batch size, 再在最后一次成功和失败之间试一次中点
+        """
+        best, batch_size = 0, 1
+        while batch_size <= max_batch_size and self.fits(batch_size):
+            best = batch_size
+            batch_size *= 2
+        middle = best + best // 2
+        if best < middle <= max_batch_size and self.fits(middle):
+            best = middle
+        return best
+
+
+def _load_plans(plan_file):
+    if not os.path.isfile(plan_file):
+        return {}
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_plan(plan_file, key, plan):
+    plans = _load_plans(plan_file)
+    plans[key] = plan
+    os.makedirs(os.path.dirname(plan_file) or '.', exist_ok=True)
+    tmp_path = f"{plan_file}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(plans, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, plan_file)
+
+
+def plan_batch_size(model, dataset, collate_fn, device, effective_batch_size, model_key, plan_file=PLAN_FILE,
+                    memory_fraction=0.9):
+    """
+    选择内存预算内最大的 batch size 和梯度累积步数, 使 batch_size * accumulate_grad_batches 接近 effective_batch_size.
+    不开启 gradient checkpointing 放不下 effective_batch_size 时, 如果开启后能放下两倍以上的 batch 则开启.
+    计划按 (模型, 机器, 探测长度, effective_batch_size) 缓存在 plan_file 中
+    """
+    length = probe_length(dataset.lengths)
+    key = json.dumps({'model': model_key, 'host': host_key(device), 'length': length,
+                      'effective_batch_size': effective_batch_size, 'memory_fraction': memory_fraction}, sort_keys=True)
+    plans = _load_plans(plan_file)
+    if key in plans:
+        print(f"load batch plan from {plan_file}: {plans[key]}")
+        return plans[key]
+
+    # 部分微调的模型在 configure_optimizers 中才冻结底部的层, 探测前先冻结, 否则按全量微调估计梯度和优化器状态
+    if hasattr(model, 'freeze_layers'):
+        model.freeze_layers()
+    device_before = next(model.parameters()).device
+    training = model.training
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    probe = MemoryProbe(model.to(torch_device(device)), dataset, collate_fn, device, length, memory_fraction)
+    model.train()
+    try:
+        batch_size = probe.largest(effective_batch_size)
+        checkpointing = False
+        if batch_size < effective_batch_size and supports_gradient_checkpointing(model):
+            set_gradient_checkpointing(model, True)
+            try:
+                checkpoint_batch_size = probe.largest(effective_batch_size)
+            finally:
+                set_gradient_checkpointing(model, False)
+            # recompute 大约增加 1/3 的计算量, batch 至少翻倍时才值得
+            if checkpoint_batch_size >= max(2 * batch_size, 1):
+                batch_size, checkpointing = checkpoint_batch_size, True
+    finally:
+        model.to(device_before)
+        model.train(training)
+        torch.set_rng_state(rng_state)
+        if cuda_rng_state is not None:
+            torch.cuda.set_rng_state_all(cuda_rng_state)
+    if batch_size == 0:
+        raise Exception(f"batch size 1 with length {length} does not fit in {probe.budget / 2 ** 20:.0f}MB")
+
+    accumulate_grad_batches = int(math.ceil(effective_batch_size / batch_size))
+    plan = {
+        'batch_size': int(math.ceil(effective_batch_size / accumulate_grad_batches)),
+        'accumulate_grad_batches': accumulate_grad_batches,
+        'gradient_checkpointing': checkpointing,
+        'length': length,
+    }
+    print(f"batch plan: {plan}")
+    _save_plan(plan_file, key, plan)
+    return plan
+
@@ -0,0 +1,90 @@
+DELTA_KEY = 'delta_base'
+# 冻结参数的校验和在不同设备上求和的误差
+CHECKSUM_RTOL = 1e-4
+
+
+def frozen_keys(module):
+    """
+    requires_grad=False 的参数, 训练中不会改变, 与预训练模型中的值相同
+    """
+    return sorted(name for name, p in module.named_parameters() if not p.requires_grad)
+
+
+def pretrained_names(module):
+    """
+    模块中由 pretrained_model 创建的预训练模型的名称 (模型类和模型名称)
+    """
+    return [m.pretrained_name for m in module.modules() if getattr(m, 'pretrained_name', None) is not None]
+
+
+def _checksums(state, keys):
+    return [float(state[k].detach().double().sum()) for k in keys]
+
+
+def base_identity(module):
+    """
+    预训练 base 的标识: 预训练模型的名称, 冻结参数的名称, 形状和校验和.
+    冻结参数在训练中不变, 只在第一次保存时计算
+    """
+    keys = frozen_keys(module)
+    cached = getattr(module, '_delta_base', None)
+    if cached is None or cached['keys'] != keys:
+        state = module.state_dict()
+        cached = {
+            'pretrained': pretrained_names(module),
+            'keys': keys,
+            'shapes': [list(state[k].shape) for k in keys],
+            'checksums': _checksums(state, keys),
+        }
+        module._delta_base = cached
+    return cached
+
+
+def to_delta(module, checkpoint):
+    """
+    在 LightningModule.on_save_checkpoint 中调用: state_dict 中只保留可训练的参数和 buffer,
+    冻结的参数由加载时的预训练模型补齐. 优化器只保存可训练参数的状态, 不需要处理
+    """
+    base = base_identity(module)
+    if len(base['keys']) == 0:
+        return checkpoint
+    frozen = set(base['keys'])
+    checkpoint['state_dict'] = {k: v for k, v in checkpoint['state_dict'].items() if k not in frozen}
+    checkpoint[DELTA_KEY] = base
+    return checkpoint
+
+
+def from_delta(module, checkpoint):
+    """
+    在 LightningModule.on_load_checkpoint 中调用: 用当前模型 (由同一个预训练模型创建) 的参数补齐冻结的参数,
+    预训练模型或者冻结的层与保存时不同时报错
+    """
+    base = checkpoint.get(DELTA_KEY)
+    if base is None:
+        return checkpoint
+    if base['pretrained'] != pretrained_names(module):
+        raise Exception(f"delta checkpoint was saved on pretrained base {base['pretrained']}, "
+                        f"but the model is built from {pretrained_names(module)}")
+    state = module.state_dict()
+    missing = [k for k in base['keys'] if k not in state]
+    if missing:
+        raise Exception(f"frozen parameters {missing[:5]} of the delta checkpoint are not in the model")
+    for k, shape, expected, checksum in zip(base['keys'], base['shapes'], base['checksums'],
+                                            _checksums(state, base['keys'])):
+        if list(state[k].shape) != shape or abs(checksum - expected) > CHECKSUM_RTOL * max(abs(expected), 1.0):
+            raise Exception(f"frozen parameter {k} differs from the pretrained base of the delta checkpoint")
+    merged = {k: state[k] for k in base['keys']}
+    merged.update(checkpoint['state_dict'])
+    checkpoint['state_dict'] = merged
+    del checkpoint[DELTA_KEY]
+    return checkpoint
+
+
+def load_checkpoint_state(model, checkpoint):
+    """
+    与 Lightning 恢复模型的顺序相同: 先调用 on_load_checkpoint 补齐参数, 再 load_state_dict
+    """
+    model.on_load_checkpoint(checkpoint)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
@@ -0,0 +1,153 @@
+import glob
+import os
+
+import torch
+from pytorch_lightning import Callback
+
+# GPU 训练时 DataLoader 的 worker 数
+GPU_LOADER_WORKERS = 8
+
+
+def torch_device(device):
+    """
+    --device 对应的 torch 设备, -1 为 CPU
+    """
+    return 'cpu' if device < 0 else f'cuda:{device}'
+
+
+def trainer_gpus(device):
+    """
+    pl.Trainer 的 gpus 参数, CPU 训练时为 None
+    """
+    return None if device < 0 else [device]
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpulist(text):
+    """
+    解析 /sys 中的 cpulist, 例如 0-15,32-47
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """
+    每个 NUMA 节点的 CPU 列表, 无法读取时把所有 CPU 视为一个节点
+    """
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda p: int(p.split('/')[-2][len('node'):])):
+        with open(path, 'r') as f:
+            cpus = parse_cpulist(f.read())
+        if len(cpus) != 0:
+            nodes.append(cpus)
+    return nodes or [list(range(os.cpu_count() or 1))]
+
+
+def slot_cpus(slot, slots):
+    """
+    同一台机器上 slots 个训练进程中第 slot 个使用的 CPU:
+    可用的 CPU 按 NUMA 节点排列后连续切分, slots 为节点数的倍数时每个进程只使用一个节点的 CPU 和本地内存
+    """
+    allowed = set(available_cpus())
+    cpus = [cpu for node in numa_nodes() for cpu in node if cpu in allowed]
+    cpus += sorted(allowed - set(cpus))
+    if slots > len(cpus):
+        raise Exception(f"{slots} cpu slots for {len(cpus)} cpus")
+    size = len(cpus) // slots
+    return cpus[slot * size:(slot + 1) * size]
+
+
+def pin_process(slot, slots):
+    """
+    把当前进程绑定到 slot 对应的 CPU 上, 之后创建的线程和 DataLoader worker 继承该绑定
+    """
+    cpus = slot_cpus(slot, slots)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    return cpus
+
+
+def loader_workers(device):
+    """
+    DataLoader 的 worker 数: CPU 训练时 worker 和计算线程共用核心, 数据已经提前 tokenize, 每 8 个核心分配一个 worker
+    """
+    if device >= 0:
+        return GPU_LOADER_WORKERS
+    cores = len(available_cpus())
+    return min(GPU_LOADER_WORKERS, cores // 8)
+
+
+def configure_threads(device, num_threads=None, num_interop_threads=None):
+    """
+    CPU 训练时的 intra-op / inter-op 线程数, 默认使用 OMP_NUM_THREADS 或者扣除 DataLoader worker 后的全部核心
+    """
+    if device >= 0:
+        return
+    if num_threads is None and os.environ.get('OMP_NUM_THREADS'):
+        num_threads = int(os.environ['OMP_NUM_THREADS'])
+    if num_threads is None:
+        num_threads = max(1, len(available_cpus()) - loader_workers(device))
+    torch.set_num_threads(num_threads)
+    if num_interop_threads is None:
+        num_interop_threads = max(1, min(4, num_threads // 4))
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # inter-op 线程池已经启动后不能再修改
+        pass
+    print(f"cpu threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+
+def setup_device(device, num_threads=None, cpu_slot=None, cpu_slots=None):
+    """
+    训练脚本启动时调用: CPU 训练时按 slot 绑定 CPU 并设置线程数
+    """
+    if device >= 0:
+        return
+    if cpu_slot is not None:
+        cpus = pin_process(cpu_slot, cpu_slots or 1)
+        print(f"pin cpu slot {cpu_slot}/{cpu_slots} to cpus {cpus}")
+    configure_threads(device, num_threads)
+
+
+class BF16Autocast(Callback):
+    """
+    训练和验证时在 bf16 autocast 下计算 forward, logits 转回 float32 计算 loss 和指标.
+    forward 只在 fit 期间替换, 不影响模型的序列化和训练结束后的测试
+    """
+    def __init__(self, device):
+        super().__init__()
+        self.device_type = 'cpu' if device < 0 else 'cuda'
+
+    def on_fit_start(self, trainer, pl_module):
+        forward = pl_module.forward
+        device_type = self.device_type
+
+        def autocast_forward(*args, **kwargs):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                logits = forward(*args, **kwargs)
+            return logits.float()
+
+        pl_module.forward = autocast_forward
+
+    def on_fit_end(self, trainer, pl_module):
+        pl_module.__dict__.pop('forward', None)
+
+
+def precision_callbacks(device, bf16=False):
+    return [BF16Autocast(device)] if bf16 else []
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import torch
+import tqdm
+from sklearn.metrics import classification_report
+
+from GitHubIssue.metrics.topk import topk_metrics
+from GitHubIssue.models import KEYWORD_INPUT_MODELS
+
+PREDICTION_COLUMNS = ['number', 'html_url', 'title', 'description']
+
+
+def _to_device(inputs, device):
+    return {k: v.to(device) for k, v in inputs.items()}
+
+
+class EvaluationEngine(object):
+    """
+    一个 stage 的评估: 每个 issue 只推理一次, 指标, classification_report 和预测结果都由同一份 logits 计算
+    logits 可以由 run 对 DataLoader 推理得到, 也可以在验证循环中通过 add 逐 batch 收集
+    """
+    def __init__(self, stage, all_labels):
+        self.stage = stage
+        self.all_labels = list(all_labels)
+        self.reset()
+
+    def reset(self):
+        self._logits = []
+        self._labels = []
+
+    def add(self, logits, target):
+        """
+        target 可以是 one-hot 标签, 也可以是类别 id
+        """
+        logits = logits.detach().float().cpu()
+        target = target.detach().cpu()
+        if target.dim() > 1:
+            target = target.argmax(dim=-1)
+        self._logits.append(logits.numpy())
+        self._labels.append(target.long().numpy())
+
+    def run(self, model, loader, desc=None):
+        """
+        在 inference_mode 下对 loader 推理一次, 推理结束后恢复模型原来的 train / eval 状态
+        """
+        self.reset()
+        training = model.training
+        device = next(model.parameters()).device
+        model.eval()
+        with torch.inference_mode():
+            for inputs, target in tqdm.tqdm(loader, desc=desc or f"evaluate {self.stage}"):
+                inputs = _to_device(inputs, device)
+                if isinstance(model, KEYWORD_INPUT_MODELS):
+                    logits = model(**inputs)
+                else:
+                    logits = model(inputs)
+                self.add(logits, target)
+        model.train(training)
+        return self
+
+    @property
+    def logits(self):
+        if len(self._logits) == 0:
+            return np.zeros((0, len(self.all_labels)), dtype=np.float32)
+        return np.concatenate(self._logits)
+
+    @property
+    def labels(self):
+        if len(self._labels) == 0:
+            return np.zeros((0,), dtype=np.int64)
+        return np.concatenate(self._labels)
+
+    def metrics(self):
+        """
+        与模型中记录的 <stage>_*_epoch 指标同名同值, 由 IssueClassificationMetrics 在收集的 logits 上计算
+        """
+        return topk_metrics(self.logits, self.labels, len(self.all_labels), self.stage)
+
+    def report(self):
+        return classification_report(self.labels, self.logits.argmax(axis=1), labels=list(range(len(self.all_labels))),
+                                     target_names=self.all_labels, output_dict=True)
+
+    def predictions(self, data):
+        """
+        data 为与 loader 顺序一致的原始 issue 列表
+        """
+        pred_dict = {k: [obj.get(k) for obj in data] for k in PREDICTION_COLUMNS}
+        pred_dict['true_label'] = [self.all_labels[i] for i in self.labels]
+        pred_dict['pred_label'] = [self.all_labels[i] for i in self.logits.argmax(axis=1)]
+        return pd.DataFrame(pred_dict)
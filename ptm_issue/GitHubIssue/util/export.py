@@ -0,0 +1,102 @@
+import io
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from GitHubIssue.models.bert import Bert
+from GitHubIssue.models.gpt import SEQUENCE_MODEL_CONFIG as GPT_SEQUENCE_MODEL_CONFIG
+from GitHubIssue.models.gpt import Gpt
+from GitHubIssue.models.transformer import SEQUENCE_MODEL_CONFIG as TRANSFORMER_SEQUENCE_MODEL_CONFIG
+from GitHubIssue.models.transformer import Transformer
+from GitHubIssue.util.delta_ckpt import load_checkpoint_state
+
+
+def model_class(model_name):
+    """
+    根据模型名称 (或本地模型路径) 返回对应的 LightningModule
+    """
+    name = model_name.split('/')[-1]
+    if model_name in GPT_SEQUENCE_MODEL_CONFIG or name in GPT_SEQUENCE_MODEL_CONFIG:
+        return Gpt
+    if model_name in TRANSFORMER_SEQUENCE_MODEL_CONFIG or name in TRANSFORMER_SEQUENCE_MODEL_CONFIG:
+        return Transformer
+    return Bert
+
+
+def load_checkpoint_model(ckpt_path, model_path=None, map_location='cpu'):
+    """
+    从 ModelCheckpoint 保存的 checkpoint 中恢复模型, 模型参数由 checkpoint 中的 hyper_parameters 决定
+    本地模型的 hyper_parameters 中只保存了模型名称, 需要通过 model_path 指定本地模型路径
+    """
+    checkpoint = torch.load(ckpt_path, map_location=map_location)
+    hparams = dict(checkpoint['hyper_parameters'])
+    if model_path is not None:
+        hparams['model_name'] = model_path
+    elif hparams.get('local_model', False):
+        raise Exception("local model checkpoint needs model_path")
+    cls = model_class(hparams['model_name'])
+    model = cls(**hparams)
+    # delta checkpoint 中冻结的参数由模型创建时的预训练权重补齐
+    load_checkpoint_state(model, checkpoint)
+    model.eval()
+    return model
+
+
+def strip_training_state(model):
+    """
+    去除只在训练中使用的指标, 部署时只需要 forward
+    """
+    model.metrics = nn.ModuleDict()
+    for param in model.parameters():
+        param.requires_grad = False
+    return model.eval()
+
+
+def quantize_int8(model):
+    """
+    对所有 Linear 层做动态 int8 量化, 返回新的模型
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def serialized_size(obj):
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def save_artifact(path, model, all_labels, tokenizer_name):
+    """
+    保存可部署的模型文件: 完整的模型对象, 标签列表和 tokenizer 名称, 不包含优化器等训练状态
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save({
+        'model': model,
+        'all_labels': list(all_labels),
+        'tokenizer': tokenizer_name,
+    }, path)
+
+
+def load_artifact(path):
+    artifact = torch.load(path, map_location='cpu')
+    artifact['model'].eval()
+    return artifact
+
+
+@torch.no_grad()
+def predict_logits(model, dataset, collate_fn, batch_size=8):
+    """
+    在 CPU 上计算数据集的 logits, 同时返回每个样本的平均耗时 (秒)
+    """
+    model.eval()
+    logits = []
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    start = time.perf_counter()
+    for inputs, _ in loader:
+        logits.append(model(inputs).float().numpy())
+    elapsed = time.perf_counter() - start
+    return np.concatenate(logits), elapsed / max(len(dataset), 1)
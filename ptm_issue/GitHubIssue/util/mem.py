@@ -14,8 +14,10 @@ def check_mem(cuda_device):
 
 def occupy_mem(cuda_device):
     """
-    分配未使用显存
+    分配未使用显存, CPU 训练或没有 GPU 时直接返回
     """
+    if int(cuda_device) < 0 or not torch.cuda.is_available():
+        return
     total, used = check_mem(cuda_device)
     total = int(total)
     used = int(used)
@@ -0,0 +1,142 @@
+import copy
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from GitHubIssue.models import KEYWORD_INPUT_MODELS
+
+OUTPUT_NAME = 'logits'
+
+
+class OnnxExportWrapper(nn.Module):
+    """
+    torch.onnx.export 只能按位置传入张量, 包装后按 input_names 还原为模型需要的输入形式
+    """
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = list(input_names)
+        self.keyword_input = isinstance(model, KEYWORD_INPUT_MODELS)
+
+    def forward(self, *inputs):
+        inputs = dict(zip(self.input_names, inputs))
+        if self.keyword_input:
+            return self.model(**inputs)
+        return self.model(inputs)
+
+
+def export_onnx(model, sample_inputs, path, opset_version=14):
+    """
+    使用一个 batch 的输入导出 ONNX 模型, batch 和序列长度两个维度都是动态的
+    """
+    input_names = list(sample_inputs.keys())
+    wrapper = OnnxExportWrapper(model, input_names).eval()
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes[OUTPUT_NAME] = {0: 'batch'}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            tuple(sample_inputs[name].cpu() for name in input_names),
+            path,
+            input_names=input_names,
+            output_names=[OUTPUT_NAME],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    return path
+
+
+class OnnxIssuePredictor(object):
+    """
+    使用 ONNX Runtime 在 CPU 上推理, 输入与模型在 PyTorch 中的输入 (collate 后的字典) 一致
+    """
+    def __init__(self, path, intra_op_threads=1, inter_op_threads=1):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, inputs):
+        feed = {}
+        for name in self.input_names:
+            value = inputs[name]
+            if isinstance(value, torch.Tensor):
+                value = value.numpy()
+            feed[name] = value.astype(np.int64)
+        return self.session.run([OUTPUT_NAME], feed)[0]
+
+    def predict(self, dataset, collate_fn, batch_size=8):
+        """
+        返回数据集的 logits 和每个样本的平均耗时 (秒)
+        """
+        logits = []
+        elapsed = 0.0
+        for inputs, _ in DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn):
+            start = time.perf_counter()
+            logits.append(self(inputs))
+            elapsed += time.perf_counter() - start
+        return np.concatenate(logits), elapsed / max(len(dataset), 1)
+
+
+@torch.no_grad()
+def eager_logits(model, inputs):
+    model.eval()
+    if isinstance(model, KEYWORD_INPUT_MODELS):
+        return model(**inputs).float().numpy()
+    return model(inputs).float().numpy()
+
+
+@torch.no_grad()
+def check_parity(model, predictor, dataset, collate_fn, batch_size=8, atol=1e-4, strict=False):
+    """
+    在数据集上比较 PyTorch 与 ONNX Runtime 的 logits, 超过 atol 时 strict 抛出异常, 否则只打印警告.
+    fp16 或不同 opset 下超过 atol 是常见的, 结果中的 parity_ok 记录是否在 atol 以内
+    """
+    model.eval()
+    max_diff = 0.0
+    same, total = 0, 0
+    for inputs, _ in DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn):
+        expected = eager_logits(model, inputs)
+        actual = predictor(inputs)
+        max_diff = max(max_diff, float(np.abs(expected - actual).max()))
+        same += int((expected.argmax(axis=1) == actual.argmax(axis=1)).sum())
+        total += len(expected)
+    if max_diff > atol:
+        message = f"onnx logits differ from pytorch: max abs diff {max_diff} > {atol}"
+        if strict:
+            raise Exception(message)
+        print(f"warning: {message}")
+    return {'max_abs_diff': max_diff, 'parity_ok': float(max_diff <= atol), 'prediction_agreement': same / max(total, 1)}
+
+
+def export_and_verify(model, dataset, collate_fn, path, intra_op_threads=1, batch_size=8, atol=1e-4, strict=False):
+    """
+    在 CPU 上导出 ONNX 模型, 在数据集上校验与 PyTorch 的 logits 一致, 并统计两者每个样本的推理耗时.
+    导出使用模型的副本, 不改变训练中模型所在的设备
+    """
+    # LightningModule 引用的 trainer (包含线程和进程) 不复制
+    trainer = getattr(model, 'trainer', None)
+    model = copy.deepcopy(model, memo={id(trainer): None} if trainer is not None else None).cpu().eval()
+    sample_inputs, _ = next(iter(DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)))
+    export_onnx(model, sample_inputs, path)
+    predictor = OnnxIssuePredictor(path, intra_op_threads=intra_op_threads)
+    report = check_parity(model, predictor, dataset, collate_fn, batch_size, atol, strict)
+
+    elapsed = 0.0
+    for inputs, _ in DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn):
+        start = time.perf_counter()
+        eager_logits(model, inputs)
+        elapsed += time.perf_counter() - start
+    report['torch_latency_ms'] = elapsed / max(len(dataset), 1) * 1000
+    report['onnx_latency_ms'] = predictor.predict(dataset, collate_fn, batch_size)[1] * 1000
+    return report
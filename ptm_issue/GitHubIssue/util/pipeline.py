@@ -0,0 +1,279 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+from pprint import pprint
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.model_selection import StratifiedShuffleSplit
+
+from GitHubIssue.dataset.issue_dataset import file_fingerprint
+from GitHubIssue.util.evaluation import EvaluationEngine
+
+SPLITS = ('train', 'valid', 'test')
+# 计算代码版本的源码目录: GitHubIssue 包
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_code_version = None
+
+
+def stage_key(stage, inputs):
+    """
+    stage 的缓存 key 由 stage 名称和全部输入计算
+    """
+    text = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def code_version():
+    """
+    GitHubIssue 包和当前训练脚本的源码, 以及 torch / transformers / pytorch_lightning 的版本, 修改代码后缓存的训练结果失效
+    """
+    global _code_version
+    if _code_version is None:
+        import pytorch_lightning
+        import transformers
+
+        paths = []
+        for root, dirs, files in os.walk(PACKAGE_DIR):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            paths += [os.path.join(root, f) for f in sorted(files) if f.endswith('.py')]
+        script = getattr(sys.modules.get('__main__'), '__file__', None)
+        if script is not None:
+            paths.append(os.path.abspath(script))
+        sha = hashlib.sha256()
+        for path in paths:
+            sha.update(os.path.relpath(path, os.path.dirname(PACKAGE_DIR)).encode('utf-8'))
+            sha.update(file_fingerprint(path).encode('utf-8'))
+        for module in (torch, transformers, pytorch_lightning):
+            sha.update(f"{module.__name__}=={module.__version__}".encode('utf-8'))
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+def load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def count_labels(data, dataset):
+    count = dict()
+    for obj in data:
+        if count.get(obj['labels']) is None:
+            count[obj['labels']] = 1
+        else:
+            count[obj['labels']] += 1
+    print(f'label count for {dataset} dataset')
+    pprint(count)
+
+
+def collect_labels(*datasets):
+    all_labels = set()
+    for data in datasets:
+        for obj in data:
+            all_labels.add(obj['labels'])
+    return sorted(list(all_labels))
+
+
+def _stratified(labels, test_size, random_state):
+    split = StratifiedShuffleSplit(n_splits=1, test_size=test_size, random_state=random_state)
+    return next(split.split(np.zeros(len(labels)), labels))
+
+
+def stratified_split_indices(files, labels, test_size=0.3, valid_size=0.2, random_state=42):
+    """
+    train_cross.py / train.py / train_cv.py 的划分方式:
+    三个文件相同时先分层划分出测试集, 再从剩余部分分层划分出验证集; 只有训练和验证文件相同时只划分验证集
+    返回 {split: (文件中的位置, 下标)}
+    """
+    train_file, valid_file, test_file = files
+    if train_file == test_file and train_file == valid_file:
+        y = np.asarray(labels[0])
+        rest, test = _stratified(y, test_size, random_state)
+        train, valid = _stratified(y[rest], valid_size, random_state)
+        return {'train': (0, rest[train]), 'valid': (0, rest[valid]), 'test': (0, test)}
+    if train_file == valid_file:
+        train, valid = _stratified(np.asarray(labels[0]), valid_size, random_state)
+        return {'train': (0, train), 'valid': (0, valid), 'test': (2, np.arange(len(labels[2])))}
+    return {split: (i, np.arange(len(labels[i]))) for i, split in enumerate(SPLITS)}
+
+
+def shuffle_split_indices(files, labels, train_ratio=0.8, valid_ratio=0.9, random_state=42):
+    """
+    train_new.py 的划分方式: 使用 random.shuffle 打乱后按比例切分, 验证集包含训练集
+    """
+    train_file, _, test_file = files
+    rng = random.Random(random_state)
+    if train_file == test_file:
+        index = list(range(len(labels[0])))
+        rng.shuffle(index)
+        split_1, split_2 = int(train_ratio * len(index)), int(valid_ratio * len(index))
+        return {'train': (0, np.array(index[:split_1])), 'valid': (0, np.array(index[:split_2])),
+                'test': (0, np.array(index[split_2:]))}
+    train_index = list(range(len(labels[0])))
+    test_index = list(range(len(labels[2])))
+    rng.shuffle(train_index)
+    rng.shuffle(test_index)
+    split_1 = int(train_ratio * len(train_index))
+    return {'train': (0, np.array(train_index[:split_1])), 'valid': (0, np.array(train_index)),
+            'test': (2, np.array(test_index))}
+
+
+SPLIT_METHODS = {
+    'stratified': stratified_split_indices,
+    'shuffle': shuffle_split_indices,
+}
+
+
+class Pipeline(object):
+    """
+    训练脚本共用的实验流程: load -> split -> vocab -> tokenize -> train -> evaluate -> report
+    每个 stage 的输出按输入计算 key 保存在 root 下, 只修改学习率或模型时, 数据划分和词表等 stage 直接读取缓存.
+    tokenize 的结果由 IssueDataset 的 cache_dir 缓存, train 和 evaluate 的输出为测试集的 logits.
+    root 为 None 时不使用缓存. 测试集 logits 的缓存需要通过 cache_evaluation 打开: 相同输入的重复训练直接返回缓存的结果,
+    不会重新采样随机性
+    """
+    def __init__(self, root=None, cache_evaluation=False):
+        self.root = root
+        self.cache_evaluation = cache_evaluation
+        self._fingerprints = {}
+
+    def stage_dir(self, stage, inputs):
+        return os.path.join(self.root, stage, stage_key(stage, inputs))
+
+    def fingerprint(self, path):
+        if path not in self._fingerprints:
+            self._fingerprints[path] = file_fingerprint(path)
+        return self._fingerprints[path]
+
+    def _commit(self, tmp_path, path):
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # 其他进程已经写入了相同的 stage
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # ------------------------------ load / split ------------------------------
+    def split(self, train_file, valid_file, test_file, method='stratified', verbose=True, **kwargs):
+        """
+        返回 (train_data, valid_data, test_data), 划分的下标按文件内容和划分参数缓存, 同一份数据的所有实验使用相同的划分
+        """
+        files = (train_file, valid_file, test_file)
+        sources = {}
+        for path in files:
+            if path not in sources:
+                sources[path] = load_json(path)
+        data = [sources[path] for path in files]
+
+        indices = None
+        if self.root is not None:
+            inputs = {'files': [self.fingerprint(path) for path in files],
+                      'same': [train_file == valid_file, train_file == test_file, valid_file == test_file],
+                      'method': method, 'kwargs': kwargs}
+            path = os.path.join(self.stage_dir('split', inputs), 'indices.json')
+            if os.path.isfile(path):
+                indices = {k: (v[0], np.array(v[1], dtype=np.int64)) for k, v in load_json(path).items()}
+        if indices is None:
+            labels = [[obj['labels'] for obj in d] for d in data]
+            indices = SPLIT_METHODS[method](files, labels, **kwargs)
+            if self.root is not None:
+                tmp_path = f"{os.path.dirname(path)}.tmp-{os.getpid()}"
+                os.makedirs(tmp_path, exist_ok=True)
+                with open(os.path.join(tmp_path, 'indices.json'), 'w', encoding='utf-8') as f:
+                    json.dump({k: [int(v[0]), v[1].tolist()] for k, v in indices.items()}, f)
+                self._commit(tmp_path, os.path.dirname(path))
+
+        splits = tuple([data[indices[s][0]][i] for i in indices[s][1]] for s in SPLITS)
+        if verbose:
+            for d, name in zip(splits, ('train', 'val', 'test')):
+                count_labels(d, name)
+        return splits
+
+    # --------------------------------- vocab ---------------------------------
+    def vocab(self, data_path, build_fn, **inputs):
+        """
+        allennlp 的词表, build_fn 在缓存不存在时构建词表, inputs 为影响词表的其他参数
+        """
+        if self.root is None:
+            return build_fn()
+        from allennlp.data.vocabulary import Vocabulary
+
+        path = self.stage_dir('vocab', {'data': self.fingerprint(data_path), **inputs})
+        if os.path.isdir(path):
+            print(f"load vocabulary from cache {path}")
+            return Vocabulary.from_files(path)
+        vocab = build_fn()
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        vocab.save_to_files(tmp_path)
+        self._commit(tmp_path, path)
+        return vocab
+
+    # --------------------------- train / evaluate ---------------------------
+    def run_inputs(self, train_file, valid_file, test_file, **params):
+        """
+        一次训练的输入: 数据文件的内容, 代码版本和全部影响结果的参数, params 中需要包含训练次数以区分重复训练
+        """
+        return {'files': [self.fingerprint(path) for path in (train_file, valid_file, test_file)], 'params': params,
+                'code': code_version() if self.cache_evaluation else None}
+
+    def cached_evaluation(self, inputs, all_labels):
+        """
+        读取之前相同输入的训练在测试集上的 logits, 不存在或没有打开 cache_evaluation 时返回 None
+        """
+        if self.root is None or not self.cache_evaluation:
+            return None
+        path = os.path.join(self.stage_dir('evaluate', inputs), 'logits.npz')
+        if not os.path.isfile(path):
+            return None
+        print(f"load test logits from cache {path}")
+        arrays = np.load(path)
+        engine = EvaluationEngine('test', all_labels)
+        engine.add(torch.from_numpy(arrays['logits']), torch.from_numpy(arrays['labels']))
+        return engine
+
+    def save_evaluation(self, inputs, engine):
+        if self.root is None or not self.cache_evaluation:
+            return
+        path = self.stage_dir('evaluate', inputs)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        np.savez(os.path.join(tmp_path, 'logits.npz'), logits=engine.logits, labels=engine.labels)
+        self._commit(tmp_path, path)
+
+    def evaluate(self, inputs, all_labels, run_fn):
+        """
+        train + evaluate: 缓存中有相同输入的结果时直接返回, 否则调用 run_fn 训练并返回测试集的 EvaluationEngine
+        """
+        engine = self.cached_evaluation(inputs, all_labels)
+        if engine is None:
+            engine = run_fn()
+            self.save_evaluation(inputs, engine)
+        return engine
+
+
+# --------------------------------- report ---------------------------------
+def report_name(train_file, test_file):
+    if train_file == test_file:
+        return train_file.split('/')[-1].split('.')[0]
+    return train_file.split('/')[-1].split('.')[0] + '_' + test_file.split('/')[-1].split('.')[0]
+
+
+def write_reports(engine, test_data, name, suffix=None, output_dir='./output'):
+    """
+    保存分类报告 (output/subclass) 和每个 issue 的预测结果 (output/eval), 返回分类报告
+    """
+    if suffix is not None:
+        name = f"{name}_{suffix}"
+    report = engine.report()
+    print(report)
+    save_path = os.path.join(output_dir, 'subclass')
+    os.makedirs(save_path, exist_ok=True)
+    pd.DataFrame(report).T.to_csv(os.path.join(save_path, f"{name}.csv"), mode='a')
+
+    save_path = os.path.join(output_dir, 'eval')
+    os.makedirs(save_path, exist_ok=True)
+    engine.predictions(test_data).to_csv(os.path.join(save_path, f"{name}.csv"), index=False)
+    return report
@@ -0,0 +1,188 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+
+import transformers
+from transformers.modeling_utils import no_init_weights
+
+# 跨进程共享的权重目录, 位于内存文件系统中, sweep 的所有任务共用
+SHM_DIR = '/dev/shm/ptm_issue_pretrained'
+WEIGHTS_NAME = 'weights.safetensors'
+INFO_NAME = 'loading_info.json'
+
+# 默认只在进程内缓存, 共享目录由 sweep.py / search.py 通过 --pretrained_cache 传入
+_cache_dir = None
+# key -> (模型类, config, 预训练权重, 需要重新初始化的参数)
+_states = {}
+_tokenizers = {}
+
+
+def set_cache_dir(path):
+    """
+    设置跨进程共享的权重目录, None 时只在进程内缓存
+    """
+    global _cache_dir
+    _cache_dir = path
+
+
+def clear():
+    _states.clear()
+    _tokenizers.clear()
+
+
+def shared_dir():
+    """
+    sweep / search 一次运行中所有任务共用的目录: 每次运行使用单独的目录, 结束时删除, 不会与其他运行冲突或残留旧的权重
+    """
+    if not os.path.isdir('/dev/shm'):
+        return None
+    return f"{SHM_DIR}_{os.getpid()}"
+
+
+def clear_shared(path=None):
+    """
+    删除跨进程共享的权重目录. /dev/shm 中的文件占用内存, 在进程退出后也不会释放, 不再训练时需要删除
+    """
+    path = path or _cache_dir
+    if path is not None and os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        print(f"remove shared pretrained weights {path}")
+
+
+def _local_files(name_or_path):
+    if not os.path.isdir(name_or_path):
+        return None
+    return {name: os.path.getmtime(os.path.join(name_or_path, name)) for name in sorted(os.listdir(name_or_path))}
+
+
+def cache_key(cls, name_or_path, **kwargs):
+    """
+    本地模型目录中的文件被修改后 key 随之变化
+    """
+    text = json.dumps({'cls': cls.__name__, 'model': name_or_path, 'kwargs': kwargs, 'files': _local_files(name_or_path),
+                       'transformers': transformers.__version__}, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def pretrained_name(cls, name_or_path):
+    """
+    预训练模型的名称: 模型类和模型名称 (本地模型为目录名), 不依赖本地路径, 文件时间和 transformers 版本,
+    复制到其他机器或重新下载后不变
+    """
+    return f"{cls.__name__}:{name_or_path.rstrip('/').split('/')[-1]}"
+
+
+def _load(cls, name_or_path, **kwargs):
+    """
+    第一次加载: from_pretrained 后只保留 checkpoint 中存在的参数, 新建的分类层参数记录为需要重新初始化
+    """
+    model, info = cls.from_pretrained(name_or_path, output_loading_info=True, **kwargs)
+    reinit = set(info['missing_keys']) | set(key for key, _, _ in info.get('mismatched_keys', []))
+    state = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        # 共享存储的参数 (tie_weights) 只保存一份
+        if name in reinit or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        # 返回的模型会被训练修改, 缓存中保留一份副本
+        state[name] = tensor.detach().clone().contiguous()
+    return type(model), copy.deepcopy(model.config), state, sorted(reinit), model
+
+
+def _save_shared(path, model_cls, config, state, reinit):
+    from safetensors.torch import save_file
+
+    # docker 默认的 /dev/shm 只有 64MB, 空间不足时不写入, 避免占满 DataLoader worker 也在使用的共享内存
+    size = sum(t.numel() * t.element_size() for t in state.values())
+    free = shutil.disk_usage(os.path.dirname(path)).free
+    if size * 1.1 > free:
+        raise OSError(f"{size / 2 ** 20:.0f}MB of pretrained weights do not fit in {free / 2 ** 20:.0f}MB free space")
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        save_file(state, os.path.join(tmp_path, WEIGHTS_NAME))
+        config.save_pretrained(tmp_path)
+        with open(os.path.join(tmp_path, INFO_NAME), 'w', encoding='utf-8') as f:
+            json.dump({'model_cls': model_cls.__name__, 'reinit': reinit}, f)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # 其他进程已经写入了相同的模型
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _load_shared(path):
+    from safetensors.torch import load_file
+
+    with open(os.path.join(path, INFO_NAME), 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    model_cls = getattr(transformers, info['model_cls'])
+    config = model_cls.config_class.from_pretrained(path)
+    return model_cls, config, load_file(os.path.join(path, WEIGHTS_NAME)), info['reinit']
+
+
+def _build(model_cls, config, state, reinit):
+    """
+    跳过随机初始化构建模型, 复制预训练权重后只重新初始化分类层
+    """
+    with no_init_weights():
+        model = model_cls(copy.deepcopy(config))
+    missing, unexpected = model.load_state_dict(state, strict=False)
+    model_state = model.state_dict()
+    ptrs = set(model_state[name].data_ptr() for name in state)
+    tied = set(name for name, tensor in model_state.items() if name not in state and tensor.data_ptr() in ptrs)
+    if unexpected or set(missing) - set(reinit) - tied:
+        raise Exception(f"pretrained cache does not match {model_cls.__name__}: "
+                        f"missing {sorted(set(missing) - set(reinit) - tied)}, unexpected {unexpected}")
+    for name in reinit:
+        model._init_weights(model.get_submodule(name.rsplit('.', 1)[0]))
+    model.tie_weights()
+    model.eval()
+    return model
+
+
+def pretrained_model(cls, name_or_path, **kwargs):
+    """
+    代替 cls.from_pretrained(name_or_path, **kwargs):
+    预训练权重在进程内和共享目录中各保留一份, 之后的每次训练只复制权重并重新初始化分类层, 不再读取和反序列化 checkpoint
+    """
+    key = cache_key(cls, name_or_path, **kwargs)
+    if key not in _states:
+        path = os.path.join(_cache_dir, key) if _cache_dir is not None else None
+        if path is not None and os.path.isdir(path):
+            print(f"load pretrained weights of {name_or_path} from {path}")
+            _states[key] = _load_shared(path)
+        else:
+            model_cls, config, state, reinit, model = _load(cls, name_or_path, **kwargs)
+            _states[key] = (model_cls, config, state, reinit)
+            if path is not None:
+                try:
+                    os.makedirs(_cache_dir, exist_ok=True)
+                    _save_shared(path, model_cls, config, state, reinit)
+                except Exception as e:
+                    # 共享目录写入失败时只在进程内缓存, 本进程之后的模型不再尝试写入
+                    print(f"can not share pretrained weights in {_cache_dir}: {e}, cache them in this process only")
+                    set_cache_dir(None)
+            # 第一次加载直接返回 from_pretrained 的结果
+            model.pretrained_name = pretrained_name(cls, name_or_path)
+            return model
+    model = _build(*_states[key])
+    # delta checkpoint 用名称标识冻结参数来自哪个预训练模型, 参数是否相同由校验和检查
+    model.pretrained_name = pretrained_name(cls, name_or_path)
+    return model
+
+
+def pretrained_tokenizer(cls, name_or_path, **kwargs):
+    """
+    代替 cls.from_pretrained(name_or_path, **kwargs), 同一进程内的多次训练共用 tokenizer
+    """
+    key = cache_key(cls, name_or_path, **kwargs)
+    if key not in _tokenizers:
+        _tokenizers[key] = cls.from_pretrained(name_or_path, **kwargs)
+    return _tokenizers[key]
@@ -0,0 +1,141 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import tqdm
+from torch.utils.data import DataLoader
+
+from GitHubIssue.dataset.issue_dataset import TEXT_TEMPLATE, concat_template, issue_to_text
+
+KEYS_NAME = 'keys.jsonl'
+EMBEDDINGS_NAME = 'embeddings.f32'
+META_NAME = 'meta.json'
+LOCK_NAME = 'lock'
+
+
+def issue_key(tokenizer, obj):
+    """
+    issue 的缓存 key: html_url (或 number) 加上拼接后文本的摘要, 数据增强得到的同一 issue 的不同文本不会冲突
+    """
+    issue_id = obj.get('html_url') or obj.get('number')
+    digest = hashlib.sha1(issue_to_text(tokenizer, obj).encode('utf-8')).hexdigest()[:16]
+    return f"{issue_id}#{digest}"
+
+
+def embedding_store_path(cache_dir, model_name, tokenizer, max_length=512):
+    key = {
+        'model_name': model_name,
+        'max_length': max_length,
+        'template': TEXT_TEMPLATE + '@' + concat_template(tokenizer),
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, model_name.replace('/', '_') + '_' + digest)
+
+
+class EmbeddingStore(object):
+    """
+    按 issue 保存 backbone 输出的 pooled 向量, 不同的数据划分和重复运行共享同一份缓存.
+    向量按行追加到 embeddings.f32, key 按行追加到 keys.jsonl, 已有的行不再重写; 多个进程同时探测时通过文件锁串行追加
+    """
+    def __init__(self, path):
+        self.path = path
+        self.keys = []
+        self.index = {}
+        self.embeddings = None
+        self.dim = None
+        self.keys_offset = 0
+        os.makedirs(path, exist_ok=True)
+        with self.lock(fcntl.LOCK_SH):
+            self.refresh()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def lock(self, mode):
+        with open(self.file(LOCK_NAME), 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        读取其他进程追加的行, 调用时需要持有锁
+        """
+        if not os.path.isfile(self.file(KEYS_NAME)):
+            return
+        if self.dim is None:
+            with open(self.file(META_NAME), 'r', encoding='utf-8') as f:
+                self.dim = json.load(f)['dim']
+        with open(self.file(KEYS_NAME), 'rb') as f:
+            f.seek(self.keys_offset)
+            data = f.read()
+        if len(data) == 0:
+            return
+        self.keys_offset += len(data)
+        keys = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        rows = np.fromfile(self.file(EMBEDDINGS_NAME), dtype=np.float32, count=len(keys) * self.dim,
+                           offset=len(self.keys) * self.dim * 4).reshape(len(keys), self.dim)
+        self._extend(keys, rows)
+
+    def _extend(self, keys, rows):
+        for i, k in enumerate(keys):
+            self.index.setdefault(k, len(self.keys) + i)
+        self.keys.extend(keys)
+        self.embeddings = rows if self.embeddings is None else np.concatenate([self.embeddings, rows])
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, keys, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self.lock(fcntl.LOCK_EX):
+            self.refresh()
+            # 其他进程可能已经写入了相同的 issue
+            new = {}
+            for i, k in enumerate(keys):
+                if k not in self.index and k not in new:
+                    new[k] = i
+            if len(new) == 0:
+                return
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                with open(self.file(META_NAME), 'w', encoding='utf-8') as f:
+                    json.dump({'dim': self.dim}, f)
+            rows = embeddings[list(new.values())]
+            # 上次追加在写入 key 之前中断时, 丢弃多出的向量
+            if os.path.isfile(self.file(EMBEDDINGS_NAME)):
+                os.truncate(self.file(EMBEDDINGS_NAME), len(self.keys) * self.dim * 4)
+            with open(self.file(EMBEDDINGS_NAME), 'ab') as f:
+                f.write(rows.tobytes())
+            data = ''.join(json.dumps(k) + '\n' for k in new).encode('utf-8')
+            with open(self.file(KEYS_NAME), 'ab') as f:
+                f.write(data)
+            self.keys_offset += len(data)
+            self._extend(list(new.keys()), rows)
+
+    def get(self, keys):
+        return self.embeddings[[self.index[k] for k in keys]]
+
+
+@torch.no_grad()
+def extract_pooled_embeddings(backbone, dataset, collate_fn, device='cpu', batch_size=32):
+    """
+    使用 backbone 计算数据集的 pooler_output
+    """
+    backbone.eval()
+    backbone.to(device)
+    embeddings = []
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    for inputs, _ in tqdm.tqdm(loader, desc="extract pooled embeddings"):
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        embeddings.append(backbone(**inputs).pooler_output.float().cpu().numpy())
+    if len(embeddings) == 0:
+        return np.zeros((0, backbone.config.hidden_size), dtype=np.float32)
+    return np.concatenate(embeddings)
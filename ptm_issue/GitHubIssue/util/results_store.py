@@ -0,0 +1,163 @@
+import math
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+RESULT_DB = 'output/rq1/results.db'
+# rq1 结果 csv 中的指标列
+RESULT_COLUMNS = [
+    'test_acc_1_epoch',
+    'test_precision_1_epoch',
+    'test_recall_1_epoch',
+    'test_f1_marco_1_epoch',
+    'test_f1_marco_weight_1_epoch',
+    'test_f1_mirco_1_epoch',
+
+    'test_acc_2_epoch',
+    'test_precision_2_epoch',
+    'test_recall_2_epoch',
+    'test_f1_marco_2_epoch',
+    'test_f1_marco_weight_2_epoch',
+    'test_f1_mirco_2_epoch',
+]
+TIMES_SEP = '_times_'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    embed TEXT NOT NULL,
+    trial TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    seed TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    created REAL NOT NULL,
+    UNIQUE (model, embed, trial, repo, seed, metric)
+)
+"""
+
+
+def csv_repo(repo, seed):
+    """
+    结果 csv 的 repo 列: <repo>_times_<seed>, 没有训练次数时只有 repo
+    """
+    return repo if seed == '' else f'{repo}{TIMES_SEP}{seed}'
+
+
+def split_csv_repo(value):
+    if TIMES_SEP not in value:
+        return value, ''
+    repo, seed = value.rsplit(TIMES_SEP, 1)
+    return repo, seed
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and not math.isnan(v)
+
+
+class ResultsStore(object):
+    """
+    多个训练进程共用的结果库: SQLite WAL 模式, 每行一个 (model, embed, trial, repo, seed, metric),
+    一次训练的所有指标在一个事务中写入, 不再对整个 csv 读取后重写.
+    结果 csv 由 export_csv 从结果库中生成, 格式与原来的 output/rq1/*_out.csv 相同
+    """
+    def __init__(self, path=RESULT_DB, timeout=60.0):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # 写锁被其他进程持有时最多等待 timeout 秒
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, model, embed, trial, repo, seed, metrics, replace=True):
+        """
+        原子地写入一次训练的指标, 非数值的指标被忽略; replace=False 时保留已有的值
+        """
+        now = time.time()
+        rows = [(model, embed, trial, repo, str(seed), k, float(v), now) for k, v in metrics.items() if _is_number(v)]
+        conflict = 'DO UPDATE SET value = excluded.value, created = excluded.created' if replace else 'DO NOTHING'
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO results (model, embed, trial, repo, seed, metric, value, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                f'ON CONFLICT (model, embed, trial, repo, seed, metric) {conflict}', rows)
+        return len(rows)
+
+    def seeds(self, model, embed, trial, repo):
+        """
+        已经写入结果的训练次数
+        """
+        cur = self.conn.execute('SELECT DISTINCT seed FROM results WHERE model = ? AND embed = ? AND trial = ? AND repo = ?',
+                                (model, embed, trial, repo))
+        return {row[0] for row in cur}
+
+    def query(self, model=None, embed=None, trial=None, repo=None, metric=None):
+        """
+        返回长表: 每行一个指标, 按写入顺序排列
+        """
+        where, params = [], []
+        for name, value in (('model', model), ('embed', embed), ('trial', trial), ('repo', repo), ('metric', metric)):
+            if value is not None:
+                where.append(f'{name} = ?')
+                params.append(value)
+        sql = 'SELECT model, embed, trial, repo, seed, metric, value, id FROM results'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return pd.read_sql_query(sql + ' ORDER BY id', self.conn, params=params)
+
+    def keys(self):
+        return pd.read_sql_query('SELECT model, embed, trial, COUNT(DISTINCT repo || seed) AS runs FROM results '
+                                 'GROUP BY model, embed, trial ORDER BY model, embed, trial', self.conn)
+
+    def frame(self, model, embed, trial, columns=RESULT_COLUMNS):
+        """
+        一个 (model, embed, trial) 的结果, 与原来的结果 csv 格式相同: 每次训练一行, 按第一次写入的顺序排列.
+        columns 为 None 时输出所有指标
+        """
+        long = self.query(model=model, embed=embed, trial=trial)
+        if columns is not None:
+            long = long[long['metric'].isin(columns)]
+        if len(long) == 0:
+            return pd.DataFrame(columns=['repo'] + list(columns or []))
+        long = long.assign(repo=[csv_repo(r, s) for r, s in zip(long['repo'], long['seed'])])
+        order = long.groupby('repo')['id'].min().sort_values().index
+        wide = long.pivot(index='repo', columns='metric', values='value').reindex(order)
+        metric_columns = list(columns) if columns is not None else sorted(wide.columns)
+        return wide.reindex(columns=metric_columns).reset_index()
+
+    def export_csv(self, path, model, embed, trial, columns=RESULT_COLUMNS):
+        """
+        从结果库生成结果 csv, 先写临时文件再替换, 读取 csv 的程序不会看到写了一半的文件
+        """
+        df = self.frame(model, embed, trial, columns)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        return df
+
+    def import_csv(self, path, model, embed, trial):
+        """
+        将已有的结果 csv 导入结果库, 结果库中已有的值优先, 可以重复调用.
+        原来的脚本重新训练时直接追加行, 同一个 <repo>_times_<t> 的重复行依次导入为 <t>_dup1, <t>_dup2, ...
+        """
+        if not os.path.exists(path):
+            return 0
+        df = pd.read_csv(path)
+        count = 0
+        seen = {}
+        for row in df.to_dict(orient='records'):
+            repo, seed = split_csv_repo(str(row.pop('repo')))
+            n = seen.get((repo, seed), 0)
+            seen[(repo, seed)] = n + 1
+            if n > 0:
+                seed = f'{seed}_dup{n}' if seed != '' else f'dup{n}'
+            count += self.add(model, embed, trial, repo, seed, row, replace=False)
+        return count
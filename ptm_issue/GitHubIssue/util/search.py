@@ -0,0 +1,308 @@
+import glob
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+import pandas as pd
+
+from GitHubIssue.models.bert import PARTIAL_FINETUNE_MODELS as BERT_PARTIAL_FINETUNE_MODELS
+from GitHubIssue.models.gpt import PARTIAL_FINETUNE_MODELS as GPT_PARTIAL_FINETUNE_MODELS
+from GitHubIssue.models.gpt import SEQUENCE_MODEL_CONFIG as GPT_SEQUENCE_MODEL_CONFIG
+from GitHubIssue.models.transformer import SEQUENCE_MODEL_CONFIG as TRANSFORMER_SEQUENCE_MODEL_CONFIG
+from GitHubIssue.util.sweep import format_seconds, job_command, repo_files
+
+METRIC = 'valid_f1_marco_1_epoch'
+# 搜索空间中未给出的参数使用 train_cross.py 的默认值
+DEFAULT_SPACE = {
+    'base_lr': [5e-5],
+    'batch_size': [8],
+    'trainable_layers': [4],
+    'class_weights': [None],
+}
+
+
+def honored_dimensions(model_name, sequence):
+    """
+    train_cross.py 中模型实际使用的搜索维度. 只有 --sequence 的部分微调模型按 base_lr 和 trainable_layers 构建优化器,
+    其他情况使用固定的学习率; Transformer 不使用类别权重, textcnn/bilstm/rcnn 的 batch size 固定为 64
+    """
+    name = model_name.split('/')[-1]
+    if name in ('textcnn', 'bilstm', 'rcnn'):
+        return set()
+    if model_name in GPT_SEQUENCE_MODEL_CONFIG or name in GPT_SEQUENCE_MODEL_CONFIG:
+        if sequence and (model_name in GPT_PARTIAL_FINETUNE_MODELS or name in GPT_PARTIAL_FINETUNE_MODELS):
+            return set(DEFAULT_SPACE)
+        return {'batch_size', 'class_weights'}
+    if model_name in TRANSFORMER_SEQUENCE_MODEL_CONFIG or name in TRANSFORMER_SEQUENCE_MODEL_CONFIG:
+        return {'base_lr', 'batch_size'} if sequence else {'batch_size'}
+    if sequence and (model_name in BERT_PARTIAL_FINETUNE_MODELS or name in BERT_PARTIAL_FINETUNE_MODELS):
+        return set(DEFAULT_SPACE)
+    # Bert.configure_optimizers 只为 --sequence 的部分微调模型创建学习率调度
+    raise Exception(f"{model_name} (sequence={sequence}) can not be trained by train_cross.py, "
+                    f"use one of {BERT_PARTIAL_FINETUNE_MODELS} with sequence")
+
+
+def check_space(model_name, sequence, space):
+    """
+    搜索空间中的维度必须被模型使用, 否则不同配置的训练完全相同
+    """
+    honored = honored_dimensions(model_name, sequence)
+    ignored = sorted(k for k, v in space.items() if k not in honored and v != DEFAULT_SPACE.get(k))
+    if ignored:
+        raise Exception(f"{model_name} (sequence={sequence}) ignores search dimensions {ignored}, "
+                        f"only {sorted(honored)} can be searched")
+
+
+def rungs(min_epochs, max_epochs, eta):
+    """
+    successive halving 每一级的训练 epoch 数: min_epochs * eta^k, 最后一级为 max_epochs
+    """
+    epochs = []
+    e = min_epochs
+    while e < max_epochs:
+        epochs.append(e)
+        e *= eta
+    return epochs + [max_epochs]
+
+
+def sample_configs(space, n_trials, seed=0):
+    """
+    从搜索空间的网格中不重复地采样 n_trials 个配置, 网格小于 n_trials 时使用整个网格
+    """
+    space = {k: space.get(k, v) for k, v in DEFAULT_SPACE.items()}
+    keys = sorted(space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+    if n_trials is None or n_trials >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, n_trials)
+
+
+def config_args(config):
+    args = ['--trainable_layers', str(config['trainable_layers'])]
+    if config['class_weights'] is not None:
+        args += ['--class_weights', ','.join(str(w) for w in config['class_weights'])]
+    return args
+
+
+class SuccessiveHalving(object):
+    """
+    异步的 successive halving (ASHA): slot 空闲时优先把某一级中排名前 1/eta 且还未晋级的配置晋级到下一级,
+    否则开始一个新的配置. 晋级的配置从上一级保存的 last.ckpt 继续训练, 只需要补齐多出的 epoch.
+
+    每个配置对应 search_dir 下的一个目录, 保存 config.json, last.ckpt 和每一级的验证集分数 rung_<k>.json,
+    崩溃后重新运行同一个配置即可继续搜索
+    """
+    def __init__(self, config, slots, search_dir='output/search', log_dir=None, script='train_cross.py',
+                 cpu_threads=None, pretrained_cache=None):
+        self.config = config
+        self.slots = list(slots)
+        self.search_dir = search_dir
+        self.log_dir = log_dir or os.path.join(search_dir, 'logs')
+        self.script = script
+        # 所有配置共用的预训练权重目录
+        self.pretrained_cache = pretrained_cache
+        self.eta = config.get('eta', 3)
+        self.rungs = rungs(config.get('min_epochs', 2), config.get('max_epochs', 30), self.eta)
+        job = self.model_job()
+        check_space(job['model'], job['sequence'], config.get('space', {}))
+        self.trials = sample_configs(config.get('space', {}), config.get('n_trials', 27), config.get('seed', 0))
+        self.cpu_slots = sum(1 for d in self.slots if int(d) < 0)
+        self.cpu_threads = cpu_threads or max(1, (os.cpu_count() or 1) // max(self.cpu_slots, 1))
+        self.cond = threading.Condition()
+        self.scores = {}
+        self.running = set()
+        self.failed = {}
+        self.epochs = 0
+
+    def trial_dir(self, trial):
+        return os.path.join(self.search_dir, f'trial_{trial:03d}')
+
+    def rung_file(self, trial, rung):
+        return os.path.join(self.trial_dir(trial), f'rung_{rung}.json')
+
+    def load(self):
+        """
+        读取已经完成的配置和分数, 搜索空间改变后不能在同一个目录中继续
+        """
+        os.makedirs(self.search_dir, exist_ok=True)
+        for trial, params in enumerate(self.trials):
+            path = os.path.join(self.trial_dir(trial), 'config.json')
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved != params:
+                    raise Exception(f"{path} does not match the search space, use another search_dir")
+            for rung in range(len(self.rungs)):
+                if os.path.exists(self.rung_file(trial, rung)):
+                    with open(self.rung_file(trial, rung), 'r', encoding='utf-8') as f:
+                        self.scores[(trial, rung)] = json.load(f)[METRIC]
+
+    def started(self, trial):
+        return any((trial, 0) in s for s in (self.scores, self.running, self.failed))
+
+    def promotable(self, rung):
+        """
+        第 rung 级已完成的配置中排名前 1/eta 且还没有进入下一级的配置
+        """
+        done = sorted([(score, -trial) for (trial, r), score in self.scores.items() if r == rung], reverse=True)
+        top = [-t for _, t in done[:len(done) // self.eta]]
+        return [trial for trial in top
+                if not any((trial, rung + 1) in s for s in (self.scores, self.running, self.failed))]
+
+    def next_job(self):
+        """
+        返回下一个 (trial, rung), 高级别的晋级优先; 所有配置完成且没有可以晋级的配置时返回 None
+        """
+        with self.cond:
+            while True:
+                for rung in reversed(range(len(self.rungs) - 1)):
+                    candidates = self.promotable(rung)
+                    if candidates:
+                        self.running.add((candidates[0], rung + 1))
+                        return candidates[0], rung + 1
+                for trial in range(len(self.trials)):
+                    if not self.started(trial):
+                        self.running.add((trial, 0))
+                        return trial, 0
+                if not self.running:
+                    return None
+                # 正在运行的配置完成后可能产生新的晋级
+                self.cond.wait()
+
+    def finish(self, trial, rung, code):
+        with self.cond:
+            self.running.discard((trial, rung))
+            result_path = os.path.join(self.trial_dir(trial), 'result.json')
+            if code == 0 and os.path.exists(result_path):
+                with open(result_path, 'r', encoding='utf-8') as f:
+                    result = json.load(f)
+                os.replace(result_path, self.rung_file(trial, rung))
+                self.scores[(trial, rung)] = result[METRIC]
+            else:
+                self.failed[(trial, rung)] = code
+            self.cond.notify_all()
+
+    def model_job(self):
+        model = self.config['model']
+        job = {'embed': 'none', 'sequence': False, 'local_model': False}
+        job.update({'model': model} if isinstance(model, str) else model)
+        return job
+
+    def command(self, trial, rung, device):
+        params = self.trials[trial]
+        job = self.model_job()
+        job.update(repo_files(self.config['repo']))
+        job.update({'base_lr': params['base_lr'], 'batch_size': params['batch_size'], 'train_time': 1,
+                    'trial': f'search_{trial:03d}',
+                    'extra_args': list(self.config.get('extra_args', [])) + list(job.get('extra_args', []))})
+        # 搜索的每次训练都从头开始, 不查询结果库
+        return job_command(job, device, self.script, start_time=0) + config_args(params) + [
+            '--max_epochs', str(self.rungs[rung]), '--search_dir', self.trial_dir(trial)] + (
+            # best_command 截掉 --search_dir 之后的参数, 最优配置的完整训练不使用本次搜索的共享目录
+            ['--pretrained_cache', self.pretrained_cache] if self.pretrained_cache is not None else [])
+
+    def worker(self, device, cpu_slot=None):
+        env = dict(os.environ)
+        if int(device) < 0:
+            env['OMP_NUM_THREADS'] = str(self.cpu_threads)
+            env['MKL_NUM_THREADS'] = str(self.cpu_threads)
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            trial, rung = job
+            os.makedirs(self.trial_dir(trial), exist_ok=True)
+            with open(os.path.join(self.trial_dir(trial), 'config.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.trials[trial], f)
+            cmd = self.command(trial, rung, device)
+            if cpu_slot is not None:
+                cmd += ['--cpu_slot', str(cpu_slot), '--cpu_slots', str(self.cpu_slots)]
+            log_path = os.path.join(self.log_dir, f'trial_{trial:03d}.log')
+            start = time.time()
+            code = -1
+            with open(log_path, 'a', encoding='utf-8') as log:
+                log.write(' '.join(cmd) + '\n')
+                log.flush()
+                try:
+                    code = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+                finally:
+                    self.finish(trial, rung, code)
+            self.report(trial, rung, device, code, time.time() - start)
+
+    def report(self, trial, rung, device, code, duration):
+        with self.cond:
+            # 晋级的配置只训练多出的 epoch
+            self.epochs += self.rungs[rung] - (self.rungs[rung - 1] if rung > 0 else 0)
+            score = self.scores.get((trial, rung))
+            status = f'{METRIC} {score:.4f}' if code == 0 and score is not None else f'failed ({code})'
+            print(f"trial {trial:03d} rung {rung} ({self.rungs[rung]} epochs) on device {device} "
+                  f"in {format_seconds(duration)}: {status}, {self.trials[trial]}, "
+                  f"elapsed {format_seconds(time.time() - self.start)}, {self.epochs} epochs trained", flush=True)
+
+    def run(self, dry_run=False):
+        self.load()
+        print(f"search: {len(self.trials)} configs, rungs {self.rungs} epochs, eta {self.eta}, "
+              f"{len(self.scores)} rungs finished, slots: {self.slots}")
+        if dry_run:
+            for trial in range(len(self.trials)):
+                print(' '.join(self.command(trial, 0, self.slots[0])))
+            return self.leaderboard()
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.start = time.time()
+        workers = []
+        cpu_slot = 0
+        for device in self.slots:
+            if int(device) < 0:
+                workers.append(threading.Thread(target=self.worker, args=(device, cpu_slot), daemon=True))
+                cpu_slot += 1
+            else:
+                workers.append(threading.Thread(target=self.worker, args=(device,), daemon=True))
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        full = len(self.trials) * self.rungs[-1]
+        print(f"search finished in {format_seconds(time.time() - self.start)}, {self.epochs} epochs trained "
+              f"({full} for the full grid), {len(self.failed)} failed")
+        return self.leaderboard()
+
+    def leaderboard(self):
+        """
+        按达到的最高级别和该级别的分数排序, 保存为 search_dir/leaderboard.csv
+        """
+        rows = []
+        for trial, params in enumerate(self.trials):
+            reached = [r for r in range(len(self.rungs)) if (trial, r) in self.scores]
+            if not reached:
+                continue
+            row = {'trial': trial, 'rung': reached[-1], 'epochs': self.rungs[reached[-1]],
+                   METRIC: self.scores[(trial, reached[-1])]}
+            row.update({k: (json.dumps(v) if isinstance(v, list) else v) for k, v in params.items()})
+            rows.append(row)
+        if not rows:
+            return None
+        df = pd.DataFrame(rows).sort_values(['rung', METRIC], ascending=False).reset_index(drop=True)
+        df.to_csv(os.path.join(self.search_dir, 'leaderboard.csv'), index=False)
+        print(df.head(10).to_string(index=False))
+        return df
+
+    def clean(self):
+        """
+        删除搜索过程中保存的 last.ckpt, 保留配置和分数
+        """
+        for path in glob.glob(os.path.join(self.search_dir, 'trial_*', '*.ckpt')):
+            os.remove(path)
+
+    def best_command(self, leaderboard, device=0):
+        """
+        最优配置完整训练并评估测试集的命令
+        """
+        if leaderboard is None:
+            return None
+        trial = int(leaderboard.loc[0, 'trial'])
+        cmd = self.command(trial, len(self.rungs) - 1, device)
+        return cmd[:cmd.index('--search_dir')]
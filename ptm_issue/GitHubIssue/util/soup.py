@@ -0,0 +1,153 @@
+import os
+import re
+
+import numpy as np
+import torch
+
+from GitHubIssue.metrics.topk import topk_metrics
+from GitHubIssue.util.delta_ckpt import DELTA_KEY, load_checkpoint_state
+from GitHubIssue.util.evaluation import EvaluationEngine
+
+MONITOR = 'valid_f1_marco_1_epoch'
+# soup checkpoint 中保留的 Lightning checkpoint 字段, 优化器等训练状态不保留
+CHECKPOINT_FIELDS = ('pytorch-lightning_version', 'hyper_parameters', DELTA_KEY)
+
+
+def load_ingredients(paths):
+    """
+    读取同一个配置多次训练的最优 checkpoint, 超参数, 预训练 base 或参数形状不同时报错
+    """
+    checkpoints = [torch.load(path, map_location='cpu') for path in paths]
+    first = checkpoints[0]
+    for path, checkpoint in zip(paths[1:], checkpoints[1:]):
+        if checkpoint.get('hyper_parameters') != first.get('hyper_parameters'):
+            raise Exception(f"{path} has different hyper_parameters from {paths[0]}")
+        base, first_base = checkpoint.get(DELTA_KEY), first.get(DELTA_KEY)
+        if (base is None) != (first_base is None) or (
+                base is not None and (base['pretrained'] != first_base['pretrained'] or base['keys'] != first_base['keys'])):
+            raise Exception(f"{path} is saved on a different pretrained base from {paths[0]}")
+        state, first_state = checkpoint['state_dict'], first['state_dict']
+        if state.keys() != first_state.keys() or any(state[k].shape != first_state[k].shape for k in state):
+            raise Exception(f"{path} has different parameters from {paths[0]}")
+    return checkpoints
+
+
+def average_states(states):
+    """
+    state_dict 的均匀平均, 浮点参数按 float32 累加后转回原来的类型, 整数 buffer (如 position_ids) 使用第一个的值
+    """
+    averaged = {}
+    for k, v in states[0].items():
+        if not torch.is_floating_point(v):
+            averaged[k] = v.clone()
+            continue
+        total = v.float().clone()
+        for state in states[1:]:
+            total += state[k].float()
+        averaged[k] = (total / len(states)).to(v.dtype)
+    return averaged
+
+
+def soup_checkpoint(template, state, method, ingredients):
+    """
+    与输入相同格式的 checkpoint, 可以直接用 load_checkpoint_model 和 export_quantized.py 加载
+    """
+    checkpoint = {k: template[k] for k in CHECKPOINT_FIELDS if k in template}
+    checkpoint['state_dict'] = state
+    checkpoint['soup'] = {'method': method, 'ingredients': list(ingredients)}
+    return checkpoint
+
+
+def default_soup_path(ckpt_path):
+    """
+    --keep_ckpt 保存的 <name>_times_<t>.ckpt 对应 <name>-soup.ckpt
+    """
+    stem = re.sub(r'_times_\d+$', '', os.path.splitext(ckpt_path)[0])
+    return stem + '-soup.ckpt'
+
+
+class ModelSoup(object):
+    """
+    权重空间的模型平均 (model soup): 同一个配置多次训练得到的模型参数取平均, 推理代价与单个模型相同.
+
+    uniform 对所有模型取平均; greedy 按验证集 macro f1 从高到低依次尝试加入, 只保留使验证集分数不下降的模型.
+    delta checkpoint 中只平均可训练的参数, 冻结的参数在各次训练中相同, 由预训练模型补齐
+    """
+    def __init__(self, model, paths, valid_loader, test_loader, all_labels):
+        self.model = model
+        self.paths = list(paths)
+        self.checkpoints = load_ingredients(self.paths)
+        self.valid_loader = valid_loader
+        self.test_loader = test_loader
+        self.all_labels = list(all_labels)
+        self.valid_scores = None
+        self.test_engines = None
+
+    def load(self, state):
+        # from_delta 会修改 checkpoint, 每次使用新的 dict
+        checkpoint = {k: v for k, v in self.checkpoints[0].items() if k != 'state_dict'}
+        checkpoint['state_dict'] = dict(state)
+        load_checkpoint_state(self.model, checkpoint)
+        return self.model
+
+    def evaluate(self, state, stage):
+        loader = self.valid_loader if stage == 'valid' else self.test_loader
+        return EvaluationEngine(stage, self.all_labels).run(self.load(state), loader)
+
+    def state(self, indices):
+        return average_states([self.checkpoints[i]['state_dict'] for i in indices])
+
+    def rank(self):
+        """
+        每个模型单独在验证集上的分数, 以及测试集的评估结果
+        """
+        if self.valid_scores is None:
+            self.valid_scores, self.test_engines = [], []
+            for checkpoint in self.checkpoints:
+                self.valid_scores.append(self.evaluate(checkpoint['state_dict'], 'valid').metrics()[MONITOR])
+                self.test_engines.append(self.evaluate(checkpoint['state_dict'], 'test'))
+        return sorted(range(len(self.checkpoints)), key=lambda i: -self.valid_scores[i])
+
+    def uniform(self):
+        indices = list(range(len(self.checkpoints)))
+        state = self.state(indices)
+        return indices, state, self.evaluate(state, 'valid').metrics()[MONITOR]
+
+    def greedy(self):
+        order = self.rank()
+        indices = [order[0]]
+        best_score = self.valid_scores[order[0]]
+        for i in order[1:]:
+            score = self.evaluate(self.state(indices + [i]), 'valid').metrics()[MONITOR]
+            print(f"greedy soup: add {self.paths[i]}, {MONITOR} {score:.4f} (current {best_score:.4f})")
+            if score >= best_score:
+                indices.append(i)
+                best_score = score
+        return indices, self.state(indices), best_score
+
+    def run(self, save='greedy', out_path=None):
+        """
+        返回每个模型, logits 平均的集成和两种 soup 在测试集上的指标, 并保存 save 指定的 soup
+        """
+        order = self.rank()
+        rows = []
+        for i in order:
+            rows.append({'model': os.path.basename(self.paths[i]), 'ingredients': 1, MONITOR: self.valid_scores[i],
+                         **self.test_engines[i].metrics()})
+        # 输出空间的集成需要 N 次推理, 作为 soup 的参照
+        labels = self.test_engines[0].labels
+        logits = np.mean([engine.logits for engine in self.test_engines], axis=0)
+        rows.append({'model': 'logit_ensemble', 'ingredients': len(order), MONITOR: None,
+                     **topk_metrics(logits, labels, len(self.all_labels), 'test')})
+        soups = {}
+        for method in ('uniform', 'greedy'):
+            indices, state, score = getattr(self, method)()
+            soups[method] = (indices, state)
+            rows.append({'model': f'{method}_soup', 'ingredients': len(indices), MONITOR: score,
+                         **self.evaluate(state, 'test').metrics()})
+        if out_path is not None:
+            indices, state = soups[save]
+            os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+            torch.save(soup_checkpoint(self.checkpoints[0], state, save, [self.paths[i] for i in indices]), out_path)
+            print(f"save {save} soup of {len(indices)} checkpoints to {out_path}")
+        return rows
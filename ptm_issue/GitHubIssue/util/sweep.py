@@ -0,0 +1,222 @@
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from GitHubIssue.util.results_store import RESULT_DB, ResultsStore
+
+RESULT_DIR = 'output/rq1'
+SPLIT_PATTERN = './my_data/{split}/{repo}_{SPLIT}_Aug/{repo}_{SPLIT}_Aug.txt'
+
+
+def result_model(model, local_model=False):
+    """
+    结果中的模型名称, 本地模型只保留目录名
+    """
+    if local_model:
+        model = model.split('/')[-1]
+    return model
+
+
+def result_csv(model, embed, trial, local_model=False):
+    """
+    train_cross.py 保存测试集指标的 csv 文件
+    """
+    model = result_model(model, local_model)
+    return f"{RESULT_DIR}/{model.replace('-', '_').replace('/', '_')}_{embed}_{trial}_out.csv"
+
+
+def repo_name(train_file):
+    return train_file.split('/')[-1].split('.')[0]
+
+
+def repo_files(repo):
+    """
+    repo 可以是 train/valid/test 三个文件的字典, 也可以是 my_data 下的仓库名
+    """
+    if isinstance(repo, dict):
+        return {k: repo[k] for k in ('train_file', 'valid_file', 'test_file')}
+    return {f'{split}_file': SPLIT_PATTERN.format(split=split, SPLIT=split.upper(), repo=repo)
+            for split in ('train', 'valid', 'test')}
+
+
+def expand_grid(config):
+    """
+    将配置中的网格展开为任务列表, 每个任务对应一次 train_cross.py 的调用
+
+    models 中的每一项可以是模型名称, 也可以是包含 model / embed / sequence / local_model 等参数的字典,
+    trial 会用任务的参数格式化, 例如 "sweep_lr{base_lr}_bs{batch_size}", 避免不同学习率的结果写入同一个 csv
+    """
+    jobs = []
+    for model, repo, base_lr, batch_size, trial in itertools.product(
+            config['models'], config['repos'], config.get('base_lr', [5e-5]),
+            config.get('batch_size', [8]), config.get('trial', ['trial'])):
+        job = {'embed': 'none', 'sequence': False, 'local_model': False}
+        job.update({'model': model} if isinstance(model, str) else model)
+        job.update(repo_files(repo))
+        job['base_lr'] = base_lr
+        job['batch_size'] = batch_size
+        job['train_time'] = config.get('train_time', 1)
+        job['extra_args'] = list(config.get('extra_args', [])) + list(job.get('extra_args', []))
+        job['trial'] = trial.format(**job)
+        jobs.append(job)
+
+    seen = {}
+    for job in jobs:
+        key = (job_csv(job), repo_name(job['train_file']))
+        if key in seen:
+            raise Exception(f"jobs {job_name(seen[key])} and {job_name(job)} write the same rows of {key[0]}, "
+                            f"add {{base_lr}} / {{batch_size}} to trial")
+        seen[key] = job
+    return jobs
+
+
+def job_csv(job):
+    return result_csv(job['model'], job['embed'], job['trial'], job['local_model'])
+
+
+def job_name(job):
+    model = job['model'].split('/')[-1] if job['local_model'] else job['model'].replace('/', '_')
+    return f"{model}_{job['embed']}_{job['trial']}_{repo_name(job['train_file'])}"
+
+
+def finished_times(job, results_db=RESULT_DB):
+    """
+    已经写入结果库的训练次数, train_cross.py 每训练一次写入一组 (repo, seed=t) 的指标
+    """
+    store = ResultsStore(results_db)
+    try:
+        model = result_model(job['model'], job['local_model'])
+        store.import_csv(job_csv(job), model, job['embed'], job['trial'])
+        seeds = store.seeds(model, job['embed'], job['trial'], repo_name(job['train_file']))
+    finally:
+        store.close()
+    t = 0
+    while t < job['train_time'] and str(t) in seeds:
+        t += 1
+    return t
+
+
+def job_command(job, device, script='train_cross.py', pretrained_cache=None, start_time=None):
+    """
+    start_time 为 None 时从结果库中已完成的训练次数继续
+    """
+    if start_time is None:
+        start_time = finished_times(job)
+    cmd = [sys.executable, script,
+           '--model', job['model'], '--embed', job['embed'], '--device', str(device),
+           '--train_file', job['train_file'], '--valid_file', job['valid_file'], '--test_file', job['test_file'],
+           '--base_lr', str(job['base_lr']), '--batch_size', str(job['batch_size']), '--trial', job['trial'],
+           '--train_time', str(job['train_time']), '--start_time', str(start_time)]
+    if job['sequence']:
+        cmd.append('--sequence')
+    if job['local_model']:
+        cmd.append('--local_model')
+    if pretrained_cache is not None:
+        cmd += ['--pretrained_cache', pretrained_cache]
+    return cmd + [str(arg) for arg in job['extra_args']]
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class SweepScheduler(object):
+    """
+    按 slot 并行执行任务: 每个 slot 是一个设备 (GPU 编号, -1 为 CPU), 同一设备可以出现多次.
+    已经有结果的任务会被跳过, 崩溃后重新运行同一个配置即可从未完成的任务继续
+    """
+    def __init__(self, jobs, slots, log_dir='logs/sweep', script='train_cross.py', cpu_threads=None, pretrained_cache=None):
+        self.jobs = jobs
+        self.slots = list(slots)
+        self.log_dir = log_dir
+        self.script = script
+        # 所有任务共用的预训练权重目录
+        self.pretrained_cache = pretrained_cache
+        self.cpu_slots = sum(1 for d in self.slots if int(d) < 0)
+        # CPU slot 平分 CPU 核心, 避免多个任务的线程互相抢占
+        self.cpu_threads = cpu_threads or max(1, (os.cpu_count() or 1) // max(self.cpu_slots, 1))
+        self.lock = threading.Lock()
+        self.failed = []
+        self.durations = []
+
+    def pending(self):
+        return [job for job in self.jobs if finished_times(job) < job['train_time']]
+
+    def run(self, dry_run=False):
+        pending = self.pending()
+        print(f"sweep: {len(self.jobs)} jobs, {len(self.jobs) - len(pending)} finished, {len(pending)} pending, "
+              f"slots: {self.slots}")
+        if dry_run:
+            for job in pending:
+                print(' '.join(job_command(job, self.slots[0], self.script, self.pretrained_cache)))
+            return []
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.queue = list(pending)
+        self.total = len(pending)
+        self.start = time.time()
+        workers = []
+        cpu_slot = 0
+        for device in self.slots:
+            if int(device) < 0:
+                # 每个 CPU slot 绑定到一组按 NUMA 节点切分的核心上
+                workers.append(threading.Thread(target=self.worker, args=(device, cpu_slot), daemon=True))
+                cpu_slot += 1
+            else:
+                workers.append(threading.Thread(target=self.worker, args=(device,), daemon=True))
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        print(f"sweep finished in {format_seconds(time.time() - self.start)}, {len(self.failed)} failed")
+        for job, code, log_path in self.failed:
+            print(f"  failed ({code}): {job_name(job)}, log: {log_path}")
+        return self.failed
+
+    def next_job(self):
+        """
+        结果写入结果库, 写同一个结果 csv 的任务也可以同时运行
+        """
+        with self.lock:
+            return self.queue.pop(0) if self.queue else None
+
+    def worker(self, device, cpu_slot=None):
+        env = dict(os.environ)
+        if int(device) < 0:
+            env['OMP_NUM_THREADS'] = str(self.cpu_threads)
+            env['MKL_NUM_THREADS'] = str(self.cpu_threads)
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            log_path = os.path.join(self.log_dir, job_name(job) + '.log')
+            cmd = job_command(job, device, self.script, self.pretrained_cache)
+            if cpu_slot is not None:
+                cmd += ['--cpu_slot', str(cpu_slot), '--cpu_slots', str(self.cpu_slots)]
+            start = time.time()
+            with open(log_path, 'a', encoding='utf-8') as log:
+                log.write(' '.join(cmd) + '\n')
+                log.flush()
+                code = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+            self.report(job, device, code, time.time() - start, log_path)
+
+    def report(self, job, device, code, duration, log_path):
+        with self.lock:
+            self.durations.append(duration)
+            if code != 0:
+                self.failed.append((job, code, log_path))
+            done = len(self.durations)
+            # 剩余任务按已完成任务的平均耗时和 slot 数估计
+            eta = sum(self.durations) / done * (self.total - done) / len(self.slots)
+            status = 'done' if code == 0 else f'failed ({code})'
+            print(f"[{done}/{self.total}] {status} on device {device} in {format_seconds(duration)}: {job_name(job)}, "
+                  f"elapsed {format_seconds(time.time() - self.start)}, eta {format_seconds(eta)}", flush=True)
+
+
+def load_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import torch
+
+from GitHubIssue.metrics.accuracy import MultiLabelAccuracy
+from GitHubIssue.metrics.precision import MultiLabelPrecision
+from GitHubIssue.metrics.recall import MultiLabelRecall
+
+
+def loop_update(preds, target, top_k):
+    """
+    原来逐样本循环的实现, 返回 (accuracy, precision, recall) 三个指标在这个 batch 上的 correct
+    """
+    num_classes = preds.size(-1)
+    if top_k == 1:
+        indices = preds.max(-1)[1].unsqueeze(-1)
+    else:
+        indices = preds.topk(min(top_k, num_classes), -1)[1]
+    batch_size = preds.shape[0]
+    preds_bin = torch.zeros(batch_size, num_classes, dtype=torch.long, device=target.device)
+    for i in range(batch_size):
+        preds_bin[i, indices[i]] = 1
+    correct = torch.sum(preds_bin & target, -1)
+
+    acc = torch.sum((correct != 0).long()).float()
+    precision = torch.sum(correct.float() / torch.full((batch_size,), top_k, dtype=torch.float32, device=target.device))
+    recall = torch.tensor(0, dtype=torch.float, device=target.device)
+    for i in range(batch_size):
+        if torch.sum(target[i, :]).item() == 0:
+            continue
+        recall += correct[i].float() / min(top_k, torch.sum(target[i, :]))
+    return acc, precision, recall
+
+
+def timeit(fn, steps, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Metric benchmark parameters.')
+    parser.add_argument('--device', default=0, type=int, required=False, help='使用的实验设备, -1:CPU, >=0:GPU')
+    parser.add_argument('--num_classes', default=5, type=int, required=False, help='类别数')
+    parser.add_argument('--batch_sizes', default='8,32,64', type=str, required=False, help='batch size, 逗号分隔')
+    parser.add_argument('--steps', default=200, type=int, required=False, help='每个设置重复的step数')
+    args = parser.parse_args()
+
+    device = torch.device(f'cuda:{args.device}' if args.device >= 0 and torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        preds = torch.rand(batch_size, args.num_classes, device=device)
+        target = torch.nn.functional.one_hot(torch.randint(args.num_classes, (batch_size,), device=device),
+                                             args.num_classes).long()
+        # 有一个样本没有标签, 覆盖 recall 中跳过的分支
+        target[0] = 0
+        for top_k in (1, 2):
+            metrics = [MultiLabelAccuracy(top_k=top_k).to(device), MultiLabelPrecision(top_k=top_k).to(device),
+                       MultiLabelRecall(top_k=top_k).to(device)]
+            expected = loop_update(preds, target, top_k)
+            for metric, value in zip(metrics, expected):
+                metric.update(preds, target)
+                if not torch.allclose(metric.correct, value):
+                    raise Exception(f"{type(metric).__name__} differs: {metric.correct.item()} != {value.item()}")
+
+            def vectorized():
+                for metric in metrics:
+                    metric.update(preds, target)
+
+            loop_ms = timeit(lambda: loop_update(preds, target, top_k), args.steps, device)
+            vectorized_ms = timeit(vectorized, args.steps, device)
+            print(f"device: {device}, batch_size: {batch_size}, top_k: {top_k}, "
+                  f"loop: {loop_ms:.3f} ms/step, vectorized: {vectorized_ms:.3f} ms/step, speedup: {loop_ms / vectorized_ms:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import argparse
+
+import torch
+import torchmetrics
+
+from GitHubIssue.metrics.accuracy import MultiLabelAccuracy
+from GitHubIssue.metrics.classification import IssueClassificationMetrics
+
+
+def reference_metrics(num_classes, stage, top_ks=(1, 2)):
+    """
+    IssueClassificationMetrics 之前每个模型使用的指标, 名称与 IssueClassificationMetrics 输出的指标相同 (不含后缀)
+    """
+    metrics = {}
+    for k in top_ks:
+        metrics[f"{stage}_acc_{k}"] = MultiLabelAccuracy(top_k=k)
+        metrics[f"{stage}_precision_{k}"] = torchmetrics.Precision(top_k=k)
+        metrics[f"{stage}_recall_{k}"] = torchmetrics.Recall(top_k=k)
+        metrics[f"{stage}_f1_marco_{k}"] = torchmetrics.F1(average='macro', num_classes=num_classes, top_k=k)
+        metrics[f"{stage}_f1_marco_weight_{k}"] = torchmetrics.F1(average='weighted', num_classes=num_classes, top_k=k)
+        metrics[f"{stage}_f1_mirco_{k}"] = torchmetrics.F1(average='micro', num_classes=num_classes, top_k=k)
+    return metrics
+
+
+def compare(values, expected, where, atol):
+    for name, value in expected.items():
+        if not torch.allclose(values[name].float().cpu(), value.float().cpu(), atol=atol):
+            raise Exception(f"{name} differs at {where}: {values[name].item()} != {value.item()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Metric equality check parameters.')
+    parser.add_argument('--device', default=-1, type=int, required=False, help='使用的实验设备, -1:CPU, >=0:GPU')
+    parser.add_argument('--num_classes', default='3,5', type=str, required=False, help='类别数, 逗号分隔, torchmetrics 要求大于 top_k, 至少为 3')
+    parser.add_argument('--batch_size', default=8, type=int, required=False, help='batch size')
+    parser.add_argument('--batches', default=20, type=int, required=False, help='每个 epoch 的 batch 数')
+    parser.add_argument('--trials', default=20, type=int, required=False, help='每个类别数重复的 epoch 数')
+    parser.add_argument('--atol', default=1e-6, type=float, required=False, help='允许的绝对误差')
+    args = parser.parse_args()
+
+    device = torch.device(f'cuda:{args.device}' if args.device >= 0 and torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    for num_classes in [int(x) for x in args.num_classes.split(',')]:
+        for trial in range(args.trials):
+            metrics = IssueClassificationMetrics(num_classes, 'test').to(device)
+            reference = {name: metric.to(device) for name, metric in reference_metrics(num_classes, 'test').items()}
+            # 每个 issue 只有一个标签, 部分 epoch 中类别不均衡, 覆盖某个类别没有样本或没有被预测的情况
+            weights = torch.rand(num_classes) ** (trial % 4 + 1)
+            for batch in range(args.batches):
+                logits = torch.randn(args.batch_size, num_classes, device=device)
+                labels = torch.multinomial(weights, args.batch_size, replacement=True).to(device)
+                target = torch.nn.functional.one_hot(labels, num_classes).long()
+                # 与训练时相同, 指标使用 softmax 之后的概率
+                preds = torch.nn.functional.softmax(logits, dim=-1)
+                values = metrics.step(preds, target)
+                compare(values, {f"{name}_step": metric(preds, target) for name, metric in reference.items()},
+                        f"num_classes {num_classes}, trial {trial}, batch {batch}", args.atol)
+            compare(metrics.compute(), {f"{name}_epoch": metric.compute() for name, metric in reference.items()},
+                    f"num_classes {num_classes}, trial {trial}, epoch", args.atol)
+        print(f"device: {device}, num_classes: {num_classes}, {args.trials} epochs of {args.batches} batches: "
+              f"all {len(reference)} metrics are equal")
+
+
+if __name__ == '__main__':
+    main()
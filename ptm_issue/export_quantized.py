@@ -0,0 +1,90 @@
+import argparse
+import os
+
+import pandas as pd
+import torch
+
+from GitHubIssue.dataset.batching import DynamicPaddingCollator
+from GitHubIssue.dataset.issue_dataset import IssueDataset
+from GitHubIssue.metrics.topk import topk_metrics
+from GitHubIssue.tokenizer.pretrained import load_tokenizer
+from GitHubIssue.util.export import (load_checkpoint_model, predict_logits,
+                                     quantize_int8, save_artifact,
+                                     serialized_size, strip_training_state)
+from GitHubIssue.util.pipeline import Pipeline, collect_labels
+
+
+def export_single(ckpt_path, train_file, valid_file, test_file, out_path, model_path=None, batch_size=8,
+                  pipeline_dir=None):
+    """
+    加载最优 checkpoint, 对 Linear 层做动态 int8 量化后导出, 并在测试集上对比量化前后的指标
+    """
+    model = strip_training_state(load_checkpoint_model(ckpt_path, model_path))
+    local_model = model.hparams.get('local_model', False)
+    model_name = model_path if local_model else model.hparams['model_name']
+    tokenizer = load_tokenizer(model_name, local_model)
+
+    # 与 train_cross.py 相同的数据划分
+    train_data, valid_data, test_data = Pipeline(pipeline_dir).split(train_file, valid_file, test_file,
+                                                                     test_size=0.3, valid_size=0.2)
+    all_labels = collect_labels(train_data, valid_data, test_data)
+    print(f"all_labels:{all_labels}")
+
+    quantized = quantize_int8(model)
+    save_artifact(out_path, quantized, all_labels, model_name)
+    print(f"save int8 model to {out_path}")
+
+    test_dataset = IssueDataset(test_data, all_labels, tokenizer, compact=True)
+    collate_fn = DynamicPaddingCollator(padding_side=tokenizer.padding_side, pad_token_id=tokenizer.pad_token_id)
+    fp32_logits, fp32_latency = predict_logits(model, test_dataset, collate_fn, batch_size)
+    int8_logits, int8_latency = predict_logits(quantized, test_dataset, collate_fn, batch_size)
+
+    fp32_metrics = topk_metrics(fp32_logits, test_dataset.labels, len(all_labels))
+    int8_metrics = topk_metrics(int8_logits, test_dataset.labels, len(all_labels))
+    report = {
+        'metric': list(fp32_metrics.keys()),
+        'fp32': list(fp32_metrics.values()),
+        'int8': [int8_metrics[k] for k in fp32_metrics.keys()],
+    }
+    report = pd.DataFrame(report)
+    report['drift'] = report['int8'] - report['fp32']
+    extra = pd.DataFrame({
+        'metric': ['prediction_agreement', 'latency_per_issue_ms', 'model_size_mb'],
+        'fp32': [1.0, fp32_latency * 1000, serialized_size(model.state_dict()) / 2 ** 20],
+        'int8': [float((fp32_logits.argmax(axis=1) == int8_logits.argmax(axis=1)).mean()), int8_latency * 1000,
+                 serialized_size(quantized.state_dict()) / 2 ** 20],
+    })
+    extra['drift'] = extra['int8'] - extra['fp32']
+    report = pd.concat([report, extra], ignore_index=True)
+    print(report.to_string(index=False))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export parameters.')
+    parser.add_argument('--ckpt', type=str, required=True, help='ModelCheckpoint保存的checkpoint路径')
+    parser.add_argument('--model', type=str, required=False, help='本地模型路径, 使用本地模型训练时需要指定')
+    parser.add_argument('--train_file', type=str, help='训练数据')
+    parser.add_argument('--valid_file', type=str, help='验证数据')
+    parser.add_argument('--test_file', type=str, help='测试数据')
+    parser.add_argument('--out', type=str, help='int8模型的保存路径, 默认保存在checkpoint同一目录')
+    parser.add_argument('--batch_size', default=8, type=int, required=False, help='评估时的batch size')
+    parser.add_argument('--threads', default=0, type=int, required=False, help='CPU推理线程数, 0:使用torch默认值')
+    parser.add_argument('--pipeline_dir', default='./cache/pipeline', type=str, required=False, help='数据划分的缓存目录, none:不使用缓存')
+
+    args = parser.parse_args()
+    print('args:\n' + args.__repr__())
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    valid_file = args.valid_file if args.valid_file is not None else args.train_file
+    test_file = args.test_file if args.test_file is not None else args.train_file
+    out_path = args.out if args.out is not None else os.path.splitext(args.ckpt)[0] + '-int8.pt'
+    report = export_single(args.ckpt, args.train_file, valid_file, test_file, out_path, args.model, args.batch_size,
+                           pipeline_dir=None if args.pipeline_dir.lower() == 'none' else args.pipeline_dir)
+    report.to_csv(os.path.splitext(out_path)[0] + '_drift.csv', index=False)
+
+
+if __name__ == '__main__':
+    main()
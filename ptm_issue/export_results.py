@@ -0,0 +1,28 @@
+import argparse
+
+from GitHubIssue.util.results_store import RESULT_DB, ResultsStore
+from GitHubIssue.util.sweep import result_csv
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export results.')
+    parser.add_argument('--results_db', default=RESULT_DB, type=str, required=False, help='SQLite结果库')
+    parser.add_argument('--model', default=None, type=str, required=False, help='模型名称, 不指定时列出结果库中所有的 (model, embed, trial)')
+    parser.add_argument('--embed', default='none', type=str, required=False, help='词嵌入')
+    parser.add_argument('--trial', default='trial', type=str, required=False, help='训练名称')
+    parser.add_argument('--out', default=None, type=str, required=False, help='输出的csv, 默认为output/rq1中对应的结果csv')
+    parser.add_argument('--all_metrics', action='store_true', help='输出所有指标, 默认只输出rq1结果csv中的指标')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.results_db)
+    if args.model is None:
+        print(store.keys().to_string(index=False))
+        return
+    out = args.out or result_csv(args.model, args.embed, args.trial)
+    kwargs = {'columns': None} if args.all_metrics else {}
+    df = store.export_csv(out, args.model, args.embed, args.trial, **kwargs)
+    print(f"export {len(df)} rows to {out}")
+
+
+if __name__ == '__main__':
+    main()
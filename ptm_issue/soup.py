@@ -0,0 +1,77 @@
+import argparse
+import os
+
+import pandas as pd
+from torch.utils.data import DataLoader
+
+from GitHubIssue.dataset.batching import DynamicPaddingCollator
+from GitHubIssue.dataset.issue_dataset import IssueDataset
+from GitHubIssue.tokenizer.pretrained import load_tokenizer
+from GitHubIssue.util.device import setup_device, torch_device
+from GitHubIssue.util.export import load_checkpoint_model
+from GitHubIssue.util.pipeline import Pipeline, collect_labels
+from GitHubIssue.util.soup import ModelSoup, default_soup_path
+
+
+def soup_single(ckpt_paths, train_file, valid_file, test_file, out_path, model_path=None, batch_size=8, device=0,
+                save='greedy', cache_dir=None, pipeline_dir=None):
+    """
+    对同一个配置多次训练 (--train_time, --keep_ckpt) 的最优 checkpoint 做 uniform 和 greedy 权重平均,
+    在验证集上排序, 保存一个 soup checkpoint, 返回测试集指标
+    """
+    model = load_checkpoint_model(ckpt_paths[0], model_path).to(torch_device(device))
+    local_model = model.hparams.get('local_model', False)
+    model_name = model_path if local_model else model.hparams['model_name']
+    tokenizer = load_tokenizer(model_name, local_model)
+
+    # 与 train_cross.py 相同的数据划分
+    train_data, valid_data, test_data = Pipeline(pipeline_dir).split(train_file, valid_file, test_file,
+                                                                     test_size=0.3, valid_size=0.2)
+    all_labels = collect_labels(train_data, valid_data, test_data)
+    print(f"all_labels:{all_labels}")
+
+    valid_dataset = IssueDataset(valid_data, all_labels, tokenizer, cache_dir=cache_dir, compact=True)
+    test_dataset = IssueDataset(test_data, all_labels, tokenizer, cache_dir=cache_dir, compact=True)
+    collate_fn = DynamicPaddingCollator(padding_side=tokenizer.padding_side, pad_token_id=tokenizer.pad_token_id)
+    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, collate_fn=collate_fn)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, collate_fn=collate_fn)
+
+    rows = ModelSoup(model, ckpt_paths, valid_loader, test_loader, all_labels).run(save, out_path)
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model soup parameters.')
+    parser.add_argument('--ckpt', type=str, nargs='+', required=True, help='同一个配置多次训练保存的最优checkpoint, 由train_cross.py --keep_ckpt保存')
+    parser.add_argument('--model', type=str, required=False, help='本地模型路径, 使用本地模型训练时需要指定')
+    parser.add_argument('--train_file', type=str, help='训练数据')
+    parser.add_argument('--valid_file', type=str, help='验证数据')
+    parser.add_argument('--test_file', type=str, help='测试数据')
+    parser.add_argument('--out', type=str, help='soup checkpoint的保存路径, 默认为<name>-soup.ckpt')
+    parser.add_argument('--save', default='greedy', choices=['greedy', 'uniform'], help='保存的soup')
+    parser.add_argument('--batch_size', default=8, type=int, required=False, help='评估时的batch size')
+    parser.add_argument('--device', default=0, type=int, required=False, help='使用的实验设备, -1:CPU, >=0:GPU')
+    parser.add_argument('--num_threads', default=None, type=int, required=False, help='CPU评估时的intra-op线程数')
+    parser.add_argument('--cache_dir', default='./cache/dataset', type=str, required=False, help='tokenize结果缓存目录, none:不使用缓存')
+    parser.add_argument('--pipeline_dir', default='./cache/pipeline', type=str, required=False, help='数据划分的缓存目录, none:不使用缓存')
+
+    args = parser.parse_args()
+    setup_device(args.device, args.num_threads)
+    print('args:\n' + args.__repr__())
+
+    if len(args.ckpt) < 2:
+        raise Exception("model soup needs at least 2 checkpoints")
+    valid_file = args.valid_file if args.valid_file is not None else args.train_file
+    test_file = args.test_file if args.test_file is not None else args.train_file
+    out_path = args.out if args.out is not None else default_soup_path(args.ckpt[0])
+    report = soup_single(args.ckpt, args.train_file, valid_file, test_file, out_path, args.model, args.batch_size,
+                         args.device, args.save,
+                         cache_dir=None if args.cache_dir.lower() == 'none' else args.cache_dir,
+                         pipeline_dir=None if args.pipeline_dir.lower() == 'none' else args.pipeline_dir)
+    report.to_csv(os.path.splitext(out_path)[0] + '_report.csv', index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import argparse
+
+from GitHubIssue.util.pretrained_cache import clear_shared, shared_dir
+from GitHubIssue.util.sweep import SweepScheduler, expand_grid, load_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep parameters.')
+    parser.add_argument('--config', type=str, required=True, help='网格配置文件 (json)')
+    parser.add_argument('--slots', default='0', type=str, required=False, help='并行的slot, 逗号分隔的设备编号, -1:CPU, 例如 0,0,1,-1')
+    parser.add_argument('--cpu_threads', default=None, type=int, required=False, help='每个CPU slot的线程数, 默认平分CPU核心')
+    parser.add_argument('--log_dir', default='logs/sweep', type=str, required=False, help='每个任务的日志目录')
+    parser.add_argument('--script', default='train_cross.py', type=str, required=False, help='训练脚本')
+    parser.add_argument('--dry_run', action='store_true', help='只打印未完成任务的命令')
+    parser.add_argument('--pretrained_cache', default=None, type=str, required=False, help='任务之间共享预训练权重的目录, 默认为/dev/shm下本次运行单独的目录, none:每个任务只在进程内缓存')
+    parser.add_argument('--keep_pretrained_cache', action='store_true', help='结束后保留共享的预训练权重')
+    args = parser.parse_args()
+    pretrained_cache = args.pretrained_cache if args.pretrained_cache is not None else shared_dir()
+    if pretrained_cache is not None and pretrained_cache.lower() == 'none':
+        pretrained_cache = None
+
+    jobs = expand_grid(load_config(args.config))
+    scheduler = SweepScheduler(jobs, [int(x) for x in args.slots.split(',')], log_dir=args.log_dir,
+                               script=args.script, cpu_threads=args.cpu_threads, pretrained_cache=pretrained_cache)
+    try:
+        failed = scheduler.run(dry_run=args.dry_run)
+    finally:
+        # 中断时也删除, /dev/shm 中的文件在进程退出后不会释放
+        if not args.keep_pretrained_cache and pretrained_cache is not None:
+            clear_shared(pretrained_cache)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
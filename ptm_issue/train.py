@@ -4,7 +4,6 @@ import random
 import glob
 import tqdm
 import os
-import pandas as pd
 import torch
 import numpy as np
 from sklearn.metrics import classification_report
@@ -15,6 +14,8 @@ import pytorch_lightning as pl
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 
 
+from GitHubIssue.dataset.batching import (BucketBatchSampler, DynamicPaddingCollator,
+                                         IssueCollator)
 from GitHubIssue.dataset.issue_dataset import IssueDataset
 from GitHubIssue.dataset.allennlp_issue_dataset import AllennlpIssueDatasetReader
 from GitHubIssue.models.textcnn import TextCNN
@@ -22,7 +23,12 @@ from GitHubIssue.models.bilstm import BiLSTM
 from GitHubIssue.models.rcnn import RCNN
 from GitHubIssue.models.bert import Bert
 # from GitHubIssue.models.model import TextLabelRecModel
+from GitHubIssue.util.evaluation import EvaluationEngine
 from GitHubIssue.util.mem import occupy_mem
+from GitHubIssue.util.device import loader_workers, precision_callbacks, setup_device, torch_device, trainer_gpus
+from GitHubIssue.util.pipeline import Pipeline, collect_labels, report_name, write_reports
+from GitHubIssue.util.pretrained_cache import pretrained_tokenizer, set_cache_dir
+from GitHubIssue.util.results_store import RESULT_DB, ResultsStore
 
 from GitHubIssue.tokenizer.allennlp_tokenizer import AllennlpTokenizer
 from allennlp.data.vocabulary import Vocabulary
@@ -76,42 +82,11 @@ def setup_seed(seed):
     random.seed(seed)
     torch.backends.cudnn.deterministic = True
 
-def count_labels(data, dataset):
-    count = dict()
-    for obj in data:
-        if count.get(obj['labels']) is None:
-            count[obj['labels']] = 1
-        else:
-            count[obj['labels']] += 1
-    from pprint import pprint
-    print(f'label count for {dataset} dataset')
-    pprint(count)
-
-def train_single(data_path: str, model_name: str, embedding_type=None, device=0, use_sequence=False, disablefinetune=False, local_model=False, do_predict=False):
-    data = []
-    with open(data_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
 
-    from sklearn.model_selection import StratifiedShuffleSplit
-    
-    X = []
-    y = []
-    for obj in data:
-        X.append(obj)
-        y.append(obj['labels'])
-
-    split = StratifiedShuffleSplit(n_splits=1, test_size=0.3, random_state=42)
-    for train_index, test_index in split.split(X, y):
-        train_data, test_data = np.array(X)[train_index], np.array(X)[test_index] # 训练集对应的值
-    
-    X = []
-    y = []
-    for obj in train_data:
-        X.append(obj)
-        y.append(obj['labels'])
-    split1 = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
-    for train_index, test_index in split1.split(X, y):
-        train_data, valid_data = np.array(X)[train_index], np.array(X)[test_index] #训练集对应的值
+def train_single(data_path: str, model_name: str, embedding_type=None, device=0, use_sequence=False, disablefinetune=False, local_model=False, do_predict=False, cache_dir=None, batch_tokenize=False, tokenize_workers=1, compact=False, pipeline_dir=None, cache_eval=False, times=0, bf16=False):
+    pipeline = Pipeline(pipeline_dir, cache_evaluation=cache_eval)
+    # 划分的下标按文件内容缓存, 所有实验使用相同的划分
+    train_data, valid_data, test_data = pipeline.split(data_path, data_path, data_path, test_size=0.3, valid_size=0.2)
     
     # split_1 = int(0.8 * len(train_data))
     # valid_data = train_data
@@ -132,9 +107,6 @@ def train_single(data_path: str, model_name: str, embedding_type=None, device=0,
     # valid_data = data[split_1:split_2]
     # valid_data = data[:split_2]
     # test_data = data[split_2:]
-    count_labels(train_data, 'train')
-    count_labels(valid_data, 'val')
-    count_labels(test_data, 'test')
     # exit(0)
     
     # 用于评估训练集的结果
@@ -146,22 +118,40 @@ def train_single(data_path: str, model_name: str, embedding_type=None, device=0,
         model_name = model_name.split('/')[-1]
         print(f"model_name: {model_path}")
 
+    # label num
+    # ['Error', 'Low efficiency and Effectiveness', 'deployment', 'other', 'tensor&inputs']
+    all_labels = collect_labels(train_data, valid_data, test_data)
+    print(f"all_labels:{all_labels}")
+
+    # 相同数据和超参数的训练已经完成时, 直接使用缓存的测试集 logits
+    run_inputs = pipeline.run_inputs(data_path, data_path, data_path, script='train', model_name=model_path if local_model else model_name,
+                                     embedding_type=embedding_type, use_sequence=use_sequence, disablefinetune=disablefinetune,
+                                     compact=compact, bf16=bf16, times=times,
+                                     batch_tokenize=batch_tokenize, device='cpu' if device < 0 else 'cuda')
+    test_engine = pipeline.cached_evaluation(run_inputs, all_labels)
+    if test_engine is not None:
+        ret = test_engine.metrics()
+        if do_predict:
+            write_reports(test_engine, test_data, report_name(data_path, data_path), model_name.replace('-', '_').replace('/', '_'))
+        return ret
+
     # init tokenizer
     if model_name in ["textcnn", "bilstm", "rcnn"]:
         # build vocab
         allennlp_tokenizer = SpacyTokenizer()
         allennlp_token_indexer = SingleIdTokenIndexer(token_min_padding_length=8, lowercase_tokens=True)
         allennlp_datareader = AllennlpIssueDatasetReader(allennlp_tokenizer, {'tokens': allennlp_token_indexer})
-        vocab = Vocabulary.from_instances(allennlp_datareader.read(data_path))
+        vocab = pipeline.vocab(data_path, lambda: Vocabulary.from_instances(allennlp_datareader.read(data_path)),
+                               tokenizer='spacy', token_min_padding_length=8, lowercase_tokens=True)
 
         tokenizer = AllennlpTokenizer(vocab, allennlp_tokenizer, allennlp_token_indexer)
     elif model_name in MODEL_CONFIG:
         if not local_model:
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(model_name)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], model_name)
         else:
             tokenizer_path = model_path
             print(f"tokenizer_path: {tokenizer_path}")
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(tokenizer_path, do_lower_case=True)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], tokenizer_path, do_lower_case=True)
     else:
         raise Exception("unknown model")
 
@@ -201,28 +191,30 @@ def train_single(data_path: str, model_name: str, embedding_type=None, device=0,
         else:
             print('unknown embeddings')
 
-    # label num
-    # TODO: 替换为project中的label
-    all_labels = set()
-    for obj in data:
-        all_labels.add(obj['labels'])
-        # for c in obj['labels'][0]:
-        #     all_labels.add(str(c))
-    
-    # ['Error', 'Low efficiency and Effectiveness', 'deployment', 'other', 'tensor&inputs']
-    all_labels = sorted(list(all_labels))
-
-    print(f"all_labels:{all_labels}")
-
     # init dataset
-    train_dataset = IssueDataset(train_data, all_labels, tokenizer)
-    valid_dataset = IssueDataset(valid_data, all_labels, tokenizer)
-    test_dataset = IssueDataset(test_data, all_labels, tokenizer)
-
-    num_workers = 8
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers)
-    test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers)
+    train_dataset = IssueDataset(train_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                 batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
+    valid_dataset = IssueDataset(valid_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                 batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
+    test_dataset = IssueDataset(test_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
+
+    num_workers = loader_workers(device)
+    # compact 模式下的标签为 class id, 在 collate 时展开为 one-hot
+    num_classes = len(all_labels) if compact else None
+    if model_name in ["textcnn", "bilstm", "rcnn"]:
+        collate_fn = IssueCollator(num_classes=num_classes)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True, collate_fn=collate_fn)
+        valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers, collate_fn=collate_fn)
+    else:
+        # 只 pad 到 batch 内的最大长度, 并将长度相近的 issue 分到同一个 batch
+        collate_fn = DynamicPaddingCollator(padding_side=tokenizer.padding_side, pad_token_id=tokenizer.pad_token_id,
+                                            num_classes=num_classes)
+        train_sampler = BucketBatchSampler(train_dataset.lengths, batch_size=batch_size, shuffle=True)
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=num_workers, collate_fn=collate_fn)
+        valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers, collate_fn=collate_fn)
 
     # init model
     class_num = len(all_labels)
@@ -249,8 +241,8 @@ def train_single(data_path: str, model_name: str, embedding_type=None, device=0,
         # accelerator='ddp',
         amp_backend='native',
         amp_level='O2',
-        gpus=[device],
-        callbacks=[EarlyStopping(monitor='val_loss')],
+        gpus=trainer_gpus(device),
+        callbacks=[EarlyStopping(monitor='val_loss')] + precision_callbacks(device, bf16),
         checkpoint_callback=False
     )
     trainer.fit(model,
@@ -258,64 +250,17 @@ def train_single(data_path: str, model_name: str, embedding_type=None, device=0,
                 val_dataloaders=[valid_loader],
                 )
 
-    ret = trainer.test(model, test_dataloaders=test_loader)
+    # 测试集只推理一次, 记录的指标, 分类报告和预测结果都来自同一份 logits
+    model.to(torch_device(device))
+    test_engine = EvaluationEngine('test', all_labels).run(model, test_loader)
+    pipeline.save_evaluation(run_inputs, test_engine)
+    ret = test_engine.metrics()
+    trainer.logger.log_metrics(ret, step=trainer.global_step)
 
-    model.eval()
-    pred_dict = {
-        'title': [],
-        'description': [],
-        'true_label': [],
-        'pred_label': [],
-    }
-    
     if do_predict:
-        print("start predict")
-        # get model predict labels
-        text_list = []
-        for i in tqdm.tqdm(range(len(test_data)), desc="generate predictions for test data"):
-            obj = test_data[i]
-            text = obj['title'] + ' ' + obj['description']
-            text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')['input_ids']
-            text_list.append(text_ids)
-            pred_dict['title'].append(obj['title'])
-            pred_dict['description'].append(obj['description'])
-            pred_dict['true_label'].append(obj['labels'])
-
-            if (i != 0 and i % 32 == 0) or (i == len(test_data) - 1):
-                text_list = torch.tensor(text_list, dtype=torch.long)
-                logits = model(text_list)
-                for i in range(len(logits)):
-                    pred_dict['pred_label'].append(test_dataset.id_to_label[int(logits[i].argmax())])
-                text_list = []
-
-        save_path = os.path.join('./output', 'subclass')
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-        name = data_path.split('/')[-1].split('.')[0]
-        name = os.path.join(save_path, name)
-        #true_label_id = [test_dataset.label_to_id(x) for x in pred_dict['true_label']]
-        #pred_label_id = [test_dataset.label_to_id(x) for x in pred_dict['pred_label']]
-        #report = classification_report(true_label_id, pred_label_id, target_names=list(all_labels), output_dict=True)
-        true_label_id = [test_dataset.label_to_id[x] for x in pred_dict['true_label']]
-        pred_label_id = [test_dataset.label_to_id[x] for x in pred_dict['pred_label']]
-        report = classification_report(true_label_id, pred_label_id, labels=list(range(len(all_labels))),
-                                       target_names=list(all_labels), output_dict=True)
-        print(report)
-        df = pd.DataFrame(report)
-        df = df.T
-        df.to_csv(f"{name}_{model_name.replace('-', '_').replace('/', '_')}.csv", mode='a')
-
-        df = pd.DataFrame(pred_dict)
-        save_path = os.path.join('./output', 'eval')
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-        name = data_path.split('/')[-1].split('.')[0]
-        name = os.path.join(save_path, name)
-        print(name)
-        df.to_csv(f"{name}_{model_name.replace('-', '_').replace('/', '_')}.csv", index=False)
-
-
-    return ret[0]
+        write_reports(test_engine, test_data, report_name(data_path, data_path), model_name.replace('-', '_').replace('/', '_'))
+
+    return ret
 
 
 def main():
@@ -328,11 +273,25 @@ def main():
     parser.add_argument('--train_time', default=1, type=int, required=False, help='训练次数')
     parser.add_argument('--local_model', required=False, action="store_true", help='使用本地模型')
     parser.add_argument('--do_predict', required=False, action="store_true", help='获取测试集预测结果')
+    parser.add_argument('--cache_dir', default='./cache/dataset', type=str, required=False, help='tokenize结果缓存目录, none:不使用缓存')
+    parser.add_argument('--results_db', default=RESULT_DB, type=str, required=False, help='多个进程共用的SQLite结果库, 结果csv由结果库生成')
+    parser.add_argument('--pipeline_dir', default='./cache/pipeline', type=str, required=False, help='数据划分和词表的缓存目录, --cache_eval时也缓存测试集logits, none:不使用缓存')
+    parser.add_argument('--cache_eval', action='store_true', help='缓存测试集logits, 数据, 代码和参数都相同的训练直接使用缓存的结果, 不重新训练')
+    parser.add_argument('--pretrained_cache', default='none', type=str, required=False, help='预训练权重的跨进程共享目录, 由sweep.py和search.py传入并在结束时删除, none:只在进程内缓存')
+    parser.add_argument('--num_threads', default=None, type=int, required=False, help='CPU训练时的intra-op线程数, 默认使用OMP_NUM_THREADS或全部可用核心')
+    parser.add_argument('--bf16', action='store_true', help='训练时使用bf16 autocast, 主要用于CPU训练')
+    parser.add_argument('--cpu_slot', default=None, type=int, required=False, help='多个CPU训练共用一台机器时, 当前进程绑定的CPU分组编号')
+    parser.add_argument('--cpu_slots', default=1, type=int, required=False, help='CPU分组数, 按NUMA节点切分可用核心')
+    parser.add_argument('--batch_tokenize', action='store_true', help='使用fast tokenizer或多进程批量tokenize')
+    parser.add_argument('--tokenize_workers', default=os.cpu_count(), type=int, required=False, help='批量tokenize时slow tokenizer的进程数')
+    parser.add_argument('--compact', action='store_true', help='按列压缩存储数据集, 标签在collate时展开为one-hot')
     
     parser.add_argument('--file', type=str, help='训练数据')
     
 
     args = parser.parse_args()
+    set_cache_dir(None if args.pretrained_cache.lower() == 'none' else args.pretrained_cache)
+    setup_device(args.device, args.num_threads, args.cpu_slot, args.cpu_slots)
     print('args:\n' + args.__repr__())
     
     # 占用全部显存
@@ -343,31 +302,10 @@ def main():
         model_path = args.model.split('/')[-2]
         out_name = f"output/rq1/{model_path.replace('-', '_').replace('/', '_')}_{args.embed}_1_out.csv"
 
-    if os.path.exists(out_name):
-        metric_dict_df = pd.read_csv(out_name)
-        metric_dict = metric_dict_df.to_dict(orient="list")
-    else:
-        if not os.path.exists('./output/rq1'):
-            os.makedirs('output/rq1')
-
-        metric_dict = {
-            'repo': [],
-            'test_acc_1_epoch': [],
-            'test_precision_1_epoch': [],
-            'test_recall_1_epoch': [],
-            'test_f1_marco_1_epoch': [],
-            'test_f1_marco_weight_1_epoch': [],
-            'test_f1_mirco_1_epoch': [],
-
-            'test_acc_2_epoch': [],
-            'test_precision_2_epoch': [],
-            'test_recall_2_epoch': [],
-            'test_f1_marco_2_epoch': [],
-            'test_f1_marco_weight_2_epoch': [],
-            'test_f1_mirco_2_epoch': [],
-
-        }
-        metric_dict_df = pd.DataFrame(metric_dict)
+    # 结果写入多个进程共用的结果库, 结果 csv 在所有训练结束后由结果库生成一次, 已有的 csv 先导入结果库
+    store = ResultsStore(args.results_db)
+    result_key = {'model': args.model.split('/')[-2] if args.local_model else args.model, 'embed': args.embed, 'trial': '1'}
+    store.import_csv(out_name, **result_key)
     
     # train on concat file
     # training_times = 10
@@ -381,14 +319,12 @@ def main():
         # concat_file = './my_data/train/streamlit1_TRAIN_Aug/streamlit1_TRAIN_Aug.txt'
         # random.seed(hash(concat_file))
         print(f'train_file:{concat_file}, test_file:{concat_file}')
-        each_metrics = train_single(concat_file, args.model, args.embed, args.device, args.sequence, args.disablefinetune, args.local_model, args.do_predict)
+        each_metrics = train_single(concat_file, args.model, args.embed, args.device, args.sequence, args.disablefinetune, args.local_model, args.do_predict,
+                                    cache_dir=None if args.cache_dir.lower() == 'none' else args.cache_dir,
+                                    batch_tokenize=args.batch_tokenize, tokenize_workers=args.tokenize_workers, compact=args.compact,
+                                    pipeline_dir=None if args.pipeline_dir.lower() == 'none' else args.pipeline_dir, cache_eval=args.cache_eval, bf16=args.bf16, times=t)
         name = concat_file.split('/')[-1].split('.')[0]
-        metric_dict['repo'].append(name + '_times_' + str(t))
-        for k, v in each_metrics.items():
-            if k in metric_dict:
-                metric_dict[k].append(v)
-
-        df = pd.DataFrame(metric_dict)
-        df.to_csv(out_name, index=False)
+        store.add(repo=name, seed=t, metrics=each_metrics, **result_key)
+    store.export_csv(out_name, **result_key)
 if __name__ == "__main__":
     main()
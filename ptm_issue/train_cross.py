@@ -9,7 +9,6 @@ import pandas as pd
 import torch
 import tqdm
 from sklearn.metrics import classification_report
-from sklearn.model_selection import StratifiedShuffleSplit
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -19,7 +18,7 @@ from allennlp.data.token_indexers.single_id_token_indexer import \
 from allennlp.data.tokenizers.spacy_tokenizer import SpacyTokenizer
 from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules.token_embedders.embedding import Embedding
-from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
+from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from pytorch_lightning.loggers import TensorBoardLogger
 from torch.utils.data import DataLoader
@@ -27,20 +26,37 @@ from transformers import (AlbertTokenizer, AutoTokenizer, BertTokenizer,
                           GPT2Tokenizer, RobertaTokenizer, T5Tokenizer,
                           XLNetTokenizer)
 
+from GitHubIssue.dataset.activation_cache import frozen_activation_loader
 from GitHubIssue.dataset.allennlp_issue_dataset import \
     AllennlpIssueDatasetReader
-from GitHubIssue.dataset.issue_dataset import IssueDataset, concat_str
+from GitHubIssue.dataset.batching import (BucketBatchSampler, DynamicPaddingCollator,
+                                         IssueCollator)
+from GitHubIssue.dataset.issue_dataset import IssueDataset, IssueIterableDataset, concat_str
+from GitHubIssue.dataset.json_stream import JsonRecords
 from GitHubIssue.metrics.log_metrics import log_metrics
 from GitHubIssue.models.bert import Bert
 from GitHubIssue.models.bilstm import BiLSTM
 from GitHubIssue.models.gpt import Gpt
 from GitHubIssue.models.rcnn import RCNN
+from GitHubIssue.models.seed_ensemble import SeedEnsemble, aggregate_metrics
 from GitHubIssue.models.textcnn import TextCNN
 from GitHubIssue.models.transformer import Transformer
 from GitHubIssue.tokenizer.allennlp_tokenizer import AllennlpTokenizer
 # from GitHubIssue.models.model import TextLabelRecModel
 from GitHubIssue.util.mem import occupy_mem
+from GitHubIssue.util.delta_ckpt import load_checkpoint_state
+from GitHubIssue.util.device import loader_workers, precision_callbacks, setup_device, torch_device, trainer_gpus
+from GitHubIssue.util.evaluation import EvaluationEngine
 from GitHubIssue.util.my_callback import MySubClassPredictCallback
+from GitHubIssue.util.async_ckpt import AsyncModelCheckpoint
+from GitHubIssue.util.async_eval import AsyncEvaluationCallback
+from GitHubIssue.util.batch_plan import plan_batch_size, set_gradient_checkpointing
+from GitHubIssue.util.onnx_export import export_and_verify
+from GitHubIssue.util.pipeline import (Pipeline, collect_labels, count_labels, load_json,
+                                       report_name, write_reports)
+from GitHubIssue.util.pretrained_cache import pretrained_tokenizer, set_cache_dir
+from GitHubIssue.util.results_store import RESULT_DB, ResultsStore
+from GitHubIssue.util.sweep import result_csv, result_model
 from mylogger import CustomTensorBoardLogger
 
 MODEL_CONFIG = [
@@ -124,17 +140,6 @@ def setup_seed(seed):
     random.seed(seed)
     torch.backends.cudnn.deterministic = True
 
-def count_labels(data, dataset):
-    count = dict()
-    for obj in data:
-        if count.get(obj['labels']) is None:
-            count[obj['labels']] = 1
-        else:
-            count[obj['labels']] += 1
-    from pprint import pprint
-    print(f'label count for {dataset} dataset')
-    pprint(count)
-
 
 def train_single(
     train_file: str, 
@@ -149,57 +154,50 @@ def train_single(
     do_predict=False,
     batch_size=8,
     base_lr=5e-5,
-    trial="trial"):
+    trial="trial",
+    cache_dir=None,
+    batch_tokenize=False,
+    tokenize_workers=1,
+    compact=False,
+    cache_frozen=False,
+    stream=False,
+    shuffle_buffer=10000,
+    keep_ckpt=False,
+    times=0,
+    onnx_dir=None,
+    onnx_threads=1,
+    async_eval=False,
+    eval_every=1,
+    eval_on_improve=False,
+    eval_device='cpu',
+    pipeline_dir=None,
+    cache_eval=False,
+    bf16=False,
+    plan_batch=False,
+    effective_batch_size=None,
+    memory_fraction=0.9,
+    max_epochs=30,
+    trainable_layers=4,
+    class_weights=None,
+    search_dir=None,
+    ensemble_seeds=None):
     
-    data = []
-    if train_file is not None:
-        with open(train_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-    if train_file == test_file and train_file == valid_file:
-        X = []
-        y = []
-        for obj in data:
-            X.append(obj)
-            y.append(obj['labels'])
-
-        split = StratifiedShuffleSplit(n_splits=1, test_size=0.3, random_state=42)
-        for train_index, test_index in split.split(X, y):
-            train_data, test_data = np.array(X)[train_index], np.array(X)[test_index] # 训练集对应的值
-        
-        X = []
-        y = []
-        for obj in train_data:
-            X.append(obj)
-            y.append(obj['labels'])
-        split1 = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
-        for train_index, test_index in split1.split(X, y):
-            train_data, valid_data = np.array(X)[train_index], np.array(X)[test_index] #训练集对应的值
-    elif train_file == valid_file and train_file != test_file:
-        X = []
-        y = []
-        for obj in data:
-            X.append(obj)
-            y.append(obj['labels'])
-        split = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=42)
-        for train_index, valid_index in split.split(X, y):
-            train_data, valid_data = np.array(X)[train_index], np.array(X)[valid_index] # 训练集对应的值
-        
-        test_data = []
-        with open(test_file, 'r', encoding='utf-8') as f:
-            test_data = json.load(f)
+    if stream and (train_file == valid_file or train_file == test_file):
+        print("stream mode needs separate valid and test files, load train file into memory")
+        stream = False
+
+    pipeline = Pipeline(pipeline_dir, cache_evaluation=cache_eval)
+    if stream:
+        # 流式读取训练集, 每次遍历都重新读取文件
+        train_data = JsonRecords(train_file)
+        valid_data = load_json(valid_file)
+        test_data = load_json(test_file)
+        count_labels(train_data, 'train')
+        count_labels(valid_data, 'val')
+        count_labels(test_data, 'test')
     else:
-        train_data = data
-        valid_data = []
-        with open(valid_file, 'r', encoding='utf-8') as f:
-            valid_data = json.load(f)
-        test_data = []
-        with open(test_file, 'r', encoding='utf-8') as f:
-            test_data = json.load(f)
-    
-    count_labels(train_data, 'train')
-    count_labels(valid_data, 'val')
-    count_labels(test_data, 'test')
+        # 划分的下标按文件内容缓存, 所有实验使用相同的划分
+        train_data, valid_data, test_data = pipeline.split(train_file, valid_file, test_file, test_size=0.3, valid_size=0.2)
     
     # 用于评估训练集的结果
     # test_data = data[:split_1]
@@ -210,14 +208,39 @@ def train_single(
         model_name = model_name.split('/')[-1]
         print(f"model_name: {model_path}")
 
+    # label num
+    # ['Error', 'Low efficiency and Effectiveness', 'deployment', 'other', 'tensor&inputs']
+    all_labels = collect_labels(train_data, valid_data, test_data)
+    print(f"all_labels:{all_labels}")
+
+    # 相同数据和超参数的训练已经完成时, 直接使用缓存的测试集 logits
+    run_inputs = pipeline.run_inputs(train_file, valid_file, test_file, model_name=model_path if local_model else model_name,
+                                     embedding_type=embedding_type,
+                                     use_sequence=use_sequence, disablefinetune=disablefinetune, batch_size=batch_size,
+                                     base_lr=base_lr, max_epochs=max_epochs, compact=compact, cache_frozen=cache_frozen,
+                                     stream=stream, bf16=bf16, plan_batch=plan_batch, effective_batch_size=effective_batch_size,
+                                     trainable_layers=trainable_layers, class_weights=class_weights, times=times,
+                                     shuffle_buffer=shuffle_buffer if stream else None, memory_fraction=memory_fraction if plan_batch else None,
+                                     batch_tokenize=batch_tokenize, device='cpu' if device < 0 else 'cuda')
+    # 超参数搜索不使用测试集, 多种子训练按种子缓存测试集结果
+    test_engine = pipeline.cached_evaluation(run_inputs, all_labels) if search_dir is None and ensemble_seeds is None else None
+    if test_engine is not None and onnx_dir is None and not keep_ckpt:
+        ret = test_engine.metrics()
+        print(ret)
+        if do_predict:
+            write_reports(test_engine, test_data, report_name(train_file, test_file),
+                          f"{model_name.replace('-', '_').replace('/', '_')}_{trial}")
+        return ret
+
     # init tokenizer
     if model_name in ["textcnn", "bilstm", "rcnn"]:
         # build vocab
         allennlp_tokenizer = SpacyTokenizer()
         allennlp_token_indexer = SingleIdTokenIndexer(token_min_padding_length=8, lowercase_tokens=True)
         allennlp_datareader = AllennlpIssueDatasetReader(allennlp_tokenizer, {'tokens': allennlp_token_indexer})
-        vocab = Vocabulary.from_instances(allennlp_datareader.read(train_file))
-        
+        vocab = pipeline.vocab(train_file, lambda: Vocabulary.from_instances(allennlp_datareader.read(train_file)),
+                               tokenizer='spacy', token_min_padding_length=8, lowercase_tokens=True)
+
         from allennlp.data.tokenizers import Token
         ids = allennlp_token_indexer.tokens_to_indices([Token(vocab._padding_token)], vocab)['tokens']
         print(f"padding tokens is {ids}")
@@ -225,20 +248,20 @@ def train_single(
         tokenizer = AllennlpTokenizer(vocab, allennlp_tokenizer, allennlp_token_indexer)
     elif model_name in BERT_MODEL_CONFIG or model_name in TRANSFORMER_MODEL_CONFIG:
         if not local_model:
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(model_name)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], model_name)
         else:
             # tokenizer_path = model_path
             tokenizer_path = model_path
             print(f"tokenizer_path: {tokenizer_path}")
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(tokenizer_path, do_lower_case=True)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], tokenizer_path, do_lower_case=True)
     elif model_name in GPT_MODEL_CONFIG:
         if not local_model:
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(model_name)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], model_name)
         else:
             # tokenizer_path = model_path
             tokenizer_path = model_path
             print(f"tokenizer_path: {tokenizer_path}")
-            tokenizer = TOKENIZER_CONFIG[model_name].from_pretrained(tokenizer_path, do_lower_case=True)
+            tokenizer = pretrained_tokenizer(TOKENIZER_CONFIG[model_name], tokenizer_path, do_lower_case=True)
         tokenizer.pad_token = tokenizer.eos_token
         tokenizer.padding_side = 'right'
     else:
@@ -252,12 +275,7 @@ def train_single(
     elif model_name == "rcnn":
         batch_size = 64
     elif model_name in MODEL_CONFIG:
-        # batch_size = 32
-        #TODO change batch size refer to gpu
-        # batch_size = 32
-        # batch_size = 32
-        # batch_size = 48
-        # batch_size = 8
+        # 预训练模型使用 --batch_size, --plan_batch 时在模型创建后按显存探测
         batch_size = batch_size
 
     # init embedding
@@ -283,30 +301,18 @@ def train_single(
         else:
             print('unknown embeddings')
 
-    # label num
-    all_labels = set()
-    for obj in train_data:
-        all_labels.add(obj['labels'])
-    for obj in valid_data:
-        all_labels.add(obj['labels'])
-    for obj in test_data:
-        all_labels.add(obj['labels'])
-    
-    # ['Error', 'Low efficiency and Effectiveness', 'deployment', 'other', 'tensor&inputs']
-    all_labels = sorted(list(all_labels))
-    print(f"all_labels:{all_labels}")
-
     # init dataset
-    train_dataset = IssueDataset(train_data, all_labels, tokenizer)
+    if stream:
+        train_dataset = IssueIterableDataset(train_file, all_labels, tokenizer, shuffle_buffer=shuffle_buffer)
+    else:
+        train_dataset = IssueDataset(train_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                     batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
     # if model_name in GPT_MODEL_CONFIG:
     #     tokenizer.padding_side = 'left'
-    valid_dataset = IssueDataset(valid_data, all_labels, tokenizer)
-    test_dataset = IssueDataset(test_data, all_labels, tokenizer)
-
-    num_workers = 8
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers)
-    test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers)
+    valid_dataset = IssueDataset(valid_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                 batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
+    test_dataset = IssueDataset(test_data, all_labels, tokenizer, cache_dir=cache_dir,
+                                batch_tokenize=batch_tokenize, num_proc=tokenize_workers, compact=compact)
 
     # init model
     class_num = len(all_labels)
@@ -321,14 +327,18 @@ def train_single(
                      word_embeddings=token_embedding)
     elif model_name in BERT_MODEL_CONFIG:
         if not local_model:
-            model = Bert(num_classes=class_num, base_lr=base_lr, model_name=model_name, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model)
+            model = Bert(num_classes=class_num, base_lr=base_lr, model_name=model_name, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model, cache_frozen=cache_frozen,
+                         trainable_layers=trainable_layers, class_weights=class_weights)
         else:
-            model = Bert(num_classes=class_num, base_lr=base_lr, model_name=model_path, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model)    
+            model = Bert(num_classes=class_num, base_lr=base_lr, model_name=model_path, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model, cache_frozen=cache_frozen,
+                         trainable_layers=trainable_layers, class_weights=class_weights)    
     elif model_name in GPT_MODEL_CONFIG:
         if not local_model:
-            model = Gpt(num_classes=class_num, base_lr=base_lr, model_name=model_name, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model)
+            model = Gpt(num_classes=class_num, base_lr=base_lr, model_name=model_name, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model, cache_frozen=cache_frozen,
+                        decoder_layers_to_train=trainable_layers, class_weights=class_weights)
         else:
-            model = Gpt(num_classes=class_num,  base_lr=base_lr, model_name=model_path, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model)
+            model = Gpt(num_classes=class_num,  base_lr=base_lr, model_name=model_path, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model, cache_frozen=cache_frozen,
+                        decoder_layers_to_train=trainable_layers, class_weights=class_weights)
     elif model_name in TRANSFORMER_MODEL_CONFIG:
         if not local_model:
             model = Transformer(num_classes=class_num, base_lr=base_lr, model_name=model_name, use_sequence=use_sequence, disablefinetune=disablefinetune, local_model=local_model)
@@ -337,6 +347,86 @@ def train_single(
     else:
         raise Exception("unknown model")
 
+    # compact 模式下的标签为 class id, 在 collate 时展开为 one-hot
+    num_classes = len(all_labels) if compact else None
+    if model_name in ["textcnn", "bilstm", "rcnn"]:
+        collate_fn = IssueCollator(num_classes=num_classes)
+    else:
+        collate_fn = DynamicPaddingCollator(padding_side=tokenizer.padding_side, pad_token_id=tokenizer.pad_token_id,
+                                            num_classes=num_classes)
+
+    # 按显存探测 batch size, 不足 effective_batch_size 的部分用梯度累积补齐
+    accumulate_grad_batches = 1
+    if plan_batch and model_name in BERT_MODEL_CONFIG + GPT_MODEL_CONFIG + TRANSFORMER_MODEL_CONFIG and not stream and not cache_frozen:
+        plan = plan_batch_size(model, train_dataset, collate_fn, device, effective_batch_size or batch_size,
+                               model_key=f"{model_path if local_model else model_name}_{use_sequence}_{disablefinetune}",
+                               memory_fraction=memory_fraction)
+        batch_size, accumulate_grad_batches = plan['batch_size'], plan['accumulate_grad_batches']
+        if plan['gradient_checkpointing']:
+            set_gradient_checkpointing(model, True)
+
+    num_workers = loader_workers(device)
+    if model_name in ["textcnn", "bilstm", "rcnn"]:
+        # IterableDataset 由 shuffle buffer 打乱顺序
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=not stream, collate_fn=collate_fn)
+        valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers, collate_fn=collate_fn)
+    else:
+        # 只 pad 到 batch 内的最大长度, 并将长度相近的 issue 分到同一个 batch
+        if stream:
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+        else:
+            train_sampler = BucketBatchSampler(train_dataset.lengths, batch_size=batch_size, shuffle=True)
+            train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=num_workers, collate_fn=collate_fn)
+        valid_loader = DataLoader(valid_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_size=8, num_workers=num_workers, collate_fn=collate_fn)
+
+    if ensemble_seeds is not None:
+        if model_name not in ["textcnn", "bilstm", "rcnn"]:
+            raise Exception(f"seed ensemble only supports textcnn, bilstm and rcnn, not {model_name}")
+        # 每个种子的测试集 logits 单独缓存, 只训练没有缓存的种子
+        seed_inputs = {seed: dict(run_inputs, params=dict(run_inputs['params'], times=seed, ensemble=True)) for seed in ensemble_seeds}
+        test_engines = {seed: pipeline.cached_evaluation(seed_inputs[seed], all_labels) for seed in ensemble_seeds}
+        best_epochs = {}
+        train_seeds = [seed for seed in ensemble_seeds if test_engines[seed] is None]
+        if train_seeds:
+            # 每个种子一个模型副本, 在同一个进程和数据流上同步训练, 词向量需要复制, 否则副本之间共享同一个 embedding
+            ensemble = SeedEnsemble(lambda: type(model)(num_classes=class_num, vocab_size=vocab.get_vocab_size(), embedding_size=300,
+                                                        word_embeddings=None if token_embedding is None else token_embedding.clone()),
+                                    train_seeds, device=torch_device(device))
+            print(f"train {len(train_seeds)} seeds of {model_name}, vectorized: {ensemble.vectorized}")
+            ensemble.fit(train_loader, valid_loader, all_labels, max_epochs=max_epochs)
+            for seed, engine, epoch in zip(train_seeds, ensemble.evaluate(test_loader, 'test', all_labels), ensemble.best_epochs):
+                pipeline.save_evaluation(seed_inputs[seed], engine)
+                test_engines[seed] = engine
+                best_epochs[seed] = epoch
+        rets = []
+        for seed in ensemble_seeds:
+            engine = test_engines[seed]
+            rets.append(engine.metrics())
+            print(f"seed {seed}, best epoch {best_epochs.get(seed, 'cached')}: {rets[-1]}")
+            if do_predict:
+                write_reports(engine, test_data, report_name(train_file, test_file),
+                              f"{model_name.replace('-', '_').replace('/', '_')}_{trial}")
+        summary = aggregate_metrics(rets)
+        for k in rets[0]:
+            print(f"{k}: {summary['mean'][k]:.4f} ± {summary['std'][k]:.4f}")
+        return rets
+
+    # 使用缓存的冻结层输出训练, 每个 epoch 只计算顶部未冻结的层
+    if cache_frozen:
+        if stream or not isinstance(model, (Bert, Gpt)) or not model.activation_cache_supported():
+            print(f"activation cache is not supported for {model_name}")
+        else:
+            frozen_cache_dir = os.path.join(cache_dir if cache_dir is not None else './cache', 'frozen')
+            cache_device = torch_device(device)
+            train_loader = frozen_activation_loader(model, train_dataset, frozen_cache_dir, collate_fn, batch_size, shuffle=True,
+                                                    num_workers=num_workers, device=cache_device, num_classes=class_num)
+            valid_loader = frozen_activation_loader(model, valid_dataset, frozen_cache_dir, collate_fn, batch_size,
+                                                    num_workers=num_workers, device=cache_device, num_classes=class_num)
+            test_loader = frozen_activation_loader(model, test_dataset, frozen_cache_dir, collate_fn, 8,
+                                                   num_workers=num_workers, device=cache_device, num_classes=class_num)
+
     # add model checkpoint
     # checkpoint_callback  = ModelCheckpoint(
     #     dirpath='ckpts/',
@@ -347,8 +437,6 @@ def train_single(
     #     )
     
     
-    # max_epochs=35
-    max_epochs=30
     log_name = trial
     # log_name= 'newtaglabel_lr_5e-5_bert'
     # log_name= 'newtaglabel_lr_5e-5_t5_enc6_dec0_times10'
@@ -357,8 +445,17 @@ def train_single(
     log_experiment = 'ep_' + str(max_epochs) + '_maxf1'
     # log_experiment = 'ep_' + str(max_epochs) + '_minloss'
     ckpt_name = f'{model_name.replace("/", "_")}' + f'-best_model_{log_name}_{log_experiment}'
-    ckpt_path = f'./ckpts/' + ckpt_name + '.ckpt'
-    checkpoint_callback = ModelCheckpoint(
+    if keep_ckpt:
+        # 保留的 checkpoint 按训练次数区分, 避免多次训练互相覆盖
+        ckpt_name = ckpt_name + f'_times_{times}'
+    ckpt_dir = 'ckpts'
+    if search_dir is not None:
+        # 超参数搜索的每个配置使用单独的目录, 保留 last.ckpt, 晋级后从上一级的 epoch 继续训练
+        ckpt_dir, ckpt_name = search_dir, 'best'
+    ckpt_path = os.path.join(ckpt_dir, ckpt_name + '.ckpt')
+    last_ckpt_path = os.path.join(ckpt_dir, 'last.ckpt')
+    # 保存时只复制到内存, 由后台线程写入磁盘
+    checkpoint_callback = AsyncModelCheckpoint(
         monitor = 'valid_f1_marco_1_epoch',  # 监视验证集上的marco f1
         # monitor = 'val_custom_marco_f1',  # 监视验证集上的marco f1
         # monitor = 'val_loss',  # 监视验证集上的损失
@@ -367,36 +464,47 @@ def train_single(
         save_top_k=1,        # 仅保存性能最佳的模型
         # save_weights_only=True,  # 仅保存模型权重而不是整个模型
         filename=ckpt_name,    # 保存文件的名称
-        dirpath='ckpts/',
+        dirpath=ckpt_dir,
+        save_last=search_dir is not None,
+        # 只有超参数搜索需要从 checkpoint 继续训练, 其他情况不保存优化器状态
+        save_weights_only=search_dir is None,
     )
 
 
+    # valid 复用验证循环的 logits, test 每个 epoch 对已经 tokenize 的测试集推理一次
     subclass_predict_callback_val = MySubClassPredictCallback(
         stage="valid",
         model_name=model_name,
         trial=trial,
-        model=model,
-        tokenizer=tokenizer,
-        test_dataset=valid_dataset,
-        train_file=train_file,
-        test_file=test_file,
         all_labels=all_labels,
-        device=device,
-    )
-
-    subclass_predict_callback_test = MySubClassPredictCallback(
-        stage="test",
-        model_name=model_name,
-        trial=trial,
-        model=model,
-        tokenizer=tokenizer,
-        test_dataset=test_dataset,
         train_file=train_file,
         test_file=test_file,
-        all_labels=all_labels,
-        device=device,
     )
 
+    if async_eval:
+        # 测试集在独立进程中评估, 训练进程只发送可训练参数的快照
+        subclass_predict_callback_test = AsyncEvaluationCallback(
+            stage="test",
+            model=model,
+            all_labels=all_labels,
+            dataset=test_loader.dataset,
+            collate_fn=test_loader.collate_fn,
+            batch_size=test_loader.batch_size,
+            device=eval_device,
+            every_n_epochs=eval_every,
+            monitor='valid_f1_marco_1_epoch' if eval_on_improve else None,
+        )
+    else:
+        subclass_predict_callback_test = MySubClassPredictCallback(
+            stage="test",
+            model_name=model_name,
+            trial=trial,
+            all_labels=all_labels,
+            train_file=train_file,
+            test_file=test_file,
+            loader=test_loader,
+        )
+
     lr_monitor = LearningRateMonitor(logging_interval='epoch')
 
     # logger = CustomTensorBoardLogger(save_dir='lightning_logs', name=log_name, log_dir_name=log_experiment)
@@ -410,138 +518,74 @@ def train_single(
         amp_backend='native',
         # amp_level='O2',
         # amp_level='O0',
-        gpus=[device],
-        # accumulate_grad_batches=2,
+        gpus=trainer_gpus(device),
+        accumulate_grad_batches=accumulate_grad_batches,
+        resume_from_checkpoint=last_ckpt_path if search_dir is not None and os.path.isfile(last_ckpt_path) else None,
         callbacks=[
             # EarlyStopping(monitor='val_loss'),
             subclass_predict_callback_val,
-            subclass_predict_callback_test,
+            # 超参数搜索不评估测试集
+            *([subclass_predict_callback_test] if search_dir is None else []),
             checkpoint_callback,
             lr_monitor
-            ],
+            ] + precision_callbacks(device, bf16),
         # checkpoint_callback=False
     )
     
-    trainer.fit(model,
-                train_dataloader=train_loader,
-                val_dataloaders=[valid_loader],
-                )
-
-    checkpoint = torch.load(ckpt_path)
-    model.load_state_dict(checkpoint["state_dict"])
+    try:
+        trainer.fit(model,
+                    train_dataloader=train_loader,
+                    val_dataloaders=[valid_loader],
+                    )
+    except BaseException:
+        # 训练中断时也把已经保存的 checkpoint 写入磁盘
+        checkpoint_callback.close()
+        raise
+    finally:
+        if async_eval:
+            subclass_predict_callback_test.close()
+
+    if search_dir is not None:
+        # 最优分数保存在 last.ckpt 的 ModelCheckpoint 状态中, 不需要保留最优模型
+        if checkpoint_callback.best_model_score is None:
+            raise Exception(f"no validation score in {search_dir}")
+        # 下一级从 last.ckpt 继续训练, 退出前需要写入磁盘
+        checkpoint_callback.close()
+        if os.path.isfile(ckpt_path):
+            os.remove(ckpt_path)
+        return {'valid_f1_marco_1_epoch': float(checkpoint_callback.best_model_score), 'max_epochs': max_epochs}
+
+    # 最优模型的快照还在内存中时不从磁盘读取
+    checkpoint = checkpoint_callback.load(ckpt_path)
+    load_checkpoint_state(model, checkpoint)
     # model.load_from_checkpoint(
     #     f'./ckpts/{model_name.replace("/", "_")}' + '-best_model.ckpt',
     #     strict=False
     #     #  num_labels=class_num
     #     )
 
-    ret = trainer.test(model, test_dataloaders=test_loader)
+    # 测试集只推理一次, 记录的指标, 分类报告和预测结果都来自同一份 logits
+    model.to(torch_device(device))
+    test_engine = EvaluationEngine('test', all_labels).run(model, test_loader)
+    pipeline.save_evaluation(run_inputs, test_engine)
+    ret = [test_engine.metrics()]
+    trainer.logger.log_metrics(ret[0], step=trainer.global_step)
+    print(ret[0])
 
     model.eval()
-    pred_dict = {
-        'number': [],
-        'html_url': [],
-        'title': [],
-        'description': [],
-        'true_label': [],
-        'pred_label': [],
-    }
-    
-    if do_predict:
-        print("start predict")
-        if model_name in GPT_MODEL_CONFIG:
-            tokenizer.padding_side = 'right'
-
-        # get model predict labels
-        text_list = []
-        for i in tqdm.tqdm(range(len(test_data)), desc="generate predictions for test data"):
-            obj = test_data[i]
-            # text = obj['title'] + ' ' + obj['description']
-            # text = concat_str(tokenizer, [obj['title'], obj['description']])
-            title = "Title: "+ obj['title']
-            description = "Details: " + obj['description']
-            if obj.get("commment_concat_str") is not None:
-                # text += " " + obj["commment_concat_str"]
-                comments_list = obj['commment_concat_str'].split("concatcommentsign")
-                if len(comments_list) != 0:
-                    comments_list[0] = "Comments: " + comments_list[0]
-                text = concat_str(tokenizer, [title, description] + comments_list)
-            else:
-                text = concat_str(tokenizer, [title, description])
-            # text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')['input_ids']
-            if isinstance(tokenizer, AllennlpTokenizer):
-                text_ids = tokenizer(text, truncation=True, max_length=512, padding='max_length')
-                # allennlp tokenizer不会自动附加维度，因此最后增加一维，便于后续concat
-                text_ids['input_ids'] = torch.tensor(text_ids['input_ids'], dtype=torch.long).unsqueeze(0)
-                text_list.append(text_ids)
-            else:
-                text_ids = tokenizer(
-                    text, 
-                    truncation=True, 
-                    max_length=512, 
-                    padding='max_length', 
-                    return_tensors="pt",
-                    return_token_type_ids=True if "token_type_ids" in tokenizer.model_input_names else False)
-                text_list.append(text_ids)
-            pred_dict['number'].append(obj['number'])
-            pred_dict['html_url'].append(obj['html_url'])
-            pred_dict['title'].append(obj['title'])
-            pred_dict['description'].append(obj['description'])
-            pred_dict['true_label'].append(obj['labels'])
-            
-            model.to(f'cuda:{device}')
-            if (i != 0 and i % 8 == 0) or (i == len(test_data) - 1):
-                keys = text_list[0].keys()
-                inputs = {}
-                for k in keys:
-                    inputs[k] = torch.cat([item[k] for item in text_list], dim=0).to(f'cuda:{device}')
-
-                if isinstance(tokenizer, AllennlpTokenizer):
-                    logits = model(**inputs)
-                else:
-                    logits = model(inputs)
-                
-                for i in range(len(logits)):
-                    pred_dict['pred_label'].append(test_dataset.id_to_label[int(logits[i].argmax())])
-                text_list = []
+    # 导出 ONNX 模型, 在测试集上校验与 PyTorch 的 logits 一致并对比 CPU 推理耗时
+    if onnx_dir is not None:
+        onnx_path = os.path.join(onnx_dir, ckpt_name + '.onnx')
+        onnx_report = export_and_verify(model, test_dataset, collate_fn, onnx_path, intra_op_threads=onnx_threads)
+        print(f"export onnx model to {onnx_path}: {onnx_report}")
+        ret[0].update({f'onnx_{k}': v for k, v in onnx_report.items()})
 
-        save_path = os.path.join('./output', 'subclass')
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-
-        if train_file == test_file:
-            name = train_file.split('/')[-1].split('.')[0]
-        else:
-            name = train_file.split('/')[-1].split('.')[0] + '_' + test_file.split('/')[-1].split('.')[0]
-
-        name = os.path.join(save_path, name)
-        true_label_id = [test_dataset.label_to_id[x] for x in pred_dict['true_label']]
-        pred_label_id = [test_dataset.label_to_id[x] for x in pred_dict['pred_label']]
-        report = classification_report(true_label_id, pred_label_id, labels=list(range(len(all_labels))),
-                                       target_names=list(all_labels), output_dict=True)
-        print(report)
+    if do_predict:
+        report = write_reports(test_engine, test_data, report_name(train_file, test_file),
+                               f"{model_name.replace('-', '_').replace('/', '_')}_{trial}")
         # 确保你使用的是 TensorBoard Logger
         if isinstance(trainer.logger, TensorBoardLogger):
             log_metrics(trainer.logger, report, '', global_step=trainer.global_step)
-
-        # save subclass report
-        df = pd.DataFrame(report)
-        df = df.T
-        df.to_csv(f"{name}_{model_name.replace('-', '_').replace('/', '_')}_{trial}.csv", mode='a')
-
-        # save eval result
-        df = pd.DataFrame(pred_dict)
-        save_path = os.path.join('./output', 'eval')
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-
-        if train_file == test_file:
-            name = train_file.split('/')[-1].split('.')[0]
-        else:
-            name = train_file.split('/')[-1].split('.')[0] + '_' + test_file.split('/')[-1].split('.')[0]
-        name = os.path.join(save_path, name)
-        df.to_csv(f"{name}_{model_name.replace('-', '_').replace('/', '_')}_{trial}.csv", index=False)
-
         # ============================  predict valid file ===========================
         # pred_dict = {
         #     'number': [],
@@ -647,7 +691,10 @@ def train_single(
         # df.to_csv(f"{name}_{model_name.replace('-', '_').replace('/', '_')}_{trial}.csv", index=False)
 
     # 训练结束后删除 checkpoint 文件
-    if os.path.isfile(ckpt_path):
+    checkpoint_callback.close()
+    if keep_ckpt:
+        print(f"Keep checkpoint {ckpt_path}, export it with export_quantized.py")
+    elif os.path.isfile(ckpt_path):
         os.remove(ckpt_path)  # 删除文件
         print(f"File {ckpt_path} has been removed successfully")
     else:
@@ -662,8 +709,9 @@ def main():
     parser.add_argument('--model', default='textcnn', type=str, required=False, help='模型名称')
     parser.add_argument('--embed', default='glove', type=str, required=False, help='词嵌入')
     parser.add_argument('--sequence', required=False, action="store_true", help='序列模型')
-    parser.add_argument('--disablefinetune', required=False, action="store_true", help='禁止微调')
+    parser.add_argument('--disablefinetune', required=False, action="store_true", help='禁止微调, 非sequence模型只训练分类头时可以使用train_probe.py在缓存的pooled向量上训练')
     parser.add_argument('--train_time', default=1, type=int, required=False, help='训练次数')
+    parser.add_argument('--start_time', default=0, type=int, required=False, help='从第几次训练开始, 之前的结果已经写入csv')
     parser.add_argument('--local_model', required=False, action="store_true", help='使用本地模型')
     parser.add_argument('--do_predict', required=False, action="store_true", help='获取测试集预测结果')
     
@@ -674,48 +722,58 @@ def main():
     parser.add_argument('--batch_size', default=8, type=int, required=False, help='模型输入batch size')
     parser.add_argument('--base_lr', default=5e-5, type=float, required=False, help='训练学习率')
     parser.add_argument('--trial', type=str, help='训练名称')
+    parser.add_argument('--cache_dir', default='./cache/dataset', type=str, required=False, help='tokenize结果缓存目录, none:不使用缓存')
+    parser.add_argument('--pipeline_dir', default='./cache/pipeline', type=str, required=False, help='数据划分和词表的缓存目录, --cache_eval时也缓存测试集logits, none:不使用缓存')
+    parser.add_argument('--cache_eval', action='store_true', help='缓存测试集logits, 数据, 代码和参数都相同的训练直接使用缓存的结果, 不重新训练')
+    parser.add_argument('--pretrained_cache', default='none', type=str, required=False, help='预训练权重的跨进程共享目录, 由sweep.py和search.py传入并在结束时删除, none:只在进程内缓存')
+    parser.add_argument('--num_threads', default=None, type=int, required=False, help='CPU训练时的intra-op线程数, 默认使用OMP_NUM_THREADS或全部可用核心')
+    parser.add_argument('--bf16', action='store_true', help='训练时使用bf16 autocast, 主要用于CPU训练')
+    parser.add_argument('--plan_batch', action='store_true', help='按显存/内存探测预训练模型的batch size, 梯度累积和gradient checkpointing')
+    parser.add_argument('--effective_batch_size', default=None, type=int, required=False, help='plan_batch时的等效batch size, 默认使用batch_size')
+    parser.add_argument('--max_epochs', default=30, type=int, required=False, help='训练的epoch数')
+    parser.add_argument('--trainable_layers', default=4, type=int, required=False, help='只微调顶部的encoder/decoder层数')
+    parser.add_argument('--class_weights', default=None, type=str, required=False, help='CrossEntropyLoss的类别权重, 按标签排序逗号分隔, 例如1.2,1.2,1.2,1.0,0.8')
+    parser.add_argument('--results_db', default=RESULT_DB, type=str, required=False, help='多个进程共用的SQLite结果库, 结果csv由结果库生成')
+    parser.add_argument('--seed_ensemble', action='store_true', help='textcnn/bilstm/rcnn的train_time次训练合并为一次多种子的同步训练, 第t次训练使用种子t')
+    parser.add_argument('--search_dir', default=None, type=str, required=False, help='超参数搜索时的目录, 保存last.ckpt和验证集分数result.json, 不评估测试集')
+    parser.add_argument('--memory_fraction', default=0.9, type=float, required=False, help='plan_batch时可以使用的空闲显存/内存比例')
+    parser.add_argument('--cpu_slot', default=None, type=int, required=False, help='多个CPU训练共用一台机器时, 当前进程绑定的CPU分组编号')
+    parser.add_argument('--cpu_slots', default=1, type=int, required=False, help='CPU分组数, 按NUMA节点切分可用核心')
+    parser.add_argument('--batch_tokenize', action='store_true', help='使用fast tokenizer或多进程批量tokenize')
+    parser.add_argument('--tokenize_workers', default=os.cpu_count(), type=int, required=False, help='批量tokenize时slow tokenizer的进程数')
+    parser.add_argument('--cache_frozen', action='store_true', help='缓存冻结层的输出, 只训练顶部未冻结的层')
+    parser.add_argument('--compact', action='store_true', help='按列压缩存储数据集, 标签在collate时展开为one-hot')
+    parser.add_argument('--stream', action='store_true', help='流式读取训练集, 在DataLoader的worker中tokenize')
+    parser.add_argument('--shuffle_buffer', default=10000, type=int, required=False, help='流式读取时shuffle buffer的大小')
+    parser.add_argument('--onnx_dir', type=str, required=False, help='导出ONNX模型的目录, 不指定时不导出')
+    parser.add_argument('--onnx_threads', default=1, type=int, required=False, help='ONNX Runtime的intra-op线程数')
+    parser.add_argument('--keep_ckpt', action='store_true', help='训练结束后保留最优checkpoint, 用于导出int8模型')
+    parser.add_argument('--async_eval', action='store_true', help='在独立进程中评估测试集, 不阻塞训练')
+    parser.add_argument('--eval_every', default=1, type=int, required=False, help='异步评估时每N个epoch评估一次')
+    parser.add_argument('--eval_on_improve', action='store_true', help='异步评估时只在验证集marco f1提升时评估')
+    parser.add_argument('--eval_device', default='cpu', type=str, required=False, help='异步评估使用的设备, 例如cpu, cuda:1')
     
 
     args = parser.parse_args()
+    set_cache_dir(None if args.pretrained_cache.lower() == 'none' else args.pretrained_cache)
+    setup_device(args.device, args.num_threads, args.cpu_slot, args.cpu_slots)
     print('args:\n' + args.__repr__())
     
-    # 占用全部显存
-    if not args.local_model:
-        out_name = f"output/rq1/{args.model.replace('-', '_').replace('/', '_')}_{args.embed}_{args.trial}_out.csv"
-    else:
-        # model_path = args.model.split('/')[-2]
-        model_path = args.model.split('/')[-1]
-        out_name = f"output/rq1/{model_path.replace('-', '_').replace('/', '_')}_{args.embed}_{args.trial}_out.csv"
-
-    if os.path.exists(out_name):
-        metric_dict_df = pd.read_csv(out_name)
-        metric_dict = metric_dict_df.to_dict(orient="list")
-    else:
-        if not os.path.exists('./output/rq1'):
-            os.makedirs('output/rq1')
-
-        metric_dict = {
-            'repo': [],
-            'test_acc_1_epoch': [],
-            'test_precision_1_epoch': [],
-            'test_recall_1_epoch': [],
-            'test_f1_marco_1_epoch': [],
-            'test_f1_marco_weight_1_epoch': [],
-            'test_f1_mirco_1_epoch': [],
-
-            'test_acc_2_epoch': [],
-            'test_precision_2_epoch': [],
-            'test_recall_2_epoch': [],
-            'test_f1_marco_2_epoch': [],
-            'test_f1_marco_weight_2_epoch': [],
-            'test_f1_mirco_2_epoch': [],
-
-        }
-        metric_dict_df = pd.DataFrame(metric_dict)
+    out_name = result_csv(args.model, args.embed, args.trial, args.local_model)
+    # 结果写入多个进程共用的结果库, 结果 csv 在所有训练结束后由结果库生成一次, 已有的 csv 先导入结果库
+    store = ResultsStore(args.results_db)
+    result_key = {'model': result_model(args.model, args.local_model), 'embed': args.embed, 'trial': args.trial}
+    store.import_csv(out_name, **result_key)
     
     # train on concat file
     # training_times = 10
-    for t in  range(args.train_time):
+    # 从 start_time 开始训练, 用于 sweep 中断后继续
+    times = range(args.start_time, args.train_time)
+    # 多种子训练时所有次数在一次训练中完成
+    ensemble_seeds = list(times) if args.seed_ensemble and args.model in ["textcnn", "bilstm", "rcnn"] else None
+    if ensemble_seeds is not None:
+        times = times[:1]
+    for t in times:
         concat_file = args.train_file
         # concat_file = './my_data/train/concat_concat/concat_concat.txt'
         # concat_file = './my_data/train/pytorch-CycleGAN-and-pix2pix_TRAIN_Aug/pytorch-CycleGAN-and-pix2pix_TRAIN_Aug.txt'
@@ -740,15 +798,50 @@ def main():
             args.do_predict, 
             args.batch_size,
             args.base_lr,
-            args.trial)
+            args.trial,
+            cache_dir=None if args.cache_dir.lower() == 'none' else args.cache_dir,
+            batch_tokenize=args.batch_tokenize,
+            tokenize_workers=args.tokenize_workers,
+            compact=args.compact,
+            cache_frozen=args.cache_frozen,
+            stream=args.stream,
+            shuffle_buffer=args.shuffle_buffer,
+            keep_ckpt=args.keep_ckpt,
+            times=t,
+            onnx_dir=args.onnx_dir,
+            onnx_threads=args.onnx_threads,
+            async_eval=args.async_eval,
+            eval_every=args.eval_every,
+            eval_on_improve=args.eval_on_improve,
+            eval_device=args.eval_device,
+            pipeline_dir=None if args.pipeline_dir.lower() == 'none' else args.pipeline_dir,
+            cache_eval=args.cache_eval,
+            bf16=args.bf16,
+            plan_batch=args.plan_batch,
+            effective_batch_size=args.effective_batch_size,
+            memory_fraction=args.memory_fraction,
+            max_epochs=args.max_epochs,
+            trainable_layers=args.trainable_layers,
+            class_weights=None if args.class_weights is None else [float(w) for w in args.class_weights.split(',')],
+            search_dir=args.search_dir,
+            ensemble_seeds=ensemble_seeds)
+        if args.search_dir is not None:
+            # successive halving 的一次训练只记录验证集分数, 不写入结果 csv
+            with open(os.path.join(args.search_dir, 'result.json'), 'w', encoding='utf-8') as f:
+                json.dump(each_metrics, f)
+            break
         name = concat_file.split('/')[-1].split('.')[0]
-        metric_dict['repo'].append(name + '_times_' + str(t))
-        for k, v in each_metrics.items():
-            if k in metric_dict:
-                metric_dict[k].append(v)
-
-        df = pd.DataFrame(metric_dict)
-        df.to_csv(out_name, index=False)
+        if ensemble_seeds is None:
+            store.add(repo=name, seed=t, metrics=each_metrics, **result_key)
+            continue
+        # 多种子训练记录每个种子的指标, 以及所有种子的均值和标准差
+        summary = aggregate_metrics(each_metrics)
+        span = f'{ensemble_seeds[0]}-{ensemble_seeds[-1]}'
+        rows = list(zip(ensemble_seeds, each_metrics)) + [(span + '_mean', summary['mean']), (span + '_std', summary['std'])]
+        for seed, seed_metrics in rows:
+            store.add(repo=name, seed=seed, metrics=seed_metrics, **result_key)
+    if args.search_dir is None:
+        store.export_csv(out_name, **result_key)
 if __name__ == "__main__":
     # os.environ['http_proxy'] = 'http://nbproxy.mlp.oppo.local:8888'
     # os.environ['https_proxy'] = 'http://nbproxy.mlp.oppo.local:8888'
@@ -0,0 +1,122 @@
+import argparse
+
+import numpy as np
+
+from GitHubIssue.dataset.batching import DynamicPaddingCollator
+from GitHubIssue.dataset.issue_dataset import IssueDataset
+from GitHubIssue.models.bert import MODEL_CONFIG
+from GitHubIssue.models.linear_probe import probe_metrics, train_linear_probes
+from GitHubIssue.tokenizer.pretrained import load_tokenizer
+from GitHubIssue.util.device import torch_device
+from GitHubIssue.util.pipeline import Pipeline, collect_labels
+from GitHubIssue.util.pretrained_cache import pretrained_model
+from GitHubIssue.util.probe import (EmbeddingStore, embedding_store_path,
+                                    extract_pooled_embeddings, issue_key)
+from GitHubIssue.util.results_store import RESULT_COLUMNS, RESULT_DB, ResultsStore
+from GitHubIssue.util.sweep import repo_name, result_model
+
+# 结果库中线性探测的 embed, 与 train_cross.py 的结果区分
+PROBE_EMBED = 'linear_probe'
+PROBE_COLUMNS = RESULT_COLUMNS + ['lr', 'weight_decay', 'valid_f1_marco']
+
+
+def probe_single(train_file, valid_file, test_file, model_name, device=0, local_model=False, cache_dir='./cache/probe',
+                 lrs=(1e-3, 1e-2), weight_decays=(0.0, 1e-2), epochs=500, batch_size=32, pipeline_dir=None):
+    """
+    冻结 backbone 的线性探测: backbone 只对未缓存的 issue 计算一次 pooled 向量, 之后只在缓存的特征矩阵上训练分类头.
+    对应 train_cross.py --disablefinetune (非 sequence 模型只训练 pooler_output 上的分类头), 分类头和损失相同,
+    但分类头在整个特征矩阵上按多组超参数训练并按验证集选择, 分数不能与 train_cross.py 的结果直接比较,
+    所以作为单独的脚本, 结果以 embed=linear_probe 写入结果库
+    """
+    # 与 train_cross.py 相同的数据划分
+    splits = Pipeline(pipeline_dir).split(train_file, valid_file, test_file, test_size=0.3, valid_size=0.2)
+
+    # 本地模型需要从路径中提取出模型名称, 与 train_cross.py 相同
+    model_path = model_name
+    if local_model:
+        model_name = model_name.split('/')[-1]
+        print(f"model_name: {model_path}")
+    if model_name not in MODEL_CONFIG:
+        raise Exception(f"linear probe only supports {list(MODEL_CONFIG.keys())}")
+
+    tokenizer = load_tokenizer(model_path, local_model)
+
+    all_labels = collect_labels(*splits)
+    label_to_id = {c: i for i, c in enumerate(all_labels)}
+    print(f"all_labels:{all_labels}")
+
+    device = torch_device(device)
+    store = EmbeddingStore(embedding_store_path(cache_dir, model_path, tokenizer))
+    backbone = None
+    features, labels = [], []
+    for data in splits:
+        keys = [issue_key(tokenizer, obj) for obj in data]
+        missing = {}
+        for k, obj in zip(keys, data):
+            if k not in store and k not in missing:
+                missing[k] = obj
+        if len(missing) != 0:
+            if backbone is None:
+                backbone = pretrained_model(MODEL_CONFIG[model_name], model_path)
+            dataset = IssueDataset(list(missing.values()), all_labels, tokenizer, compact=True)
+            collate_fn = DynamicPaddingCollator(padding_side=tokenizer.padding_side, pad_token_id=tokenizer.pad_token_id)
+            store.add(list(missing.keys()), extract_pooled_embeddings(backbone, dataset, collate_fn, device, batch_size))
+        features.append(store.get(keys))
+        labels.append(np.array([label_to_id[obj['labels']] for obj in data], dtype=np.int64))
+
+    (train_x, valid_x, test_x), (train_y, valid_y, test_y) = features, labels
+    probes = train_linear_probes(train_x, train_y, valid_x, valid_y, len(all_labels), lrs=lrs,
+                                 weight_decays=weight_decays, epochs=epochs, device=device)
+    for probe in probes:
+        print(f"lr: {probe.lr}, weight_decay: {probe.weight_decay}, valid_f1_marco: {probe.valid_f1:.4f}")
+
+    best = probes[0]
+    metrics = probe_metrics(best, test_x, test_y, len(all_labels))
+    metrics['lr'] = best.lr
+    metrics['weight_decay'] = best.weight_decay
+    metrics['valid_f1_marco'] = best.valid_f1
+    print(metrics)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Linear probe parameters.')
+    parser.add_argument('--device', default=0, type=int, required=False, help='使用的实验设备, -1:CPU, >=0:GPU')
+    parser.add_argument('--model', default='bert-base-uncased', type=str, required=False, help='模型名称')
+    parser.add_argument('--local_model', required=False, action="store_true", help='使用本地模型')
+    parser.add_argument('--train_file', type=str, help='训练数据')
+    parser.add_argument('--valid_file', type=str, help='验证数据')
+    parser.add_argument('--test_file', type=str, help='测试数据')
+    parser.add_argument('--trial', type=str, help='训练名称')
+    parser.add_argument('--cache_dir', default='./cache/probe', type=str, required=False, help='pooled向量缓存目录')
+    parser.add_argument('--pipeline_dir', default='./cache/pipeline', type=str, required=False, help='数据划分的缓存目录, none:不使用缓存')
+    parser.add_argument('--lrs', default='1e-3,1e-2', type=str, required=False, help='分类头的学习率, 逗号分隔')
+    parser.add_argument('--weight_decays', default='0,1e-2', type=str, required=False, help='分类头的权重衰减, 逗号分隔')
+    parser.add_argument('--epochs', default=500, type=int, required=False, help='分类头训练的epoch数')
+    parser.add_argument('--results_db', default=RESULT_DB, type=str, required=False, help='多个进程共用的SQLite结果库, 结果csv由结果库生成')
+
+    args = parser.parse_args()
+    print('args:\n' + args.__repr__())
+
+    valid_file = args.valid_file if args.valid_file is not None else args.train_file
+    test_file = args.test_file if args.test_file is not None else args.train_file
+    metrics = probe_single(args.train_file, valid_file, test_file, args.model, args.device, args.local_model, args.cache_dir,
+                           lrs=[float(x) for x in args.lrs.split(',')],
+                           weight_decays=[float(x) for x in args.weight_decays.split(',')],
+                           epochs=args.epochs,
+                           pipeline_dir=None if args.pipeline_dir.lower() == 'none' else args.pipeline_dir)
+
+    model_name = result_model(args.model, args.local_model)
+    out_name = f"output/probe/{model_name.replace('-', '_').replace('/', '_')}_{args.trial}_out.csv"
+    # 多个探测同时运行时由结果库串行写入, 结果 csv 由结果库生成
+    store = ResultsStore(args.results_db)
+    result_key = {'model': model_name, 'embed': PROBE_EMBED, 'trial': args.trial}
+    try:
+        store.add(repo=repo_name(args.train_file), seed='', metrics=metrics, **result_key)
+        store.export_csv(out_name, columns=PROBE_COLUMNS, **result_key)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()